@@ -0,0 +1,132 @@
+"""
+Measure read_file latency while large content searches are running.
+
+Usage (from servers/filesystem):
+
+    python benchmarks/concurrency.py [--files 5000] [--file-kb 32]
+        [--reads 200] [--searches 2]
+
+A temporary tree of ``--files`` text files is generated and served through
+httpx's ASGI transport, in this process, so every request shares one event
+loop as it would on a single uvicorn worker. read_file is timed on its own,
+then again while ``--searches`` clients repeatedly run search_content over
+the whole tree, until each search has finished at least once. If disk work
+blocked the event loop, every read would wait for a search to finish; off
+the loop, reads stay close to their idle latency.
+"""
+
+from pathlib import Path
+import argparse
+import asyncio
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+import httpx
+
+SERVER_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(SERVER_DIR))
+
+
+def make_tree(root: Path, files: int, file_kb: int, rng: random.Random):
+    words = ["alpha", "beta", "gamma", "delta", "epsilon", "zeta", "eta", "theta"]
+    line_count = max(1, file_kb * 1024 // 48)
+    for i in range(files):
+        directory = root / f"dir{i % 50}"
+        directory.mkdir(exist_ok=True)
+        lines = (" ".join(rng.choices(words, k=7)) for _ in range(line_count))
+        (directory / f"file{i}.txt").write_text("\n".join(lines) + "\n")
+
+
+def summary(latencies):
+    latencies = sorted(latencies)
+    return (
+        f"median {statistics.median(latencies) * 1000:7.1f} ms"
+        f"  p95 {latencies[int(len(latencies) * 0.95)] * 1000:7.1f} ms"
+        f"  max {latencies[-1] * 1000:7.1f} ms"
+    )
+
+
+async def time_reads(client, paths, count, rng):
+    latencies = []
+    for _ in range(count):
+        start = time.perf_counter()
+        response = await client.post("/read_file", json={"path": rng.choice(paths)})
+        response.raise_for_status()
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+async def search_forever(client, root: Path, durations):
+    while True:
+        start = time.perf_counter()
+        response = await client.post(
+            "/search_content",
+            json={"path": str(root), "search_query": "no such phrase"},
+        )
+        response.raise_for_status()
+        durations.append(time.perf_counter() - start)
+
+
+async def run(args, root: Path, paths):
+    import main
+
+    rng = random.Random(1)
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(
+        transport=transport, base_url="http://test", timeout=None
+    ) as client:
+        idle = await time_reads(client, paths, args.reads, rng)
+        print(f"read_file, idle:        {summary(idle)}")
+
+        durations = []
+        searches = [
+            asyncio.create_task(search_forever(client, root, durations))
+            for _ in range(args.searches)
+        ]
+        # Let the searches get going before timing reads against them.
+        await asyncio.sleep(0.2)
+        busy = []
+        # Keep reading until each search has finished at least once.
+        while len(busy) < args.reads or len(durations) < args.searches:
+            busy += await time_reads(client, paths, 1, rng)
+        for task in searches:
+            task.cancel()
+        await asyncio.gather(*searches, return_exceptions=True)
+        print(f"read_file, {args.searches} searches:  {summary(busy)}")
+        print(
+            f"search_content over {args.files:,} files:"
+            f" {statistics.median(durations):.2f}s median,"
+            f" {len(busy)} reads while {len(durations)} finished"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--files", type=int, default=5000)
+    parser.add_argument("--file-kb", type=int, default=32)
+    parser.add_argument("--reads", type=int, default=200)
+    parser.add_argument("--searches", type=int, default=2)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        root = Path(tmp).resolve()
+        start = time.perf_counter()
+        make_tree(root, args.files, args.file_kb, random.Random(0))
+        print(
+            f"generated {args.files:,} files of {args.file_kb} KiB"
+            f" in {time.perf_counter() - start:.1f}s"
+        )
+        paths = [str(p) for p in root.rglob("*.txt")]
+
+        import config
+
+        # main imports the list itself, so fill it in place.
+        config.ALLOWED_DIRECTORIES[:] = [str(root)]
+        asyncio.run(run(args, root, paths))
+
+
+if __name__ == "__main__":
+    main()
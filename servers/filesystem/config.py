@@ -4,4 +4,34 @@ import pathlib
 # Constants
 ALLOWED_DIRECTORIES = [
     str(pathlib.Path(os.path.expanduser("~/tmp")).resolve())
-]  # 👈 Replace with your paths
\ No newline at end of file
+]  # 👈 Replace with your paths
+
+# Disk work runs on worker threads. Each endpoint may use at most this many at
+# once: quick file operations, and recursive walks (search_files,
+# search_content, directory_tree), which can take seconds on large trees.
+FILE_IO_CONCURRENCY = int(os.getenv("FILE_IO_CONCURRENCY", "8"))
+SEARCH_CONCURRENCY = int(os.getenv("SEARCH_CONCURRENCY", "2"))
+
+# read_file memory-maps files of at least this many bytes when it reads part
+# of them or streams them, instead of loading them. 0 never maps.
+READ_MMAP_MIN_BYTES = int(os.getenv("READ_MMAP_MIN_BYTES", str(8 << 20)))
+
+# search_content searches files in this many worker processes; 1 searches in
+# the request's own thread.
+SEARCH_PROCESSES = int(os.getenv("SEARCH_PROCESSES", str(os.cpu_count() or 1)))
+
+# search_content keeps a trigram index of each allowed directory in this
+# directory, refreshed every SEARCH_INDEX_REFRESH seconds, to find which
+# files can match before reading any. Files larger than
+# SEARCH_INDEX_MAX_FILE_BYTES are not indexed and always searched. Empty
+# disables the index.
+SEARCH_INDEX_DIR = os.getenv("SEARCH_INDEX_DIR", "")
+SEARCH_INDEX_REFRESH = float(os.getenv("SEARCH_INDEX_REFRESH", "60"))
+SEARCH_INDEX_MAX_FILE_BYTES = int(os.getenv("SEARCH_INDEX_MAX_FILE_BYTES", str(16 << 20)))
+
+# list_directory, directory_tree and get_metadata keep listings and stat
+# results in a cache of about this many MiB, kept current with inotify
+# (Linux only) using at most METADATA_CACHE_WATCHES watches (and never more
+# than half the kernel's limit). 0 disables it.
+METADATA_CACHE_MB = float(os.getenv("METADATA_CACHE_MB", "64"))
+METADATA_CACHE_WATCHES = int(os.getenv("METADATA_CACHE_WATCHES", "8192"))
@@ -0,0 +1,324 @@
+"""
+Directory metadata cache for list_directory, directory_tree and get_metadata.
+
+Listings come from os.scandir, whose entries carry the file type the
+directory itself reports, so telling files from directories costs no extra
+stat. Listings and stat results are kept in an LRU bounded by an estimate of
+their memory, and each is dropped as soon as inotify reports a change that
+could affect it. A directory is watched, along with each of its parents up
+to the allowed directory holding it (so renames further up are seen), before
+it is first read. Each watch lasts as long as some cached entry relies on
+it, and the number of watches is capped: when the cap is reached, the least
+recently used entries are evicted until their watches free up.
+
+Events are read from the inotify descriptor, without blocking, each time the
+cache is used. The kernel queues them when the change is made, so a listing
+requested after a write completes never predates it. A result is only kept
+if no event arrived while it was being read. If the kernel's queue
+overflows, the cache starts over.
+
+inotify is Linux only; open_cache() returns None elsewhere.
+"""
+
+from collections import OrderedDict
+from typing import Callable, Dict, Iterator, List, Optional, Set, Tuple
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import struct
+import threading
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_ATTRIB
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_CREATE
+    | IN_DELETE
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+)
+# Events that add, remove or rename an entry of the watched directory.
+ENTRY_EVENTS = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+EVENT = struct.Struct("iIII")
+
+# Rough bytes held per cached listing, per listed entry and per stat result.
+LISTING_COST = 200
+ENTRY_COST = 100
+STAT_COST = 300
+
+Listing = List[Tuple[str, bool]]
+# A watched path and its watch descriptor.
+Watch = Tuple[str, int]
+
+logger = logging.getLogger(__name__)
+
+
+def scan(path: str) -> Listing:
+    """(name, is directory) for each entry of ``path``, in directory order."""
+    with os.scandir(path) as entries:
+        return [(entry.name, entry.is_dir()) for entry in entries]
+
+
+def inotify_init(consequence: str) -> Optional[Tuple[ctypes.CDLL, int]]:
+    """
+    libc, set up for inotify calls, and a new non-blocking inotify
+    descriptor; None (logging ``consequence``) where inotify is not
+    available.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        init = libc.inotify_init1
+    except (OSError, AttributeError, TypeError):
+        return None
+    libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+    fd = init(os.O_NONBLOCK | os.O_CLOEXEC)
+    if fd < 0:
+        logger.warning("inotify unavailable (%s); %s", os.strerror(ctypes.get_errno()), consequence)
+        return None
+    return libc, fd
+
+
+def read_events(fd: int) -> Iterator[Tuple[int, int, str]]:
+    """(watch descriptor, mask, name) for each event queued on ``fd``."""
+    while True:
+        try:
+            data = os.read(fd, 1 << 16)
+        except BlockingIOError:
+            return
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, pos)
+            pos += EVENT.size
+            name = data[pos : pos + length].rstrip(b"\0")
+            pos += length
+            yield wd, mask, os.fsdecode(name)
+
+
+def _under(path: str, top: str) -> bool:
+    return path == top or path.startswith(top.rstrip(os.sep) + os.sep)
+
+
+class DirectoryCache:
+    """
+    Listings and stat results under ``roots``, holding about ``budget_bytes``
+    of them and at most ``max_watches`` inotify watches, kept current
+    through the inotify instance ``fd``.
+    """
+
+    def __init__(self, libc, fd: int, roots: List[str], budget_bytes: int, max_watches: int):
+        self._libc = libc
+        self._fd = fd
+        self.roots = roots
+        self.budget_bytes = budget_bytes
+        self.max_watches = max_watches
+        self._lock = threading.Lock()
+        # ("list" | "stat", path) -> (value, estimated bytes, watches), oldest
+        # first; watches are the (path, wd) pairs the entry relies on.
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[object, int, List[Watch]]]" = OrderedDict()
+        self._bytes = 0
+        self._watches: Dict[str, int] = {}
+        self._paths_of: Dict[int, Set[str]] = {}
+        # Cached entries and reads in progress relying on each watched path.
+        # A watch is removed when its count drops to zero.
+        self._users: Dict[str, int] = {}
+        # Bumped by every event, so a read that overlapped one is not kept.
+        self._epoch = 0
+
+    # -- watches --
+
+    def _unwatch(self, path: str):
+        wd = self._watches.pop(path, None)
+        self._users.pop(path, None)
+        if wd is None:
+            return
+        paths = self._paths_of.get(wd)
+        if paths is None:
+            return
+        paths.discard(path)
+        if not paths:
+            del self._paths_of[wd]
+            self._libc.inotify_rm_watch(self._fd, wd)
+
+    def _release(self, watches: List[Watch]):
+        for path, wd in watches:
+            # A watch replaced since (the path moved) is no longer counted.
+            if self._watches.get(path) != wd:
+                continue
+            self._users[path] -= 1
+            if not self._users[path]:
+                self._unwatch(path)
+
+    def _watch(self, path: str, watches: List[Watch]) -> bool:
+        """Watch ``path`` on behalf of a read, adding it to ``watches``."""
+        wd = self._watches.get(path)
+        if wd is None:
+            while len(self._watches) >= self.max_watches and self._entries:
+                self._evict()
+            if len(self._watches) >= self.max_watches:
+                return False
+            wd = self._libc.inotify_add_watch(self._fd, os.fsencode(path), WATCH_MASK)
+            if wd < 0:
+                if ctypes.get_errno() == errno.ENOSPC and self._watches:
+                    # Other processes use up the rest of the kernel's limit.
+                    logger.warning(
+                        "inotify watch limit reached; directory cache now keeps at most %d watches",
+                        len(self._watches),
+                    )
+                    self.max_watches = len(self._watches)
+                return False
+            self._watches[path] = wd
+            self._paths_of.setdefault(wd, set()).add(path)
+        self._users[path] = self._users.get(path, 0) + 1
+        watches.append((path, wd))
+        return True
+
+    def _watch_up(self, directory: str, watches: List[Watch]) -> bool:
+        """Watch ``directory`` and its parents up to the allowed directory holding it."""
+        while True:
+            if not self._watch(directory, watches):
+                return False
+            if not any(_under(directory, root) and directory != root for root in self.roots):
+                return True
+            directory = os.path.dirname(directory)
+
+    def _watch_stat(self, path: str, watches: List[Watch]) -> bool:
+        if not self._watch_up(os.path.dirname(path) or path, watches):
+            return False
+        # A directory's own watch sees entries come and go, which change its
+        # mtime and size; for anything else the parent's watch is enough.
+        if os.path.isdir(path):
+            return self._watch(path, watches)
+        return True
+
+    # -- cache entries --
+
+    def _drop(self, key: Tuple[str, str]):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._bytes -= entry[1]
+            self._release(entry[2])
+
+    def _evict(self):
+        self._drop(next(iter(self._entries)))
+
+    def _store(self, key: Tuple[str, str], value, cost: int, watches: List[Watch]):
+        self._drop(key)
+        self._entries[key] = (value, cost, watches)
+        self._bytes += cost
+        while self._bytes > self.budget_bytes and self._entries:
+            self._evict()
+
+    def _forget_under(self, top: str):
+        """Drop what is cached and watched at or below ``top``, whose paths changed."""
+        for key in [key for key in self._entries if _under(key[1], top)]:
+            self._drop(key)
+        # Watches still held by reads in progress; those reads are not kept.
+        for path in [path for path in self._watches if _under(path, top)]:
+            self._unwatch(path)
+
+    # -- inotify --
+
+    def _drain(self):
+        # Called with the lock held.
+        for wd, mask, name in read_events(self._fd):
+            self._epoch += 1
+            if mask & IN_Q_OVERFLOW:
+                while self._entries:
+                    self._evict()
+                continue
+            for directory in list(self._paths_of.get(wd, ())):
+                if name:
+                    child = os.path.join(directory, name)
+                    self._drop(("stat", child))
+                    if mask & ENTRY_EVENTS:
+                        self._drop(("list", directory))
+                        self._drop(("stat", directory))
+                        if mask & IN_ISDIR:
+                            self._forget_under(child)
+                elif mask & (IN_DELETE_SELF | IN_MOVE_SELF | IN_IGNORED):
+                    self._forget_under(directory)
+                else:
+                    self._drop(("list", directory))
+                    self._drop(("stat", directory))
+            if mask & IN_IGNORED:
+                for directory in self._paths_of.pop(wd, ()):
+                    self._watches.pop(directory, None)
+                    self._users.pop(directory, None)
+
+    # -- lookups --
+
+    def _cached(self, key: Tuple[str, str], load: Callable, watch: Callable, cost: Callable):
+        with self._lock:
+            self._drain()
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                return entry[0]
+            epoch = self._epoch
+            watches: List[Watch] = []
+            watched = watch(key[1], watches)
+        try:
+            value = load(key[1])
+        except BaseException:
+            with self._lock:
+                self._release(watches)
+            raise
+        with self._lock:
+            self._drain()
+            if watched and epoch == self._epoch:
+                self._store(key, value, cost(value), watches)
+            else:
+                self._release(watches)
+        return value
+
+    def listing(self, path: str) -> Listing:
+        """scan(path), from the cache when nothing in the directory changed."""
+        return self._cached(
+            ("list", path),
+            scan,
+            self._watch_up,
+            lambda listing: LISTING_COST + ENTRY_COST * len(listing),
+        )
+
+    def stat(self, path: str) -> os.stat_result:
+        """os.stat(path), from the cache when the path did not change."""
+        return self._cached(("stat", path), os.stat, self._watch_stat, lambda _: STAT_COST)
+
+    def close(self):
+        os.close(self._fd)
+
+
+def open_cache(roots: List[str], budget_bytes: int, max_watches: int) -> Optional[DirectoryCache]:
+    """
+    A DirectoryCache, or None where inotify is not available. It keeps at
+    most ``max_watches`` watches, and never more than half the kernel's
+    per-user limit, which other programs share.
+    """
+    opened = inotify_init("directory cache disabled")
+    if opened is None:
+        return None
+    libc, fd = opened
+    try:
+        with open("/proc/sys/fs/inotify/max_user_watches") as f:
+            max_watches = min(max_watches, int(f.read()) // 2)
+    except (OSError, ValueError):
+        pass
+    return DirectoryCache(libc, fd, roots, budget_bytes, max_watches)
@@ -1,5 +1,5 @@
 from fastapi import FastAPI, HTTPException, Body
-from fastapi.responses import PlainTextResponse
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 
 
@@ -7,18 +7,69 @@ from pydantic import BaseModel, Field
 import os
 import pathlib
 import asyncio
-from typing import List, Optional, Literal, Dict, Union
+from typing import Callable, List, Optional, Literal, Dict, Tuple, Union
 import difflib
 import shutil
 from datetime import datetime, timezone, timedelta
 import json
 import secrets
-from config import ALLOWED_DIRECTORIES
+import functools
+import mmap
+import re
+import stat
+import time
+import anyio
+from contextlib import asynccontextmanager
+from config import (
+    ALLOWED_DIRECTORIES,
+    FILE_IO_CONCURRENCY,
+    METADATA_CACHE_MB,
+    METADATA_CACHE_WATCHES,
+    READ_MMAP_MIN_BYTES,
+    SEARCH_CONCURRENCY,
+    SEARCH_INDEX_DIR,
+    SEARCH_INDEX_MAX_FILE_BYTES,
+    SEARCH_INDEX_REFRESH,
+    SEARCH_PROCESSES,
+)
+from search import ContentSearch, Query
+import dircache
+
+indexer = None
+if SEARCH_INDEX_DIR:
+    from trigram import Indexer
+
+    indexer = Indexer(
+        ALLOWED_DIRECTORIES,
+        SEARCH_INDEX_DIR,
+        SEARCH_INDEX_REFRESH,
+        SEARCH_INDEX_MAX_FILE_BYTES,
+        SEARCH_PROCESSES,
+    )
+
+metadata_cache = None
+if METADATA_CACHE_MB > 0:
+    metadata_cache = dircache.open_cache(
+        ALLOWED_DIRECTORIES, int(METADATA_CACHE_MB * (1 << 20)), METADATA_CACHE_WATCHES
+    )
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if indexer is not None:
+        indexer.start()
+    yield
+    if indexer is not None:
+        await anyio.to_thread.run_sync(indexer.close)
+    if metadata_cache is not None:
+        metadata_cache.close()
+
 
 app = FastAPI(
     title="Secure Filesystem API",
     version="0.1.1",
     description="A secure file manipulation server for reading, editing, writing, listing, and searching files with access restrictions.",
+    lifespan=lifespan,
 )
 
 origins = ["*"]
@@ -52,6 +103,97 @@ def normalize_path(requested_path: str) -> pathlib.Path:
     )
 
 
+def scan_directory(path: pathlib.Path) -> List[Tuple[str, bool]]:
+    """(name, is directory) for each entry of ``path``, cached if possible."""
+    if metadata_cache is not None:
+        return metadata_cache.listing(str(path))
+    return dircache.scan(str(path))
+
+
+def stat_path(path: pathlib.Path) -> os.stat_result:
+    if metadata_cache is not None:
+        return metadata_cache.stat(str(path))
+    return os.stat(path)
+
+
+def offload(limit: Union[int, anyio.CapacityLimiter]):
+    """
+    Run a blocking endpoint on a worker thread so the event loop keeps serving
+    other requests. At most ``limit`` calls run at once; the rest wait for a
+    slot. Pass a shared CapacityLimiter to bound several endpoints together.
+    """
+    limiter = limit if isinstance(limit, anyio.CapacityLimiter) else anyio.CapacityLimiter(limit)
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def endpoint(*args, **kwargs):
+            return await anyio.to_thread.run_sync(
+                functools.partial(func, *args, **kwargs), limiter=limiter
+            )
+
+        return endpoint
+
+    return decorator
+
+
+# Mutations take turns, as they did when they ran on the event loop: edits
+# read, modify and write back, and delete_path keeps its tokens in a file.
+WRITE_LIMITER = anyio.CapacityLimiter(1)
+
+# search_content's own limiter, which streamed searches also hold while they
+# run after the endpoint has returned.
+SEARCH_CONTENT_LIMITER = anyio.CapacityLimiter(SEARCH_CONCURRENCY)
+
+# Size of each piece streamed by read_file, and of the windows it counts
+# line breaks in.
+READ_CHUNK_BYTES = 1 << 16
+
+
+def open_buffer(path: pathlib.Path) -> Tuple[Union[bytes, mmap.mmap], int, Callable]:
+    """
+    The file's bytes, its size and a function releasing them. Files of
+    READ_MMAP_MIN_BYTES or more are memory-mapped, so reading part of them
+    only pages in that part.
+    """
+    with path.open("rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if READ_MMAP_MIN_BYTES and size >= READ_MMAP_MIN_BYTES:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            return buffer, size, buffer.close
+        return f.read(), size, lambda: None
+
+
+def char_boundary(buffer, pos: int, size: int) -> int:
+    """``pos`` moved forward past any UTF-8 continuation bytes."""
+    while pos < size and buffer[pos] & 0xC0 == 0x80:
+        pos += 1
+    return pos
+
+
+def skip_lines(buffer, pos: int, count: int, size: int) -> int:
+    """The offset just after the ``count``-th line break from ``pos``, or ``size``."""
+    while count > 0 and pos < size:
+        window = buffer[pos : pos + READ_CHUNK_BYTES]
+        found = window.count(b"\n")
+        if found < count:
+            count -= found
+            pos += len(window)
+            continue
+        end = 0
+        for _ in range(count):
+            end = window.find(b"\n", end) + 1
+        return pos + end
+    return min(pos, size)
+
+
+def stream_range(buffer, start: int, end: int, close: Callable):
+    try:
+        for pos in range(start, end, READ_CHUNK_BYTES):
+            yield buffer[pos : min(pos + READ_CHUNK_BYTES, end)]
+    finally:
+        close()
+
+
 # ------------------------------------------------------------------------------
 # Pydantic Schemas
 # ------------------------------------------------------------------------------
@@ -59,6 +201,21 @@ def normalize_path(requested_path: str) -> pathlib.Path:
 
 class ReadFileRequest(BaseModel):
     path: str = Field(..., description="Path to the file to read")
+    offset: Optional[int] = Field(
+        default=None, ge=0, description="Byte offset to start reading at (e.g. a previous next_offset)."
+    )
+    length: Optional[int] = Field(
+        default=None, ge=1, description="Maximum number of bytes to read from offset."
+    )
+    start_line: Optional[int] = Field(
+        default=None, ge=1, description="First line to read (1-based). Cannot be combined with offset/length."
+    )
+    end_line: Optional[int] = Field(
+        default=None, ge=1, description="Last line to read (inclusive). Cannot be combined with offset/length."
+    )
+    stream: bool = Field(
+        default=False, description="If true, send the contents as plain text while they are read instead of as JSON."
+    )
 
 
 class WriteFileRequest(BaseModel):
@@ -119,6 +276,18 @@ class SearchContentRequest(BaseModel):
     file_pattern: Optional[str] = Field(
         default="*", description="Glob pattern to filter files to search within (e.g., '*.py')."
     )
+    regex: bool = Field(
+        default=False, description="If true, search_query is a regular expression rather than literal text."
+    )
+    max_results: Optional[int] = Field(
+        default=None, ge=1, description="Stop after this many matching lines."
+    )
+    timeout_seconds: Optional[float] = Field(
+        default=None, gt=0, description="Stop searching after this long and return what was found."
+    )
+    stream: bool = Field(
+        default=False, description="If true, send matches as newline-delimited JSON as they are found."
+    )
 
 
 class DeletePathRequest(BaseModel):
@@ -207,6 +376,15 @@ class SuccessResponse(BaseModel):
 
 class ReadFileResponse(BaseModel):
     content: str = Field(..., description="UTF-8 encoded text content of the file.")
+    size_bytes: Optional[int] = Field(
+        default=None, description="Size of the whole file, for partial reads."
+    )
+    next_offset: Optional[int] = Field(
+        default=None, description="Byte offset where the rest of the file starts, if the read stopped before the end."
+    )
+    next_line: Optional[int] = Field(
+        default=None, description="First line not read, if a line range stopped before the end of the file."
+    )
 
 
 class DiffResponse(BaseModel):
@@ -219,15 +397,68 @@ class ConfirmationRequiredResponse(BaseModel):
     expires_at: datetime = Field(..., description="UTC timestamp when the token expires.")
 
 
-@app.post("/read_file", response_model=ReadFileResponse, summary="Read a file") # Changed response_class to response_model
-async def read_file(data: ReadFileRequest = Body(...)):
+@app.post(
+    "/read_file",
+    response_model=ReadFileResponse,
+    response_model_exclude_none=True,
+    summary="Read a file",
+)
+@offload(FILE_IO_CONCURRENCY)
+def read_file(data: ReadFileRequest = Body(...)):
     """
-    Read the entire contents of a file and return as JSON.
+    Read the contents of a file and return as JSON.
+
+    To page through a large file, pass offset and length (in bytes, moved
+    forward to whole UTF-8 characters) or start_line and end_line; the
+    response then carries next_offset or next_line for the following page.
+    With stream=true the selected contents are sent as plain text while they
+    are read, so the server never holds the whole file.
     """
     path = normalize_path(data.path)
+    by_lines = data.start_line is not None or data.end_line is not None
+    if by_lines and (data.offset is not None or data.length is not None):
+        raise HTTPException(status_code=400, detail="Use either offset/length or start_line/end_line, not both.")
+    first_line = data.start_line or 1
+    if data.end_line is not None and data.end_line < first_line:
+        raise HTTPException(status_code=400, detail="end_line must not be before start_line.")
+    partial = by_lines or data.offset is not None or data.length is not None
     try:
-        file_content = path.read_text(encoding="utf-8")
-        return ReadFileResponse(content=file_content) # Return Pydantic model instance
+        if not partial and not data.stream:
+            file_content = path.read_text(encoding="utf-8")
+            return ReadFileResponse(content=file_content) # Return Pydantic model instance
+
+        buffer, size, close = open_buffer(path)
+        try:
+            if by_lines:
+                start = skip_lines(buffer, 0, first_line - 1, size)
+                end = size if data.end_line is None else skip_lines(buffer, start, data.end_line - first_line + 1, size)
+            else:
+                start = char_boundary(buffer, min(data.offset or 0, size), size)
+                end = size if data.length is None else char_boundary(buffer, min(start + data.length, size), size)
+        except BaseException:
+            close()
+            raise
+        next_offset = end if end < size else None
+        if data.stream:
+            headers = {"Content-Length": str(end - start)}
+            if next_offset is not None:
+                headers["X-Next-Offset"] = str(next_offset)
+            return StreamingResponse(
+                stream_range(buffer, start, end, close),
+                media_type="text/plain; charset=utf-8",
+                headers=headers,
+            )
+        try:
+            # Logs may hold stray bytes; replace them rather than fail the page.
+            content = buffer[start:end].decode("utf-8", errors="replace")
+        finally:
+            close()
+        return ReadFileResponse(
+            content=content,
+            size_bytes=size,
+            next_offset=next_offset,
+            next_line=data.end_line + 1 if by_lines and next_offset is not None else None,
+        )
     except FileNotFoundError:
         raise HTTPException(status_code=404, detail=f"File not found: {data.path}")
     except PermissionError:
@@ -238,13 +469,16 @@ async def read_file(data: ReadFileRequest = Body(...)):
 
 
 @app.post("/write_file", response_model=SuccessResponse, summary="Write to a file")
-async def write_file(data: WriteFileRequest = Body(...)):
+@offload(WRITE_LIMITER)
+def write_file(data: WriteFileRequest = Body(...)):
     """
     Write content to a file, overwriting if it exists. Returns JSON success message.
     """
     path = normalize_path(data.path)
     try:
         path.write_text(data.content, encoding="utf-8")
+        if indexer is not None:
+            indexer.mark_changed(path)
         return SuccessResponse(message=f"Successfully wrote to {data.path}")
     except PermissionError:
         raise HTTPException(status_code=403, detail=f"Permission denied to write to {data.path}")
@@ -256,7 +490,8 @@ async def write_file(data: WriteFileRequest = Body(...)):
     response_model=Union[SuccessResponse, DiffResponse], # Use Union for multiple response types
     summary="Edit a file with diff"
 )
-async def edit_file(data: EditFileRequest = Body(...)):
+@offload(WRITE_LIMITER)
+def edit_file(data: EditFileRequest = Body(...)):
     """
     Apply a list of edits to a text file.
     Returns JSON success message or JSON diff on dry-run.
@@ -292,6 +527,8 @@ async def edit_file(data: EditFileRequest = Body(...)):
 
         # Write changes if not dry run
         path.write_text(modified, encoding="utf-8")
+        if indexer is not None:
+            indexer.mark_changed(path)
         return SuccessResponse(message=f"Successfully edited file {data.path}") # Return JSON success
 
     except PermissionError:
@@ -304,7 +541,8 @@ async def edit_file(data: EditFileRequest = Body(...)):
 @app.post(
     "/create_directory", response_model=SuccessResponse, summary="Create a directory"
 )
-async def create_directory(data: CreateDirectoryRequest = Body(...)):
+@offload(WRITE_LIMITER)
+def create_directory(data: CreateDirectoryRequest = Body(...)):
     """
     Create a new directory recursively. Returns JSON success message.
     """
@@ -321,25 +559,29 @@ async def create_directory(data: CreateDirectoryRequest = Body(...)):
 @app.post(
     "/list_directory", summary="List a directory"
 )
-async def list_directory(data: ListDirectoryRequest = Body(...)):
+@offload(FILE_IO_CONCURRENCY)
+def list_directory(data: ListDirectoryRequest = Body(...)):
     """
     List contents of a directory.
     """
     dir_path = normalize_path(data.path)
-    if not dir_path.is_dir():
+    try:
+        entries = scan_directory(dir_path)
+    except (FileNotFoundError, NotADirectoryError):
         raise HTTPException(status_code=400, detail="Provided path is not a directory")
 
     listing = []
-    for entry in dir_path.iterdir():
-        entry_type = "directory" if entry.is_dir() else "file"
-        listing.append({"name": entry.name, "type": entry_type})
+    for name, is_dir in entries:
+        entry_type = "directory" if is_dir else "file"
+        listing.append({"name": name, "type": entry_type})
 
     # Return the list directly, FastAPI will serialize it to JSON
     return listing
 
 
 @app.post("/directory_tree", summary="Recursive directory tree")
-async def directory_tree(data: DirectoryTreeRequest = Body(...)):
+@offload(SEARCH_CONCURRENCY)
+def directory_tree(data: DirectoryTreeRequest = Body(...)):
     """
     Recursively return a tree structure of a directory.
     """
@@ -347,13 +589,13 @@ async def directory_tree(data: DirectoryTreeRequest = Body(...)):
 
     def build_tree(current: pathlib.Path):
         entries = []
-        for item in current.iterdir():
+        for name, is_dir in scan_directory(current):
             entry = {
-                "name": item.name,
-                "type": "directory" if item.is_dir() else "file",
+                "name": name,
+                "type": "directory" if is_dir else "file",
             }
-            if item.is_dir():
-                entry["children"] = build_tree(item)
+            if is_dir:
+                entry["children"] = build_tree(current / name)
             entries.append(entry)
         return entries
 
@@ -361,7 +603,8 @@ async def directory_tree(data: DirectoryTreeRequest = Body(...)):
 
 
 @app.post("/search_files", summary="Search for files")
-async def search_files(data: SearchFilesRequest = Body(...)):
+@offload(SEARCH_CONCURRENCY)
+def search_files(data: SearchFilesRequest = Body(...)):
     """
     Search files and directories matching a pattern.
     """
@@ -392,7 +635,8 @@ async def search_files(data: SearchFilesRequest = Body(...)):
     response_model=Union[SuccessResponse, ConfirmationRequiredResponse], # Updated response model
     summary="Delete a file or directory (two-step confirmation)"
 )
-async def delete_path(data: DeletePathRequest = Body(...)):
+@offload(WRITE_LIMITER)
+def delete_path(data: DeletePathRequest = Body(...)):
     """
     Delete a specified file or directory using a two-step confirmation process.
 
@@ -491,7 +735,8 @@ async def delete_path(data: DeletePathRequest = Body(...)):
 
 
 @app.post("/move_path", response_model=SuccessResponse, summary="Move or rename a file or directory")
-async def move_path(data: MovePathRequest = Body(...)):
+@offload(WRITE_LIMITER)
+def move_path(data: MovePathRequest = Body(...)):
     """
     Move or rename a file or directory from source_path to destination_path.
     Both paths must be within the allowed directories.
@@ -505,6 +750,8 @@ async def move_path(data: MovePathRequest = Body(...)):
             raise HTTPException(status_code=404, detail=f"Source path not found: {data.source_path}")
 
         shutil.move(str(source), str(destination))
+        if indexer is not None:
+            indexer.mark_changed(destination)
         return SuccessResponse(message=f"Successfully moved '{data.source_path}' to '{data.destination_path}'")
 
     except PermissionError:
@@ -514,22 +761,23 @@ async def move_path(data: MovePathRequest = Body(...)):
 
 
 @app.post("/get_metadata", summary="Get file or directory metadata")
-async def get_metadata(data: GetMetadataRequest = Body(...)):
+@offload(FILE_IO_CONCURRENCY)
+def get_metadata(data: GetMetadataRequest = Body(...)):
     """
     Retrieve metadata for a specified file or directory path.
     """
     path = normalize_path(data.path)
 
     try:
-        if not path.exists():
+        try:
+            stat_result = stat_path(path)
+        except (FileNotFoundError, NotADirectoryError):
             raise HTTPException(status_code=404, detail=f"Path not found: {data.path}")
 
-        stat_result = path.stat()
-
         # Determine type
-        if path.is_file():
+        if stat.S_ISREG(stat_result.st_mode):
             file_type = "file"
-        elif path.is_dir():
+        elif stat.S_ISDIR(stat_result.st_mode):
             file_type = "directory"
         else:
             file_type = "other" # Should generally not happen for existing paths normalized
@@ -561,39 +809,61 @@ async def get_metadata(data: GetMetadataRequest = Body(...)):
 
 
 @app.post("/search_content", summary="Search for content within files")
-async def search_content(data: SearchContentRequest = Body(...)):
+@offload(SEARCH_CONTENT_LIMITER)
+def search_content(data: SearchContentRequest = Body(...)):
     """
     Search for text content within files in a specified directory.
+
+    Binary files are skipped. Matches come back in no particular order.
+    With max_results or timeout_seconds the search stops early and reports
+    truncated=true. With stream=true each match is sent as a JSON line
+    ({"type": "match", ...}) as soon as it is found, followed by a summary
+    line ({"type": "summary", "matches": n, "truncated": ...}).
+
+    With SEARCH_INDEX_DIR set, only files whose trigrams can match, or that
+    changed since they were indexed, are read.
     """
     base_path = normalize_path(data.path)
-    results = []
-    search_query_lower = data.search_query.lower()
 
     if not base_path.is_dir():
         raise HTTPException(status_code=400, detail="Provided path is not a directory")
+    try:
+        query = Query(data.search_query, data.regex)
+    except re.error as e:
+        raise HTTPException(status_code=400, detail=f"Invalid regular expression: {e}")
+
+    paths = None
+    if indexer is not None:
+        paths = indexer.candidates(base_path, query, data.file_pattern, data.recursive)
+    if paths is None:
+        iterator = base_path.rglob(data.file_pattern) if data.recursive else base_path.glob(data.file_pattern)
+        paths = (str(item_path) for item_path in iterator if item_path.is_file())
+    search = ContentSearch(
+        paths,
+        query,
+        max_results=data.max_results,
+        deadline=time.time() + data.timeout_seconds if data.timeout_seconds else None,
+        workers=SEARCH_PROCESSES,
+    )
+
+    if data.stream:
+        async def lines():
+            # The search runs as the response is sent, after the endpoint has
+            # given back its slot, so it takes one again for the duration.
+            async with SEARCH_CONTENT_LIMITER:
+                matches = iter(search)
+                try:
+                    while (match := await anyio.to_thread.run_sync(next, matches, None)) is not None:
+                        yield json.dumps({"type": "match", **match}) + "\n"
+                finally:
+                    with anyio.CancelScope(shield=True):
+                        await anyio.to_thread.run_sync(matches.close)
+            yield json.dumps({"type": "summary", "matches": search.found, "truncated": search.truncated}) + "\n"
 
-    iterator = base_path.rglob(data.file_pattern) if data.recursive else base_path.glob(data.file_pattern)
-
-    for item_path in iterator:
-        if item_path.is_file():
-            try:
-                # Read file line by line to handle potentially large files and different encodings
-                with item_path.open("r", encoding="utf-8", errors="ignore") as f:
-                    for line_num, line in enumerate(f, 1):
-                        if search_query_lower in line.lower():
-                            results.append(
-                                {
-                                    "file_path": str(item_path),
-                                    "line_number": line_num,
-                                    "line_content": line.strip(),
-                                }
-                            )
-            except Exception as e:
-                # Log or handle files that cannot be read (e.g., permission errors, binary files)
-                print(f"Could not read or search file {item_path}: {e}")
-                continue
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
 
-    return {"matches": results or ["No matches found"]}
+    results = list(search)
+    return {"matches": results or ["No matches found"], "truncated": search.truncated}
 
 
 @app.get("/list_allowed_directories", summary="List access-permitted directories")
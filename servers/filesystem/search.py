@@ -0,0 +1,295 @@
+"""
+Content search for the filesystem server.
+
+Files are read in binary chunks and matched a chunk at a time with one
+precompiled pattern, so the work per byte happens in C rather than in
+Python: literal text is found in the lowercased chunk, as str.lower() would
+fold it line by line, and regular expressions match case-insensitively.
+Files whose first bytes contain a NUL are taken to be binary and skipped.
+Batches of files are searched in a pool of worker processes, and matches
+are handed back batch by batch as soon as each one finishes.
+"""
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+import logging
+import multiprocessing
+import re
+import threading
+import time
+
+CHUNK_BYTES = 1 << 20
+SNIFF_BYTES = 8192
+BATCH_FILES = 64
+
+logger = logging.getLogger(__name__)
+
+
+class Query:
+    """
+    A compiled case-insensitive query, taken literally unless ``regex``.
+    ASCII literals match raw bytes; other literals, and all regexes, match
+    decoded text, so that case folding covers non-ASCII letters and ``.``
+    or ``\w`` match whole characters. Raises re.error for a bad regex.
+    Queries pickle, so they can be sent to worker processes.
+    """
+
+    def __init__(self, query: str, regex: bool = False):
+        # re.IGNORECASE is several times slower than lowercasing the text
+        # and finding a lowercase literal, so only regexes use it.
+        self.fold = not regex
+        if regex:
+            self.pattern = re.compile(query, re.IGNORECASE | re.MULTILINE)
+            return
+        source = re.escape(query.lower())
+        if source.isascii():
+            self.pattern = re.compile(source.encode("ascii"), re.MULTILINE)
+        else:
+            self.pattern = re.compile(source, re.MULTILINE)
+
+
+def matching_lines(source, query: Query, newline) -> Iterator[Tuple[int, object]]:
+    """(index, line) for each line of ``source`` that ``query`` matches."""
+    pattern = query.pattern
+    text = source.lower() if query.fold else source
+    if len(text) != len(source):
+        # A few letters lowercase to two characters, so offsets in the folded
+        # text would not line up with source; fold it line by line instead.
+        lines = source.split(newline)
+        if not lines[-1]:
+            lines.pop()
+        for index, line in enumerate(lines):
+            if pattern.search(line.lower()) is not None:
+                yield index, line
+        return
+    index = counted = pos = 0
+    while (match := pattern.search(text, pos)) is not None:
+        start = text.rfind(newline, 0, match.start()) + 1
+        if start == len(text):
+            # Past the last line break: there is no line here.
+            return
+        end = text.find(newline, match.start())
+        end = len(text) if end < 0 else end
+        index += text.count(newline, counted, start)
+        counted = start
+        yield index, source[start:end]
+        pos = end + 1
+
+
+def search_file(
+    path: str, query: Query, limit: Optional[int], deadline: Optional[float]
+) -> List[Dict]:
+    """Lines of ``path`` matching ``query``, each reported once."""
+    raw = isinstance(query.pattern.pattern, bytes)
+    newline = b"\n" if raw else "\n"
+    matches = []
+    line_number = 1
+    # Pieces of a line not yet ended, joined once its newline is read.
+    carry: List[bytes] = []
+    with open(path, "rb") as f:
+        data = f.read(CHUNK_BYTES)
+        if b"\0" in data[:SNIFF_BYTES]:
+            return matches
+        while True:
+            if data:
+                # Search whole lines only; a partial last line waits for the next read.
+                cut = data.rfind(b"\n") + 1
+                if cut == 0:
+                    carry.append(data)
+                    data = f.read(CHUNK_BYTES)
+                    continue
+                carry.append(data[:cut])
+                chunk, carry = b"".join(carry), [data[cut:]]
+            else:
+                chunk, carry = b"".join(carry), []
+            source = chunk if raw else chunk.decode("utf-8", errors="ignore")
+            for index, line in matching_lines(source, query, newline):
+                if raw:
+                    line = line.decode("utf-8", errors="ignore")
+                matches.append(
+                    {
+                        "file_path": path,
+                        "line_number": line_number + index,
+                        "line_content": line.strip(),
+                    }
+                )
+                if limit is not None and len(matches) >= limit:
+                    return matches
+            line_number += source.count(newline)
+            if not data or (deadline is not None and time.time() > deadline):
+                return matches
+            data = f.read(CHUNK_BYTES)
+
+
+def search_batch(
+    paths: List[str], query: Query, limit: Optional[int], deadline: Optional[float]
+) -> Tuple[List[Dict], List[str]]:
+    """
+    Matches in each of ``paths`` in turn, up to ``limit`` in all, and a
+    message for each file that could not be read. Workers return these
+    rather than logging them, so they are logged once, by the server.
+    """
+    matches = []
+    errors = []
+    for path in paths:
+        if deadline is not None and time.time() > deadline:
+            break
+        remaining = None if limit is None else limit - len(matches)
+        try:
+            matches += search_file(path, query, remaining, deadline)
+        except OSError as e:
+            errors.append(f"Could not read or search file {path}: {e}")
+            continue
+        if limit is not None and len(matches) >= limit:
+            break
+    return matches, errors
+
+
+_executor: Optional[ProcessPoolExecutor] = None
+_executor_lock = threading.Lock()
+
+
+def process_pool(workers: int) -> Optional[ProcessPoolExecutor]:
+    """The shared pool of search processes, or None to search in-thread."""
+    global _executor
+    if workers <= 1:
+        return None
+    with _executor_lock:
+        if _executor is None:
+            # Spawned rather than forked: the server process runs threads.
+            _executor = ProcessPoolExecutor(
+                workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return _executor
+
+
+def discard_pool(executor: ProcessPoolExecutor):
+    """Forget ``executor`` after a worker died, so the next search starts a fresh pool."""
+    global _executor
+    with _executor_lock:
+        if _executor is executor:
+            _executor = None
+
+
+class ContentSearch:
+    """
+    Iterating yields the matches in ``paths`` as batches of files finish, in
+    no particular order, searching in ``workers`` processes (or in the
+    calling thread for one). It stops after ``max_results`` matches or at the
+    ``deadline`` (a time.time() value); ``truncated`` then tells whether
+    anything was left unsearched.
+    """
+
+    def __init__(
+        self,
+        paths: Iterable[str],
+        query: Query,
+        max_results: Optional[int] = None,
+        deadline: Optional[float] = None,
+        workers: int = 1,
+    ):
+        self.paths = paths
+        self.query = query
+        self.max_results = max_results
+        self.deadline = deadline
+        self.workers = workers
+        self.found = 0
+        self.truncated = False
+
+    def _remaining(self) -> Optional[int]:
+        return None if self.max_results is None else self.max_results - self.found
+
+    def _limit(self) -> Optional[int]:
+        # One match more than wanted tells whether anything was left out.
+        remaining = self._remaining()
+        return None if remaining is None else remaining + 1
+
+    def _expired(self) -> bool:
+        return self.deadline is not None and time.time() > self.deadline
+
+    def _batches(self) -> Iterator[List[str]]:
+        batch = []
+        for path in self.paths:
+            batch.append(path)
+            if len(batch) == BATCH_FILES:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def _take(self, result: Tuple[List[Dict], List[str]]) -> List[Dict]:
+        matches, errors = result
+        for error in errors:
+            logger.warning(error)
+        remaining = self._remaining()
+        if remaining is not None and len(matches) > remaining:
+            matches = matches[:remaining]
+            self.truncated = True
+        self.found += len(matches)
+        return matches
+
+    def __iter__(self) -> Iterator[Dict]:
+        executor = process_pool(self.workers)
+        if executor is None:
+            yield from self._search_here()
+            return
+        try:
+            yield from self._search_pool(executor)
+        except BrokenProcessPool:
+            discard_pool(executor)
+            raise
+
+    def _search_here(self) -> Iterator[Dict]:
+        for batch in self._batches():
+            if self._expired():
+                self.truncated = True
+                return
+            yield from self._take(
+                search_batch(batch, self.query, self._limit(), self.deadline)
+            )
+            if self.truncated:
+                return
+        if self._expired():
+            self.truncated = True
+
+    def _search_pool(self, executor: ProcessPoolExecutor) -> Iterator[Dict]:
+        batches = self._batches()
+        # Enough batches in flight to keep every worker busy, but no more,
+        # so little is wasted once max_results is reached.
+        in_flight = 2 * self.workers
+        pending = set()
+        walked = False
+        try:
+            while True:
+                while not walked and len(pending) < in_flight and not self._expired():
+                    batch = next(batches, None)
+                    if batch is None:
+                        walked = True
+                        break
+                    pending.add(
+                        executor.submit(
+                            search_batch,
+                            batch,
+                            self.query,
+                            self._limit(),
+                            self.deadline,
+                        )
+                    )
+                if not pending:
+                    break
+                timeout = None
+                if self.deadline is not None:
+                    timeout = max(0.0, self.deadline - time.time())
+                done, pending = wait(pending, timeout, return_when=FIRST_COMPLETED)
+                if not done:
+                    break
+                for future in done:
+                    yield from self._take(future.result())
+                    if self.truncated:
+                        return
+            if pending or not walked or self._expired():
+                self.truncated = True
+        finally:
+            for future in pending:
+                future.cancel()
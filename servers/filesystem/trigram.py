@@ -0,0 +1,817 @@
+"""
+On-disk trigram index for search_content, in the style of codesearch.
+
+Each allowed directory gets one index file listing, for every trigram (three
+consecutive bytes, ASCII letters lowercased), the files that contain it. A
+query's trigrams narrow the files to search down to those that contain all
+of them; ContentSearch then verifies the candidates, so the index never
+changes what matches, only which files are read.
+
+A background thread refreshes each index by walking its directory and
+re-reading files whose mtime or size changed. New postings go to an
+in-memory delta on top of the memory-mapped file, and are merged into a new
+file once the delta grows large (or at shutdown). Between refreshes,
+queries trust the postings except for what changed since: files the server
+itself wrote, and, through inotify watches on every directory the refresh
+walked, files and directories created, modified, moved or deleted by
+others. Changed files are searched whatever their postings say, and
+changed directories are walked, so a query costs O(candidates + changes)
+rather than O(files). Where inotify is unavailable, runs out of watches or
+overflows its queue, queries instead stat every file in their scope until
+a refresh completes with every directory watched.
+
+Index file layout:
+
+  MAGIC | ids | keys | offsets | header JSON | u64 header offset | u64 header length | MAGIC
+
+  ids      u32[P]    file ids of each trigram, ascending, grouped by trigram
+  keys     u32[K]    trigrams, ascending, as little-endian 24-bit integers
+  offsets  u64[K+1]  range of ids for each trigram
+
+Sections are 8-byte aligned arrays in native byte order (recorded in the
+header). The header also lists the files, by id, as [relative path,
+mtime_ns, size, unindexed] or null for ids whose file was replaced or
+removed; unindexed files (too large to index, or not valid UTF-8, which
+decoded searches would read differently) are always candidates.
+"""
+
+from array import array
+from bisect import bisect_left
+from collections import deque
+from concurrent.futures import Executor
+from concurrent.futures.process import BrokenProcessPool
+from fnmatch import fnmatchcase
+from pathlib import Path, PurePath
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+import ctypes
+import errno
+import functools
+import hashlib
+import json
+import logging
+import mmap
+import os
+import stat
+import struct
+import sys
+import threading
+
+try:
+    from re import _parser as sre_parse
+except ImportError:  # Python < 3.11
+    import sre_parse
+
+from dircache import (
+    IN_CREATE,
+    IN_DELETE,
+    IN_DELETE_SELF,
+    IN_IGNORED,
+    IN_ISDIR,
+    IN_MODIFY,
+    IN_MOVE_SELF,
+    IN_MOVED_FROM,
+    IN_MOVED_TO,
+    IN_ONLYDIR,
+    IN_Q_OVERFLOW,
+    inotify_init,
+    read_events,
+)
+from search import BATCH_FILES, SNIFF_BYTES, Query, discard_pool, process_pool
+
+MAGIC = b"FSTRGM\x00\x01"
+VERSION = 1
+TRAILER = struct.Struct("<QQ8s")
+DEAD = 0xFFFFFFFF
+# The delta is merged into the file once it holds this many postings
+# (64 MiB of ids), which also bounds memory while the first build runs.
+DELTA_FLUSH_POSTINGS = 1 << 24
+# Batches of files being read for the index at once, kept low so that
+# searches sharing the process pool are not queued behind a whole refresh.
+READS_IN_FLIGHT = 2
+# ASCII letters that also match non-ASCII characters when folded as text
+# (Kelvin sign, long s, dotted and dotless i), so runs of them cannot be
+# looked up by their ASCII-lowercased bytes.
+UNFOLDABLE = frozenset(map(ord, "iksIKS"))
+# Changes to a watched directory's entries, or to the directory itself,
+# that can leave postings out of date.
+WATCH_MASK = (
+    IN_MODIFY
+    | IN_CREATE
+    | IN_DELETE
+    | IN_MOVED_FROM
+    | IN_MOVED_TO
+    | IN_DELETE_SELF
+    | IN_MOVE_SELF
+    | IN_ONLYDIR
+)
+
+logger = logging.getLogger(__name__)
+
+assert array("I").itemsize == 4 and array("Q").itemsize == 8
+
+
+def u32(values: Iterable[int] = ()) -> array:
+    return array("I", values)
+
+
+def u64(values: Iterable[int] = ()) -> array:
+    return array("Q", values)
+
+
+def trigram_key(gram: bytes) -> int:
+    return int.from_bytes(gram, "little")
+
+
+def trigrams(data: bytes) -> Set[int]:
+    """The distinct trigrams of ``data``, ASCII letters lowercased."""
+    data = data.lower()
+    size = len(data)
+    if size < 3:
+        return set()
+    # Reading the bytes as 32-bit words at each of the four alignments gives
+    # every 4-gram but the last in C; the low three bytes of each are the
+    # trigram starting at the same offset.
+    grams = set()
+    for start in range(4):
+        words = u32()
+        words.frombytes(data[start : start + (size - start) // 4 * 4])
+        if sys.byteorder == "big":
+            words.byteswap()
+        grams.update(words)
+    found = {word & 0xFFFFFF for word in grams}
+    found.add(trigram_key(data[-3:]))
+    return found
+
+
+# Zero-width items that do not break a run of literal text.
+_ZERO_WIDTH = {sre_parse.AT}
+_GROUPS = {sre_parse.SUBPATTERN, getattr(sre_parse, "ATOMIC_GROUP", None)}
+_REPEATS = {
+    sre_parse.MAX_REPEAT,
+    sre_parse.MIN_REPEAT,
+    getattr(sre_parse, "POSSESSIVE_REPEAT", None),
+}
+
+
+def _literal_runs(parsed, runs: List[bytes], text: bool) -> None:
+    """
+    Add the runs of literal bytes that every match of ``parsed`` contains.
+    For ``text`` patterns, characters that could match a different UTF-8
+    sequence once case is folded end a run.
+    """
+    run = bytearray()
+    for op, av in parsed:
+        if op is sre_parse.LITERAL and not (text and (av > 0x7F or av in UNFOLDABLE)):
+            run.append(av)
+            continue
+        if op in _ZERO_WIDTH:
+            continue
+        runs.append(bytes(run))
+        run = bytearray()
+        if op in _GROUPS:
+            _literal_runs(av[-1], runs, text)
+        elif op in _REPEATS and av[0] >= 1:
+            _literal_runs(av[2], runs, text)
+    runs.append(bytes(run))
+
+
+def query_trigrams(query: Query) -> Optional[Set[int]]:
+    """
+    Trigrams every line matching ``query`` contains, or None when the index
+    cannot narrow the search: the query has no three usable literal
+    characters in a row.
+    """
+    source = query.pattern.pattern
+    runs: List[bytes] = []
+    _literal_runs(
+        sre_parse.parse(source, query.pattern.flags), runs, not isinstance(source, bytes)
+    )
+    keys = set()
+    for run in runs:
+        run = run.lower()
+        keys.update(trigram_key(run[i : i + 3]) for i in range(len(run) - 2))
+    return keys or None
+
+
+def read_batch(
+    batch: List[Tuple[str, str, os.stat_result]], max_file_bytes: int
+) -> List[Tuple[str, os.stat_result, Optional[array]]]:
+    """
+    (relative path, stat, trigrams) for each file of ``batch`` that could be
+    read; trigrams are None for files larger than ``max_file_bytes`` or not
+    valid UTF-8.
+    """
+    results = []
+    for relative, path, st in batch:
+        found = None
+        if st.st_size <= max_file_bytes:
+            try:
+                with open(path, "rb") as f:
+                    data = f.read(max_file_bytes + 1)
+            except OSError:
+                continue
+            if b"\0" in data[:SNIFF_BYTES]:
+                # search_content skips binary files, so they never match.
+                found = u32()
+            elif len(data) <= max_file_bytes and _is_utf8(data):
+                found = u32(trigrams(data))
+        results.append((relative, st, found))
+    return results
+
+
+def _is_utf8(data: bytes) -> bool:
+    # Decoded searches drop invalid bytes, joining the text around them.
+    try:
+        data.decode("utf-8")
+    except UnicodeDecodeError:
+        return False
+    return True
+
+
+def _read_all(
+    read: Callable, batches: Iterable, executor: Optional[Executor]
+) -> Iterator[List[Tuple[str, os.stat_result, Optional[array]]]]:
+    """read(batch) for each batch, in ``executor`` if given, a few at a time."""
+    if executor is None:
+        yield from map(read, batches)
+        return
+    pending = deque()
+    try:
+        for batch in batches:
+            pending.append(executor.submit(read, batch))
+            if len(pending) >= READS_IN_FLIGHT:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        for future in pending:
+            future.cancel()
+
+
+def _intersect(ids: List[int], posting) -> List[int]:
+    """The ids, ascending, that are also in the ascending ``posting``."""
+    if len(ids) * 16 < len(posting):
+        kept = []
+        for file_id in ids:
+            at = bisect_left(posting, file_id)
+            if at < len(posting) and posting[at] == file_id:
+                kept.append(file_id)
+        return kept
+    return sorted(set(ids).intersection(posting))
+
+
+def _aligned(f) -> int:
+    pad = -f.tell() % 8
+    f.write(b"\0" * pad)
+    return f.tell()
+
+
+class TrigramIndex:
+    """
+    The trigram index of the files under ``root``, kept in ``path``. Only
+    the refresh thread calls refresh() and save(); candidates() may be
+    called from any thread.
+    """
+
+    def __init__(self, root: str, path: Path, max_file_bytes: int):
+        self.root = root
+        self.path = path
+        self.max_file_bytes = max_file_bytes
+        self._lock = threading.Lock()
+        self._inotify = inotify_init("search index queries stat every file in scope")
+        # Relative directory of each watch descriptor.
+        self._watched: Dict[int, str] = {}
+        # Whether every directory the last refresh walked is watched and no
+        # event was lost since, so queries can trust the postings.
+        self._trusted = False
+        # Whether an event was lost since the current refresh started.
+        self._lost = False
+        self._reset()
+        try:
+            self._load()
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.warning("Ignoring unreadable search index %s: %s", self.path, e)
+            self._reset()
+
+    def _reset(self):
+        # [relative path, mtime_ns, size, unindexed] per file id, or None.
+        self._files: List[Optional[list]] = []
+        self._by_path: Dict[str, int] = {}
+        self._unindexed: Set[int] = set()
+        self._dead = 0
+        # Postings in the mapped file, and those added since.
+        self._keys = self._offsets = self._ids = None
+        self._delta: Dict[int, array] = {}
+        self._delta_postings = 0
+        self._dirty = False
+        # Whether every file has been indexed at least once.
+        self._complete = False
+        # Files that changed since they were last indexed, and directories
+        # whose entries did, each with the mark it was changed at.
+        self._stale: Dict[str, int] = {}
+        self._stale_dirs: Dict[str, int] = {}
+        self._marks = 0
+
+    # -- file format --
+
+    def _load(self):
+        with self.path.open("rb") as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(buffer) < TRAILER.size + len(MAGIC) or buffer[: len(MAGIC)] != MAGIC:
+            raise ValueError("not a search index")
+        offset, length, magic = TRAILER.unpack_from(buffer, len(buffer) - TRAILER.size)
+        if magic != MAGIC:
+            raise ValueError("truncated search index")
+        header = json.loads(buffer[offset : offset + length])
+        if header["version"] != VERSION or header["byteorder"] != sys.byteorder:
+            raise ValueError("search index from another version or platform")
+        if header["root"] != self.root:
+            raise ValueError("search index for another directory")
+
+        view = memoryview(buffer)
+
+        def section(name: str, fmt: str):
+            start, count = header["sections"][name]
+            size = array(fmt).itemsize
+            return view[start : start + count * size].cast(fmt)
+
+        self._ids = section("ids", "I")
+        self._keys = section("keys", "I")
+        self._offsets = section("offsets", "Q")
+        self._files = header["files"]
+        for file_id, entry in enumerate(self._files):
+            if entry is None:
+                self._dead += 1
+                continue
+            self._by_path[entry[0]] = file_id
+            if entry[3]:
+                self._unindexed.add(file_id)
+        self._complete = header["complete"]
+
+    def _base_posting(self, key: int):
+        if self._keys is None:
+            return b""
+        at = bisect_left(self._keys, key)
+        if at == len(self._keys) or self._keys[at] != key:
+            return b""
+        return self._ids[self._offsets[at] : self._offsets[at + 1]].cast("B")
+
+    def _posting(self, key: int) -> array:
+        posting = u32()
+        posting.frombytes(self._base_posting(key))
+        delta = self._delta.get(key)
+        if delta is not None:
+            posting += delta
+        return posting
+
+    def save(self):
+        """Merge the delta into a new index file, dropping dead ids if most are."""
+        compact = self._dead * 2 > len(self._files)
+        remap = None
+        files = self._files
+        if compact:
+            remap = u32([DEAD]) * len(files)
+            files = []
+            for file_id, entry in enumerate(self._files):
+                if entry is not None:
+                    remap[file_id] = len(files)
+                    files.append(entry)
+        merged = set(self._delta)
+        if self._keys is not None:
+            merged.update(self._keys)
+
+        temp_path = self.path.with_name(self.path.name + ".tmp")
+        keys, offsets = u32(), u64([0])
+        with temp_path.open("wb") as f:
+            f.write(MAGIC)
+            ids_start = _aligned(f)
+            count = 0
+            for key in sorted(merged):
+                posting = self._posting(key)
+                if remap is not None:
+                    posting = u32(filter(DEAD.__ne__, map(remap.__getitem__, posting)))
+                if not posting:
+                    continue
+                posting.tofile(f)
+                count += len(posting)
+                keys.append(key)
+                offsets.append(count)
+            keys_start = _aligned(f)
+            keys.tofile(f)
+            offsets_start = _aligned(f)
+            offsets.tofile(f)
+            header = json.dumps(
+                {
+                    "version": VERSION,
+                    "byteorder": sys.byteorder,
+                    "root": self.root,
+                    "complete": self._complete,
+                    "sections": {
+                        "ids": [ids_start, count],
+                        "keys": [keys_start, len(keys)],
+                        "offsets": [offsets_start, len(offsets)],
+                    },
+                    "files": files,
+                }
+            ).encode()
+            header_start = f.tell()
+            f.write(header)
+            f.write(TRAILER.pack(header_start, len(header), MAGIC))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, self.path)
+
+        # The old mapping closes once nothing refers to it.
+        with self._lock:
+            self._reset()
+            self._load()
+
+    # -- updates --
+
+    def _drop(self, relative: str):
+        # Called with the lock held.
+        file_id = self._by_path.pop(relative, None)
+        if file_id is not None:
+            self._files[file_id] = None
+            self._unindexed.discard(file_id)
+            self._dead += 1
+
+    def _add(self, relative: str, st: os.stat_result, found: Optional[array], mark: int):
+        """Index ``relative`` as read after it was stat()ed at ``mark``."""
+        with self._lock:
+            self._drop(relative)
+            file_id = len(self._files)
+            self._files.append([relative, st.st_mtime_ns, st.st_size, found is None])
+            self._by_path[relative] = file_id
+            # Still stale if it changed again after the stat.
+            if self._stale.get(relative, mark) <= mark:
+                self._stale.pop(relative, None)
+            if found is None:
+                self._unindexed.add(file_id)
+            else:
+                for key in found:
+                    posting = self._delta.get(key)
+                    if posting is None:
+                        self._delta[key] = u32([file_id])
+                    else:
+                        posting.append(file_id)
+                self._delta_postings += len(found)
+            self._dirty = True
+
+    def _files_under(
+        self, top: str, recursive: bool = True, watch: Optional[Callable[[str], None]] = None
+    ) -> Iterator[Tuple[str, os.stat_result]]:
+        """
+        (path, stat) for each regular file under ``top``, skipping the index.
+        ``watch`` is called on each directory before it is listed.
+        """
+        skip = str(self.path.parent)
+        if watch is not None:
+            watch(top)
+        for directory, dirnames, filenames in os.walk(top):
+            if not recursive:
+                dirnames.clear()
+            elif skip.startswith(directory):
+                dirnames[:] = [name for name in dirnames if os.path.join(directory, name) != skip]
+            if watch is not None:
+                for name in dirnames:
+                    watch(os.path.join(directory, name))
+            for name in filenames:
+                path = os.path.join(directory, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if stat.S_ISREG(st.st_mode):
+                    yield path, st
+
+    def _is_current(self, relative: str, st: os.stat_result) -> bool:
+        """Whether the postings of ``relative`` reflect the file ``st`` describes."""
+        file_id = self._by_path.get(relative)
+        if file_id is None or relative in self._stale:
+            return False
+        entry = self._files[file_id]
+        return entry is not None and entry[1] == st.st_mtime_ns and entry[2] == st.st_size
+
+    def mark_changed(self, relative: str):
+        """Have queries search ``relative`` until it is indexed again."""
+        with self._lock:
+            self._mark(self._stale, relative)
+
+    # -- change tracking --
+
+    def _mark(self, stale: Dict[str, int], relative: str):
+        # Called with the lock held.
+        self._marks += 1
+        stale[relative] = self._marks
+
+    def _watch(self, directory: str, failed: List[bool]):
+        """Watch ``directory`` (a path under the root); sets ``failed`` if it cannot be."""
+        if self._inotify is None:
+            failed[0] = True
+            return
+        libc, fd = self._inotify
+        wd = libc.inotify_add_watch(fd, os.fsencode(directory), WATCH_MASK)
+        if wd < 0:
+            if not failed[0] and ctypes.get_errno() == errno.ENOSPC:
+                logger.warning(
+                    "inotify watch limit reached; search index queries for %s stat every"
+                    " file in scope",
+                    self.root,
+                )
+            failed[0] = True
+            return
+        with self._lock:
+            self._watched[wd] = os.path.relpath(directory, self.root)
+
+    def _drain(self):
+        """Mark what the queued inotify events show changed. Called with the lock held."""
+        if self._inotify is None:
+            return
+        for wd, mask, name in read_events(self._inotify[1]):
+            if mask & IN_Q_OVERFLOW:
+                self._trusted = False
+                self._lost = True
+                continue
+            directory = self._watched.get(wd)
+            if directory is None:
+                continue
+            if mask & IN_IGNORED:
+                del self._watched[wd]
+            elif not name:
+                if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                    if directory == os.curdir:
+                        self._trusted = False
+                        self._lost = True
+                    self._mark(self._stale_dirs, directory)
+            else:
+                relative = os.path.normpath(os.path.join(directory, name))
+                self._mark(self._stale_dirs if mask & IN_ISDIR else self._stale, relative)
+
+    def _changed(self, seen: Set[str], marks: Dict[str, int], stop: threading.Event, watch):
+        """Batches of (relative path, path, stat) for new and changed files."""
+        batch = []
+        for path, st in self._files_under(self.root, watch=watch):
+            if stop.is_set():
+                return
+            relative = os.path.relpath(path, self.root)
+            seen.add(relative)
+            # Changes not drained yet get later marks, so they stay stale.
+            with self._lock:
+                if self._is_current(relative, st):
+                    continue
+                marks[relative] = self._marks
+            batch.append((relative, path, st))
+            if len(batch) == BATCH_FILES:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def refresh(self, stop: threading.Event, executor: Optional[Executor] = None):
+        """
+        Index new and changed files, reading them in ``executor`` if given,
+        and forget removed ones.
+        """
+        seen: Set[str] = set()
+        # Mark at which each file read was stat()ed.
+        marks: Dict[str, int] = {}
+        failed = [False]
+        with self._lock:
+            self._drain()
+            start = self._marks
+            self._lost = False
+        read = functools.partial(read_batch, max_file_bytes=self.max_file_bytes)
+        watch = functools.partial(self._watch, failed=failed)
+        changed = self._changed(seen, marks, stop, watch)
+        for results in _read_all(read, changed, executor):
+            if stop.is_set():
+                return
+            for relative, st, found in results:
+                self._add(relative, st, found, marks.pop(relative))
+            if self._delta_postings >= DELTA_FLUSH_POSTINGS:
+                self.save()
+        if stop.is_set():
+            return
+
+        with self._lock:
+            self._drain()
+            for relative in set(self._by_path) - seen:
+                self._drop(relative)
+                self._dirty = True
+            # The walk saw everything changed before it started.
+            for stale in (self._stale, self._stale_dirs):
+                for relative in [r for r, mark in stale.items() if mark <= start]:
+                    if relative not in self._by_path:
+                        del stale[relative]
+            self._trusted = not (self._lost or failed[0])
+            first = not self._complete
+            self._complete = True
+        if first or self._dead * 2 > len(self._files):
+            self.save()
+
+    # -- queries --
+
+    def candidates(
+        self, base: Path, keys: Set[int], pattern: str, recursive: bool
+    ) -> Optional[List[str]]:
+        """
+        Files under ``base`` matching the glob ``pattern`` (searched
+        recursively, like rglob, if ``recursive``) that contain every
+        trigram in ``keys`` or changed since they were indexed, or None if
+        the index cannot tell yet.
+        """
+        if os.path.relpath(base, self.root).startswith(os.pardir):
+            return None
+        if "**" in pattern or os.path.isabs(pattern) or not self._complete:
+            return None
+        scope = _Scope(str(base), pattern, recursive)
+
+        with self._lock:
+            self._drain()
+            trusted = self._trusted
+            if trusted:
+                ids = None
+                for posting in sorted(map(self._posting, keys), key=len):
+                    ids = sorted(set(posting)) if ids is None else _intersect(ids, posting)
+                    if not ids:
+                        break
+                hits = [self._files[i] for i in set(ids).union(self._unindexed)]
+                stale = set(self._stale)
+                stale_dirs = set(self._stale_dirs)
+        if not trusted:
+            return self._swept(scope, keys)
+
+        def changed(relative: str) -> bool:
+            if relative in stale:
+                return True
+            parent = os.path.dirname(relative)
+            while parent and stale_dirs:
+                if parent in stale_dirs:
+                    return True
+                parent = os.path.dirname(parent)
+            return False
+
+        paths = set()
+        for entry in hits:
+            if entry is None or changed(entry[0]):
+                continue
+            path = os.path.join(self.root, entry[0])
+            if scope.contains(path):
+                paths.add(path)
+        # Changed files are searched if they still exist; changed
+        # directories are walked for whatever they now hold.
+        for relative in stale:
+            path = os.path.join(self.root, relative)
+            if scope.contains(path) and os.path.isfile(path):
+                paths.add(path)
+        for relative in stale_dirs:
+            top = scope.walk_from(os.path.join(self.root, relative))
+            if top is not None:
+                paths.update(
+                    path
+                    for path, _ in self._files_under(top, scope.deep)
+                    if scope.contains(path)
+                )
+        return sorted(paths)
+
+    def _swept(self, scope: "_Scope", keys: Set[int]) -> List[str]:
+        """candidates() for untrusted postings: stat every file in scope."""
+        files = [
+            (path, st)
+            for path, st in self._files_under(scope.base, scope.deep)
+            if scope.contains(path)
+        ]
+        with self._lock:
+            ids = None
+            for posting in sorted(map(self._posting, keys), key=len):
+                ids = sorted(set(posting)) if ids is None else _intersect(ids, posting)
+                if not ids:
+                    break
+            ids = set(ids).union(self._unindexed)
+            paths = []
+            for path, st in files:
+                relative = os.path.relpath(path, self.root)
+                if not self._is_current(relative, st) or self._by_path[relative] in ids:
+                    paths.append(path)
+        return paths
+
+    def close(self):
+        if self._dirty:
+            self.save()
+        if self._inotify is not None:
+            os.close(self._inotify[1])
+            self._inotify = None
+
+
+class _Scope:
+    """The files a search of ``base`` for the glob ``pattern`` covers."""
+
+    def __init__(self, base: str, pattern: str, recursive: bool):
+        self.base = base
+        self.pattern = pattern
+        self.recursive = recursive
+        self.depth = len(PurePath(pattern).parts)
+        # Whether files below the base directory itself can match.
+        self.deep = recursive or self.depth > 1
+        self._prefix = os.path.join(base, "")
+
+    def contains(self, path: str) -> bool:
+        if not path.startswith(self._prefix):
+            return False
+        rest = path[len(self._prefix) :]
+        if self.depth == 1:
+            if not self.recursive and os.sep in rest:
+                return False
+            return fnmatchcase(os.path.basename(rest), self.pattern)
+        rest = PurePath(rest)
+        if not self.recursive and len(rest.parts) != self.depth:
+            return False
+        return rest.match(self.pattern)
+
+    def walk_from(self, directory: str) -> Optional[str]:
+        """Where to walk for the files in scope under ``directory``, if any may be."""
+        if directory == self.base or self._prefix.startswith(os.path.join(directory, "")):
+            return self.base
+        if self.deep and directory.startswith(self._prefix):
+            return directory
+        return None
+
+
+class Indexer:
+    """
+    Trigram indexes for each of ``roots``, kept in ``directory`` and
+    refreshed by a background thread every ``interval`` seconds, reading
+    files in ``workers`` search processes.
+    """
+
+    def __init__(
+        self,
+        roots: List[str],
+        directory: str,
+        interval: float,
+        max_file_bytes: int,
+        workers: int = 1,
+    ):
+        self.directory = Path(os.path.expanduser(directory)).resolve()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.interval = interval
+        self.workers = workers
+        self.indexes = [
+            TrigramIndex(
+                root,
+                self.directory / f"{hashlib.sha1(root.encode()).hexdigest()[:16]}.trigrams",
+                max_file_bytes,
+            )
+            for root in roots
+        ]
+        self._stop = threading.Event()
+        self._worker: Optional[threading.Thread] = None
+
+    def start(self):
+        self._stop.clear()
+        self._worker = threading.Thread(target=self._background, name="search-index", daemon=True)
+        self._worker.start()
+
+    def _background(self):
+        while not self._stop.is_set():
+            for index in self.indexes:
+                executor = process_pool(self.workers)
+                try:
+                    index.refresh(self._stop, executor)
+                except BrokenProcessPool:
+                    discard_pool(executor)
+                    logger.exception("Could not refresh search index for %s", index.root)
+                except Exception:
+                    logger.exception("Could not refresh search index for %s", index.root)
+            self._stop.wait(self.interval)
+
+    def candidates(
+        self, base: Path, query: Query, pattern: str, recursive: bool
+    ) -> Optional[List[str]]:
+        """Files under ``base`` that may match ``query``, or None to search them all."""
+        keys = query_trigrams(query)
+        if keys is None:
+            return None
+        for index in self.indexes:
+            paths = index.candidates(base, keys, pattern, recursive)
+            if paths is not None:
+                return paths
+        return None
+
+    def mark_changed(self, path: Path):
+        """Have queries search ``path``, which the server just wrote, until it is reindexed."""
+        for index in self.indexes:
+            relative = os.path.relpath(path, index.root)
+            if not relative.startswith(os.pardir):
+                index.mark_changed(relative)
+
+    def close(self):
+        self._stop.set()
+        if self._worker is not None:
+            self._worker.join()
+            self._worker = None
+        for index in self.indexes:
+            index.close()
@@ -0,0 +1,78 @@
+"""
+Compare opening a store from memory.json with opening it from its snapshot.
+
+Usage (from servers/memory):
+
+    python benchmarks/cold_start.py [--entities 100000] [--observations 5] [--relations 3]
+
+A memory.json is generated as in footprint.py. The store is opened once from
+it (parsing every line), closed so that it leaves memory.json.snap behind,
+and opened again from the snapshot. Each time the first open_nodes request
+is timed from construction to response, together with the Python heap it
+left behind; the first page is timed afterwards, since paging builds its
+sorted index on first use.
+"""
+
+from pathlib import Path
+import argparse
+import gc
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from footprint import write_file  # noqa: E402
+from store import JsonlStore  # noqa: E402
+
+
+def measure(path: Path, label: str, args):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    store = JsonlStore(path)
+    found = store.open_nodes(["entity-1", f"entity-{args.entities - 1}"])
+    first = time.perf_counter() - start
+    heap = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    assert len(found.entities) == 2
+
+    start = time.perf_counter()
+    store.read_page(None, 100)
+    page = time.perf_counter() - start
+    print(
+        f"  {label:<9} first request {first:>7.3f}s  heap {heap / 2**20:>7.1f} MiB"
+        f"  first page {page:>6.2f}s"
+    )
+    return store
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--entities", type=int, default=100_000)
+    parser.add_argument("--observations", type=int, default=5)
+    parser.add_argument("--relations", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "memory.json"
+        file_size = write_file(path, args)
+        print(
+            f"{args.entities:,} entities, {args.relations * args.entities:,}"
+            f" relations, memory.json {file_size / 2**20:.1f} MiB"
+        )
+        store = measure(path, "jsonl", args)
+        start = time.perf_counter()
+        store.close()
+        snapshot_size = store.snapshot_path.stat().st_size
+        print(
+            f"  snapshot written in {time.perf_counter() - start:.2f}s"
+            f" ({snapshot_size / 2**20:.1f} MiB)"
+        )
+        del store
+        measure(path, "snapshot", args).close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Measure how much memory the resident graph costs per entity.
+
+Usage (from servers/memory):
+
+    python benchmarks/footprint.py [--entities 100000] [--observations 5] [--relations 3]
+
+A memory.json with the given number of entities, observations per entity
+and relations per entity is written to a temporary directory and loaded the
+way JsonlStore loads it. The Python heap growth (tracemalloc) is reported
+per entity next to the size of the file itself.
+"""
+
+from pathlib import Path
+import argparse
+import gc
+import json
+import random
+import sys
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from store import read_graph_file  # noqa: E402
+
+
+def write_file(path: Path, args) -> int:
+    rng = random.Random(0)
+    names = [f"entity-{i}" for i in range(args.entities)]
+    with open(path, "w", encoding="utf-8") as f:
+        for i, name in enumerate(names):
+            item = {
+                "type": "entity",
+                "name": name,
+                "entityType": f"type-{i % 10}",
+                "observations": [
+                    f"observation {j} about {name}" for j in range(args.observations)
+                ],
+            }
+            f.write(json.dumps(item) + "\n")
+        for i in range(args.entities * args.relations):
+            item = {
+                "type": "relation",
+                "from": rng.choice(names),
+                "to": rng.choice(names),
+                "relationType": f"rel-{i % 7}",
+            }
+            f.write(json.dumps(item) + "\n")
+    return path.stat().st_size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--entities", type=int, default=100_000)
+    parser.add_argument("--observations", type=int, default=5)
+    parser.add_argument("--relations", type=int, default=3)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = Path(tmp) / "memory.json"
+        file_size = write_file(path, args)
+
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        graph = read_graph_file(path)
+        gc.collect()
+        heap = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+
+    print(
+        f"{graph.entity_count():,} entities, {args.observations} observations"
+        f" and {args.relations} relations each"
+    )
+    print(f"  file      {file_size / args.entities:>8.0f} bytes/entity")
+    print(f"  resident  {heap / args.entities:>8.0f} bytes/entity")
+    print(f"  ratio     {heap / file_size:>8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
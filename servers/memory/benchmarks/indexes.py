@@ -0,0 +1,129 @@
+"""
+Compare the indexed Graph against the linear scans it replaced.
+
+Usage (from servers/memory):
+
+    python benchmarks/indexes.py [--sizes 10000 100000 1000000]
+
+For each relation count a random graph is built with one entity per five
+relations. Three operations are timed, each as the old scan and through the
+indexes: resolving an entity by name (add_observations), collecting the
+relations among a handful of entities (open_nodes/search_nodes), and
+dropping an entity together with its relations (delete_entities).
+"""
+
+from pathlib import Path
+import argparse
+import random
+import sys
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from graph import Graph, relation_key  # noqa: E402
+from models import Entity, Relation  # noqa: E402
+
+
+def build(num_relations: int, seed: int = 0):
+    rng = random.Random(seed)
+    num_entities = max(num_relations // 5, 2)
+    names = [f"entity-{i}" for i in range(num_entities)]
+    entities = [Entity(name=n, entityType="thing", observations=[]) for n in names]
+    relations = [
+        Relation(
+            **{
+                "from": rng.choice(names),
+                "to": rng.choice(names),
+                "relationType": f"rel-{i % 7}",
+            }
+        )
+        for i in range(num_relations)
+    ]
+    graph = Graph()
+    for e in entities:
+        graph.add_entity(e.name, e.entityType, e.observations)
+    for r in relations:
+        graph.add_relation(*relation_key(r))
+    return names, entities, relations, graph
+
+
+def timed(fn, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def run(num_relations: int, repeat: int):
+    names, entities, relations, graph = build(num_relations)
+    rng = random.Random(1)
+    probe = rng.sample(names, 10)
+    victim = probe[0]
+
+    rows = []
+
+    rows.append(
+        (
+            "lookup entity",
+            timed(
+                lambda: [
+                    next((e for e in entities if e.name == n), None) for n in probe
+                ],
+                repeat,
+            ),
+            timed(lambda: [graph.get_entity(n) for n in probe], repeat),
+        )
+    )
+
+    def scan_among():
+        wanted = {e.name for e in entities if e.name in probe}
+        return [r for r in relations if r.from_ in wanted and r.to in wanted]
+
+    rows.append(
+        (
+            "relations among 10 nodes",
+            timed(scan_among, repeat),
+            timed(lambda: graph.relations_among(probe), repeat),
+        )
+    )
+
+    def scan_delete():
+        kept_entities = [e for e in entities if e.name not in [victim]]
+        kept_relations = [
+            r for r in relations if r.from_ not in [victim] and r.to not in [victim]
+        ]
+        return kept_entities, kept_relations
+
+    def index_delete():
+        # Restore afterwards so every repetition deletes the same entity.
+        touched = graph.neighbors([victim], "both")
+        entity = graph.get_entity(victim)
+        graph.remove_entity(victim)
+        graph.add_entity(entity.name, entity.entityType, entity.observations)
+        for key in touched:
+            graph.add_relation(*key)
+
+    rows.append(
+        ("delete entity", timed(scan_delete, repeat), timed(index_delete, repeat))
+    )
+
+    print(f"\n{num_relations:,} relations / {len(entities):,} entities")
+    print(f"  {'operation':<26}{'scan ms':>12}{'index ms':>12}{'speedup':>10}")
+    for label, scan_ms, index_ms in rows:
+        speedup = scan_ms / index_ms if index_ms else float("inf")
+        print(f"  {label:<26}{scan_ms:>12.3f}{index_ms:>12.4f}{speedup:>9.0f}x")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000]
+    )
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    for size in args.sizes:
+        run(size, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,529 @@
+"""
+Benchmark every memory server endpoint and report the results as JSON.
+
+Usage (from servers/memory):
+
+    python benchmarks/load.py [--storage jsonl|sqlite] [--entities 10000]
+        [--observations 5] [--relations 3] [--skew 1.0] [--requests 200]
+        [--concurrency 8] [--namespaces 4] [--subscribers 8]
+        [--mode asgi http] [--output results.json]
+
+A synthetic memory.json is generated first. Entity names are ranked by
+popularity and drawn from a Zipf distribution with exponent ``--skew`` (0
+is uniform), both for the endpoints of generated relations and for the
+entities requests touch, so a few hot entities carry most of the degree
+and most of the traffic.
+
+Each mode starts a server on its own copy of that file and drives every
+endpoint in turn with ``--concurrency`` requests in flight: reads first,
+then writes, with each delete undoing what the matching create made. The
+``namespaced_*`` endpoints then go through /namespaces/{namespace}, spread
+over ``--namespaces`` copies of the graph, so they include opening each
+namespace's store on its first request. Last, ``changes_stream`` follows
+/changes/stream with ``--subscribers`` clients while entities are created,
+and reports how long each change took to reach them.
+
+- ``asgi`` runs the app in this process through httpx's ASGI transport. It
+  measures the server's own work without sockets, but its peak RSS also
+  counts this script. The transport only returns a response once it is
+  complete, so ``changes_stream`` is skipped.
+- ``http`` runs uvicorn in a subprocess and sends real HTTP requests.
+
+Endpoints that read or write the whole graph get ``--heavy-requests``
+requests instead. The report gives each endpoint's throughput, p50 and p99
+latency and error count, plus the time to the first answer (which loads
+the graph) and the server's peak RSS.
+"""
+
+from pathlib import Path
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+SERVER_DIR = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(SERVER_DIR))
+
+
+# ----- Synthetic Graph -----
+class Workload:
+    """The generated graph, and what the requests made so far left behind."""
+
+    def __init__(self, args):
+        self.rng = random.Random(args.seed)
+        self.names = [f"entity-{i}" for i in range(args.entities)]
+        weights = [1 / (rank + 1) ** args.skew for rank in range(args.entities)]
+        self.cum_weights = list(itertools.accumulate(weights))
+        self.observations = args.observations
+        self.relations = args.relations
+        self.namespaces = [f"bench-{k}" for k in range(args.namespaces)]
+        # Filled by the write endpoints for the deletes that follow them.
+        self.added_observations = []
+        self.added_relations = []
+        self.version = 0
+
+    def pick(self, k: int = 1):
+        return self.rng.choices(self.names, cum_weights=self.cum_weights, k=k)
+
+    def write_file(self, path: Path) -> int:
+        with open(path, "w", encoding="utf-8") as f:
+            for i, name in enumerate(self.names):
+                item = {
+                    "type": "entity",
+                    "name": name,
+                    "entityType": f"type-{i % 10}",
+                    "observations": [
+                        f"observation {j} about {name}"
+                        for j in range(self.observations)
+                    ],
+                }
+                f.write(json.dumps(item) + "\n")
+            for i in range(len(self.names) * self.relations):
+                source, target = self.pick(2)
+                item = {
+                    "type": "relation",
+                    "from": source,
+                    "to": target,
+                    "relationType": f"rel-{i % 7}",
+                }
+                f.write(json.dumps(item) + "\n")
+        return path.stat().st_size
+
+
+# ----- Requests -----
+# Each endpoint builds its i-th request as (method, url, httpx keyword
+# arguments). Writes use their index so every run makes the same changes.
+
+
+def open_nodes(w: Workload, i: int):
+    return "POST", "/open_nodes", {"json": {"names": w.pick(5)}}
+
+
+def search_nodes(w: Workload, i: int):
+    query = w.pick()[0] if i % 2 else f"type-{i % 10}"
+    return "POST", "/search_nodes", {"json": {"query": query, "limit": 20}}
+
+
+def traverse(w: Workload, i: int):
+    body = {"names": w.pick(), "maxDepth": 2, "maxNodes": 200}
+    return "POST", "/traverse", {"json": body}
+
+
+def read_graph_page(w: Workload, i: int):
+    return "GET", "/read_graph", {"params": {"limit": 100}}
+
+
+def read_graph(w: Workload, i: int):
+    return "GET", "/read_graph", {}
+
+
+def read_graph_stream(w: Workload, i: int):
+    return "GET", "/read_graph", {"params": {"stream": "true"}}
+
+
+def bulk_export(w: Workload, i: int):
+    return "GET", "/bulk_export", {}
+
+
+def semantic_search(w: Workload, i: int):
+    body = {"query": f"observation {i % 5} about {w.pick()[0]}", "limit": 10}
+    return "POST", "/semantic_search", {"json": body}
+
+
+def create_entities(w: Workload, i: int):
+    entity = {
+        "name": f"bench-{i}",
+        "entityType": "bench",
+        "observations": [f"created by request {i}"],
+    }
+    return "POST", "/create_entities", {"json": {"entities": [entity]}}
+
+
+def add_observations(w: Workload, i: int):
+    item = {"entityName": w.pick()[0], "contents": [f"bench observation {i}"]}
+    w.added_observations.append(item)
+    return "POST", "/add_observations", {"json": {"observations": [item]}}
+
+
+def create_relations(w: Workload, i: int):
+    source, target = w.pick(2)
+    relation = {"from": source, "to": target, "relationType": f"bench-{i}"}
+    w.added_relations.append(relation)
+    return "POST", "/create_relations", {"json": {"relations": [relation]}}
+
+
+def changes(w: Workload, i: int):
+    return "GET", "/changes", {"params": {"since": w.version}}
+
+
+def delete_observations(w: Workload, i: int):
+    item = w.added_observations[i % len(w.added_observations)]
+    deletion = {"entityName": item["entityName"], "observations": item["contents"]}
+    return "POST", "/delete_observations", {"json": {"deletions": [deletion]}}
+
+
+def delete_relations(w: Workload, i: int):
+    relation = w.added_relations[i % len(w.added_relations)]
+    return "POST", "/delete_relations", {"json": {"relations": [relation]}}
+
+
+def delete_entities(w: Workload, i: int):
+    return "POST", "/delete_entities", {"json": {"entityNames": [f"bench-{i}"]}}
+
+
+def bulk_import(w: Workload, i: int):
+    lines = "".join(
+        json.dumps(
+            {
+                "type": "entity",
+                "name": f"import-{i}-{j}",
+                "entityType": "bench",
+                "observations": [f"imported {j}"],
+            }
+        )
+        + "\n"
+        for j in range(100)
+    )
+    headers = {"Content-Type": "application/x-ndjson"}
+    return "POST", "/bulk_import", {"content": lines, "headers": headers}
+
+
+def namespaced(build):
+    """``build``'s requests, sent to the namespaces in turn."""
+
+    def build_namespaced(w: Workload, i: int):
+        method, url, kwargs = build(w, i)
+        return method, f"/namespaces/{w.namespaces[i % len(w.namespaces)]}{url}", kwargs
+
+    return build_namespaced
+
+
+# (name, request builder, whether it touches the whole graph), in run order.
+ENDPOINTS = [
+    ("open_nodes", open_nodes, False),
+    ("search_nodes", search_nodes, False),
+    ("traverse", traverse, False),
+    ("read_graph_page", read_graph_page, False),
+    ("read_graph", read_graph, True),
+    ("read_graph_stream", read_graph_stream, True),
+    ("bulk_export", bulk_export, True),
+    ("semantic_search", semantic_search, False),
+    ("create_entities", create_entities, False),
+    ("add_observations", add_observations, False),
+    ("create_relations", create_relations, False),
+    ("changes", changes, False),
+    ("delete_observations", delete_observations, False),
+    ("delete_relations", delete_relations, False),
+    ("delete_entities", delete_entities, False),
+    ("bulk_import", bulk_import, True),
+    ("namespaced_open_nodes", namespaced(open_nodes), False),
+    ("namespaced_search_nodes", namespaced(search_nodes), False),
+    ("namespaced_create_entities", namespaced(create_entities), False),
+    ("namespaced_delete_entities", namespaced(delete_entities), False),
+]
+
+
+# ----- Driver -----
+def percentile(ordered, fraction: float) -> float:
+    return ordered[round(fraction * (len(ordered) - 1))]
+
+
+async def drive(client, workload: Workload, build, count: int, concurrency: int):
+    latencies = []
+    statuses = {}
+    counter = itertools.count()
+
+    async def worker():
+        # Requests are built here, on the event loop, so no locking is needed.
+        while (i := next(counter)) < count:
+            method, url, kwargs = build(workload, i)
+            start = time.perf_counter()
+            response = await client.request(method, url, **kwargs)
+            latencies.append(time.perf_counter() - start)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    seconds = time.perf_counter() - start
+    latencies.sort()
+    return {
+        "requests": count,
+        "errors": sum(n for status, n in statuses.items() if status >= 400),
+        "statuses": {str(status): n for status, n in sorted(statuses.items())},
+        "seconds": round(seconds, 3),
+        "throughput": round(count / seconds, 1),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+    }
+
+
+def parse_events(lines):
+    """Yield the data of each ``change`` event in the server-sent ``lines``."""
+    event, data = None, []
+    for line in lines:
+        if line.startswith("event:"):
+            event = line[6:].strip()
+        elif line.startswith("data:"):
+            data.append(line[5:].strip())
+        elif not line:
+            if event == "change" and data:
+                yield json.loads("\n".join(data))
+            event, data = None, []
+
+
+async def stream_changes(client, workload: Workload, args):
+    """
+    Open ``--subscribers`` change streams, create ``--requests`` entities,
+    and time each change from its request being sent to each subscriber
+    receiving it. The entities are deleted again afterwards.
+    """
+    response = await client.get("/read_graph", params={"limit": 1})
+    since = int(response.headers["ETag"].strip('"'))
+    count = args.requests
+    sent = {}
+    delays = []
+    received = [0] * args.subscribers
+    connected = asyncio.Semaphore(0)
+
+    async def subscriber(k: int):
+        async with client.stream(
+            "GET", "/changes/stream", params={"since": since}
+        ) as response:
+            connected.release()
+            buffered = []
+            async for line in response.aiter_lines():
+                buffered.append(line)
+                if line:
+                    continue
+                for change in parse_events(buffered):
+                    for entity in change.get("entities", ()):
+                        name = entity["name"]
+                        if name in sent:
+                            delays.append(time.perf_counter() - sent[name])
+                            received[k] += 1
+                buffered = []
+                if received[k] >= count:
+                    return
+
+    def build(w: Workload, i: int):
+        name = f"stream-{i}"
+        sent[name] = time.perf_counter()
+        entity = {"name": name, "entityType": "bench", "observations": []}
+        return "POST", "/create_entities", {"json": {"entities": [entity]}}
+
+    subscribers = [asyncio.create_task(subscriber(k)) for k in range(args.subscribers)]
+    for _ in subscribers:
+        await connected.acquire()
+    writes = await drive(client, workload, build, count, args.concurrency)
+    try:
+        # A change that never arrives must not hang the run.
+        await asyncio.wait_for(asyncio.gather(*subscribers), timeout=30)
+    except asyncio.TimeoutError:
+        pass
+    for task in subscribers:
+        task.cancel()
+    await client.post("/delete_entities", json={"entityNames": list(sent)})
+
+    delays.sort()
+    result = {
+        "subscribers": args.subscribers,
+        "requests": count,
+        "errors": writes["errors"],
+        "write_throughput": writes["throughput"],
+        "delivered": len(delays),
+        "missed": count * args.subscribers - len(delays),
+    }
+    if delays:
+        result["p50_ms"] = round(percentile(delays, 0.50) * 1000, 3)
+        result["p99_ms"] = round(percentile(delays, 0.99) * 1000, 3)
+    return result
+
+
+async def run_endpoints(client, workload: Workload, args, streams: bool):
+    start = time.perf_counter()
+    response = await client.get("/read_graph", params={"limit": 1})
+    response.raise_for_status()
+    report = {"first_request_ms": round((time.perf_counter() - start) * 1000, 3)}
+    workload.version = int(response.headers["ETag"].strip('"'))
+    workload.added_observations.clear()
+    workload.added_relations.clear()
+
+    endpoints = {}
+    for name, build, heavy in ENDPOINTS:
+        if args.endpoints and name not in args.endpoints:
+            continue
+        count = args.heavy_requests if heavy else args.requests
+        result = await drive(client, workload, build, count, args.concurrency)
+        if result["statuses"].keys() == {"501"}:
+            result = {"skipped": "not enabled on this server"}
+        endpoints[name] = result
+        print(f"  {name:<20} {json.dumps(result)}", file=sys.stderr)
+    if not args.endpoints or "changes_stream" in args.endpoints:
+        if streams:
+            result = await stream_changes(client, workload, args)
+        else:
+            result = {"skipped": "responses are not streamed in this mode"}
+        endpoints["changes_stream"] = result
+        print(f"  {'changes_stream':<20} {json.dumps(result)}", file=sys.stderr)
+    report["endpoints"] = endpoints
+    return report
+
+
+def server_env(data_dir: Path, args):
+    env = dict(os.environ)
+    env["MEMORY_FILE_PATH"] = str(data_dir / "memory.json")
+    env["MEMORY_NAMESPACE_DIR"] = str(data_dir / "namespaces")
+    env["MEMORY_STORAGE"] = args.storage
+    if args.semantic:
+        env["MEMORY_SEMANTIC_MODEL"] = args.semantic
+    return env
+
+
+def run_asgi(data_dir: Path, workload: Workload, args):
+    os.environ.update(server_env(data_dir, args))
+    import main as server
+
+    async def run():
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://bench", timeout=None
+        ) as client:
+            return await run_endpoints(client, workload, args, streams=False)
+
+    try:
+        report = asyncio.run(run())
+    finally:
+        server.stores.close()
+    # ru_maxrss is in KiB on Linux.
+    report["peak_rss_mb"] = round(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1
+    )
+    report["peak_rss_includes"] = "server and load generator"
+    return report
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def peak_rss_mb(pid: int):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    return None
+
+
+def run_http(data_dir: Path, workload: Workload, args):
+    port = free_port()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port)]
+        + ["--log-level", "warning"],
+        cwd=SERVER_DIR,
+        env=server_env(data_dir, args),
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                httpx.get(base_url + "/openapi.json").raise_for_status()
+                break
+            except httpx.TransportError:
+                if time.monotonic() > deadline or server.poll() is not None:
+                    raise RuntimeError("uvicorn did not start")
+                time.sleep(0.1)
+
+        async def run():
+            # Room for the change streams next to the requests in flight.
+            limits = httpx.Limits(max_connections=args.concurrency + args.subscribers)
+            async with httpx.AsyncClient(
+                base_url=base_url, limits=limits, timeout=None
+            ) as client:
+                return await run_endpoints(client, workload, args, streams=True)
+
+        report = asyncio.run(run())
+        report["peak_rss_mb"] = peak_rss_mb(server.pid)
+        report["peak_rss_includes"] = "server"
+        return report
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--storage", choices=["jsonl", "sqlite"], default="jsonl")
+    parser.add_argument("--entities", type=int, default=10_000)
+    parser.add_argument("--observations", type=int, default=5)
+    parser.add_argument("--relations", type=int, default=3, help="relations per entity")
+    parser.add_argument(
+        "--skew", type=float, default=1.0, help="Zipf exponent, 0 for uniform"
+    )
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--heavy-requests", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument(
+        "--namespaces", type=int, default=4, help="graphs for the namespaced_* endpoints"
+    )
+    parser.add_argument(
+        "--subscribers", type=int, default=8, help="clients following /changes/stream"
+    )
+    parser.add_argument(
+        "--mode", choices=["asgi", "http"], nargs="+", default=["asgi", "http"]
+    )
+    parser.add_argument(
+        "--endpoints", nargs="+", help="only these endpoints (default: all)"
+    )
+    parser.add_argument(
+        "--semantic", default="", help="MEMORY_SEMANTIC_MODEL for the server"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path, help="write the report here too")
+    args = parser.parse_args()
+
+    workload = Workload(args)
+    report = {"config": {k: v for k, v in vars(args).items() if k != "output"}}
+    with tempfile.TemporaryDirectory(prefix="memory-load-") as tmp:
+        graph_file = Path(tmp) / "memory.json"
+        size = workload.write_file(graph_file)
+        report["graph"] = {
+            "entities": args.entities,
+            "relations": args.entities * args.relations,
+            "file_mb": round(size / 2**20, 1),
+        }
+        for mode in args.mode:
+            print(f"{mode}:", file=sys.stderr)
+            data_dir = Path(tmp) / mode
+            data_dir.mkdir()
+            shutil.copy(graph_file, data_dir / "memory.json")
+            (data_dir / "namespaces").mkdir()
+            for namespace in workload.namespaces:
+                shutil.copy(graph_file, data_dir / "namespaces" / f"{namespace}.json")
+            run = run_asgi if mode == "asgi" else run_http
+            report[mode] = run(data_dir, workload, args)
+
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        args.output.write_text(text + "\n")
+
+
+if __name__ == "__main__":
+    main()
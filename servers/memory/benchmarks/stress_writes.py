@@ -0,0 +1,137 @@
+"""
+Multi-threaded write stress test for the memory server.
+
+Usage (from servers/memory):
+
+    python benchmarks/stress_writes.py [--storage jsonl|sqlite] [--threads 16]
+
+Many threads hammer a handful of shared entities with add_observations and
+create_relations through the ASGI app, while reader threads keep fetching
+the graph. Afterwards every acknowledged observation and relation must be
+present exactly once, both in the running server and after the store is
+reopened from disk. Exits non-zero if any update was lost.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--storage", choices=["jsonl", "sqlite"], default="jsonl")
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--ops", type=int, default=200, help="writes per thread")
+    parser.add_argument("--entities", type=int, default=4)
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp(prefix="memory-stress-")
+    os.environ["MEMORY_FILE_PATH"] = os.path.join(data_dir, "memory.json")
+    os.environ["MEMORY_STORAGE"] = args.storage
+    # Small log so compactions run concurrently with the writers.
+    os.environ.setdefault("MEMORY_WAL_COMPACT_BYTES", str(64 << 10))
+
+    import main as server
+    from fastapi.testclient import TestClient
+
+    client = TestClient(server.app)
+    names = [f"hot-{i}" for i in range(args.entities)]
+    client.post(
+        "/create_entities",
+        json={
+            "entities": [
+                {"name": n, "entityType": "stress", "observations": []} for n in names
+            ]
+        },
+    ).raise_for_status()
+
+    stop = threading.Event()
+    read_errors = []
+
+    def reader():
+        while not stop.is_set():
+            r = client.get("/read_graph")
+            if r.status_code != 200:
+                read_errors.append(r.status_code)
+
+    def writer(t: int):
+        for i in range(args.ops):
+            name = names[(t + i) % len(names)]
+            client.post(
+                "/add_observations",
+                json={"observations": [{"entityName": name, "contents": [f"{t}:{i}"]}]},
+            ).raise_for_status()
+            if i % 10 == 0:
+                client.post(
+                    "/create_relations",
+                    json={
+                        "relations": [
+                            {"from": name, "to": f"t{t}", "relationType": f"r{i}"}
+                        ]
+                    },
+                ).raise_for_status()
+
+    readers = [threading.Thread(target=reader) for _ in range(2)]
+    for r in readers:
+        r.start()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.threads) as pool:
+        list(pool.map(writer, range(args.threads)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    for r in readers:
+        r.join()
+
+    expected_obs = {name: set() for name in names}
+    for t in range(args.threads):
+        for i in range(args.ops):
+            expected_obs[names[(t + i) % len(names)]].add(f"{t}:{i}")
+    expected_rels = args.threads * len(range(0, args.ops, 10))
+
+    def verify(graph, label):
+        failures = []
+        for e in graph.entities:
+            got = e.observations
+            want = expected_obs.get(e.name, set())
+            if len(got) != len(set(got)) or set(got) != want:
+                failures.append(f"{e.name}: {len(want - set(got))} observations lost")
+        if len(graph.relations) != expected_rels:
+            failures.append(
+                f"relations: expected {expected_rels}, got {len(graph.relations)}"
+            )
+        print(f"{label}: {'OK' if not failures else 'FAILED'}")
+        for f in failures:
+            print("  " + f)
+        return not failures
+
+    with server.stores.lease("") as store:
+        ok = verify(store.read_graph(), "live graph")
+    server.stores.close()
+    if args.storage == "sqlite":
+        from sqlite_store import SqliteStore
+
+        reopened = SqliteStore(server.MEMORY_SQLITE_PATH)
+    else:
+        from store import JsonlStore
+
+        reopened = JsonlStore(server.MEMORY_FILE_PATH)
+    ok = verify(reopened.read_graph(), "reopened from disk") and ok
+    reopened.close()
+
+    writes = args.threads * (args.ops + len(range(0, args.ops, 10)))
+    print(
+        f"{writes} writes from {args.threads} threads in {elapsed:.2f}s"
+        f" ({writes / elapsed:.0f}/s), {len(read_errors)} failed reads"
+    )
+    sys.exit(0 if ok and not read_errors else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+"""
+Measure the semantic search index: build time, query latency and recall.
+
+Usage (from servers/memory):
+
+    python benchmarks/vector_search.py [--observations 1000000] [--queries 200] [--nprobe 8 40 80]
+
+Synthetic observations are embedded with the built-in hashing embedder and
+indexed. Like real notes they are topical: each has six words from one of
+5,000 topics (of 12 words each) and two from a 20,000-word vocabulary, and a
+query is three words of one topic. Each query is run
+through the index at the given ``nprobe`` values and compared with an exact
+scan of every vector. Many observations tie on score, so recall@10 counts a
+returned observation as correct when it scores at least as high as the
+exact tenth best.
+"""
+
+from pathlib import Path
+import argparse
+import random
+import statistics
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from semantic import HashingEmbedder, VectorIndex  # noqa: E402
+
+
+def words(rng: random.Random, count: int):
+    letters = "abcdefghijklmnopqrstuvwxyz"
+    return [
+        "".join(rng.choice(letters) for _ in range(rng.randint(3, 9)))
+        for _ in range(count)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--observations", type=int, default=1_000_000)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[8, 40, 80])
+    parser.add_argument("--limit", type=int, default=10)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    vocabulary = words(rng, 20_000)
+    topics = [rng.sample(vocabulary, 12) for _ in range(5000)]
+    index = VectorIndex(HashingEmbedder())
+
+    start = time.perf_counter()
+    batch = []
+    for i in range(args.observations):
+        topic = rng.choice(topics)
+        batch.append(" ".join(rng.sample(topic, 6) + rng.choices(vocabulary, k=2)))
+        if len(batch) == 4096 or i == args.observations - 1:
+            index.add(f"entity-{i // 5}", batch)
+            batch = []
+    embedded = time.perf_counter() - start
+    start = time.perf_counter()
+    index.train()
+    trained = time.perf_counter() - start
+    print(
+        f"{len(index):,} observations: embedded in {embedded:.1f}s,"
+        f" {len(index.centroids)} clusters trained in {trained:.1f}s,"
+        f" {index.nbytes() / 2**20:.0f} MiB of vectors"
+    )
+
+    queries = [" ".join(rng.sample(rng.choice(topics), 3)) for _ in range(args.queries)]
+    live = index._live_rows()
+    thresholds, expected = [], []
+    for query in queries:
+        vector = index.embedder.embed([query])[0]
+        scores = index._unit_vectors(live) @ vector
+        thresholds.append(np.partition(scores, -args.limit)[-args.limit])
+        # Search leaves out unrelated observations (score 0 or less).
+        expected.append(min(args.limit, int((scores > 0).sum())))
+
+    for nprobe in args.nprobe:
+        latencies, recalls = [], []
+        for query, threshold, wanted in zip(queries, thresholds, expected):
+            start = time.perf_counter()
+            found = index.search(query, args.limit, nprobe=nprobe)
+            latencies.append(time.perf_counter() - start)
+            hits = sum(score >= threshold - 1e-6 for _, _, score in found)
+            recalls.append(hits / wanted if wanted else 1.0)
+        latencies.sort()
+        print(
+            f"  nprobe {nprobe:>4}  median {statistics.median(latencies) * 1000:6.1f} ms"
+            f"  p95 {latencies[int(len(latencies) * 0.95)] * 1000:6.1f} ms"
+            f"  recall@{args.limit} {statistics.mean(recalls):.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,538 @@
+from bisect import bisect_left, bisect_right, insort
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+import sys
+
+from models import Relation
+from search import TextIndex, rank
+from snapshot import Snapshot
+
+RelationKey = Tuple[str, str, str]
+EntityTuple = Tuple[str, str, List[str], int]
+
+# Relations are packed into one int of three 32-bit symbol ids.
+ID_BITS = 32
+ID_MASK = (1 << ID_BITS) - 1
+
+
+def relation_key(relation: Relation) -> RelationKey:
+    return (relation.from_, relation.to, relation.relationType)
+
+
+def pack(from_id: int, to_id: int, type_id: int) -> int:
+    return (from_id << (2 * ID_BITS)) | (to_id << ID_BITS) | type_id
+
+
+class EntityRecord:
+    """
+    Resident form of an entity: four slots instead of a Pydantic model.
+
+    It has the attributes of ``models.Entity``, so search and serialization
+    code reads either; models are only built when a response needs one.
+    Observations are kept in a dict used as an insertion-ordered set, so
+    membership tests, additions and removals are O(1) per observation.
+    ``version`` is the graph version that last created or changed it.
+    """
+
+    __slots__ = ("name", "entityType", "observations", "version")
+
+    def __init__(
+        self,
+        name: str,
+        entity_type: str,
+        observations: Dict[str, None],
+        version: int = 0,
+    ):
+        self.name = name
+        self.entityType = entity_type
+        self.observations = observations
+        self.version = version
+
+
+# ----- Indexed Graph -----
+class Graph:
+    """
+    In-memory knowledge graph with name and adjacency indexes.
+
+    Entities are slotted records keyed by name, with their types interned.
+    Relation endpoints and types are replaced by integer symbol ids, and each
+    relation is stored as a single int packing (from, to, relationType) ids,
+    filed under its source and target ids in ``outgoing``/``incoming``.
+    Symbols are reference counted by the relations that use them and
+    recycled once unused. All mutations go through the methods below so the
+    indexes never drift, and lookups or relation filtering cost O(result)
+    instead of a scan of the whole graph.
+
+    A graph may sit on top of a ``base`` snapshot, which is memory-mapped
+    and never modified: the strings of its table are symbols (their ids are
+    the table's), entities are decoded from it when first looked up, and a
+    node's adjacency is copied out of it the first time the node is visited.
+    Only what changed since the snapshot, plus what was decoded, is held in
+    Python objects, so opening a graph does not scale with its size.
+
+    The full-text index is built on the first search rather than at load
+    time, and from then on is updated in place by every mutation. So is the
+    optional ``vector_index`` (semantic.VectorIndex), which the store
+    attaches when semantic search is enabled.
+    """
+
+    def __init__(self, base: Optional[Snapshot] = None):
+        self.base = base
+        self._base_entities = base.entity_count if base else 0
+        self._base_relations = base.relation_count if base else 0
+        self._base_strings = base.string_count if base else 0
+        # Entities created on top of the base, in insertion order.
+        self._added: Dict[str, EntityRecord] = {}
+        # Base entities decoded for changes, and base entities deleted. A
+        # deleted base entity that is created again also lives in _added.
+        self._loaded: Dict[str, EntityRecord] = {}
+        self._deleted: Set[str] = set()
+        # Packed relation keys used as ordered sets (values are always None),
+        # with the same split between the base and what was added on top.
+        self._added_relations: Dict[int, None] = {}
+        self._deleted_relations: Set[int] = set()
+        self.outgoing: Dict[int, Dict[int, None]] = {}
+        self.incoming: Dict[int, Dict[int, None]] = {}
+        # Base symbols whose adjacency has been copied into outgoing/incoming.
+        self._loaded_nodes: Set[int] = set()
+        self.text_index: Optional[TextIndex] = None
+        self.vector_index = None
+        # Number of the last mutation applied (see store.ChangeFeed).
+        self.version = base.version if base else 0
+        # Symbols that are not in the base table, numbered after it.
+        self._symbols: Dict[str, int] = {}
+        self._strings: List[Optional[str]] = []
+        self._refs: List[int] = []
+        self._free_ids: List[int] = []
+        # Insertion sequence numbers, used to break ranking ties in graph
+        # order. Base entities are numbered by their index in the snapshot.
+        self._positions: Dict[str, int] = {}
+        self._next_position = self._base_entities
+        # Sorted keys for cursor pagination, built on first use and then
+        # maintained in place.
+        self._sorted_names: Optional[List[str]] = None
+        self._sorted_relation_keys: Optional[List[int]] = None
+
+    # -- symbols --
+
+    def _symbol(self, text: str) -> Optional[int]:
+        symbol = self._symbols.get(text)
+        if symbol is None and self.base is not None:
+            symbol = self.base.find(text)
+        return symbol
+
+    def _string(self, symbol: int) -> str:
+        if symbol < self._base_strings:
+            return self.base.string(symbol)
+        return self._strings[symbol - self._base_strings]
+
+    def _acquire(self, text: str) -> int:
+        symbol = self._symbol(text)
+        if symbol is None:
+            text = sys.intern(text)
+            if self._free_ids:
+                slot = self._free_ids.pop()
+                self._strings[slot] = text
+                self._refs[slot] = 0
+            else:
+                slot = len(self._strings)
+                self._strings.append(text)
+                self._refs.append(0)
+            symbol = self._base_strings + slot
+            self._symbols[text] = symbol
+        if symbol >= self._base_strings:
+            self._refs[symbol - self._base_strings] += 1
+        return symbol
+
+    def _release(self, symbol: int):
+        # Base symbols are part of the snapshot and never recycled.
+        slot = symbol - self._base_strings
+        if slot < 0:
+            return
+        self._refs[slot] -= 1
+        if not self._refs[slot]:
+            del self._symbols[self._strings[slot]]
+            self._strings[slot] = None
+            self._free_ids.append(slot)
+
+    def _unpack(self, key: int) -> RelationKey:
+        return (
+            self._string(key >> (2 * ID_BITS)),
+            self._string((key >> ID_BITS) & ID_MASK),
+            self._string(key & ID_MASK),
+        )
+
+    def _lookup(self, from_: str, to: str, relation_type: str) -> Optional[int]:
+        ids = (self._symbol(from_), self._symbol(to), self._symbol(relation_type))
+        if None in ids:
+            return None
+        return pack(*ids)
+
+    # -- entities --
+
+    def _base_index(self, name: str) -> Optional[int]:
+        symbol = self.base.find(name)
+        return None if symbol is None else self.base.entity_index(symbol)
+
+    def _decode_entity(self, index: int, name: str) -> EntityRecord:
+        return EntityRecord(
+            name,
+            sys.intern(self.base.entity_type(index)),
+            dict.fromkeys(self.base.observations(index)),
+            self.base.entity_version(index),
+        )
+
+    def _entity(self, name: str, keep: bool) -> Optional[EntityRecord]:
+        entity = self._added.get(name)
+        if entity is not None or self.base is None or name in self._deleted:
+            return entity
+        entity = self._loaded.get(name)
+        if entity is None:
+            index = self._base_index(name)
+            if index is not None:
+                entity = self._decode_entity(index, name)
+                if keep:
+                    self._loaded[name] = entity
+        return entity
+
+    def get_entity(self, name: str) -> Optional[EntityRecord]:
+        """The live record for ``name``; changes to it must go through the graph."""
+        return self._entity(name, keep=True)
+
+    def iter_entities(self) -> Iterator[EntityRecord]:
+        """
+        Every entity in insertion order. Base entities that were not looked
+        up before are decoded for the iteration only.
+        """
+        for index in range(self._base_entities):
+            name = self.base.entity_name(index)
+            if name in self._deleted:
+                continue
+            entity = self._loaded.get(name)
+            yield entity if entity is not None else self._decode_entity(index, name)
+        yield from self._added.values()
+
+    def entity_count(self) -> int:
+        return self._base_entities - len(self._deleted) + len(self._added)
+
+    def add_entity(
+        self, name: str, entity_type: str, observations: List[str], version: int = 0
+    ) -> bool:
+        if self._entity(name, keep=False) is not None:
+            return False
+        entity = EntityRecord(
+            name, sys.intern(entity_type), dict.fromkeys(observations), version
+        )
+        self._added[name] = entity
+        self._positions[name] = self._next_position
+        self._next_position += 1
+        if self._sorted_names is not None:
+            insort(self._sorted_names, name)
+        if self.text_index is not None:
+            self.text_index.add_texts(
+                name, [name, entity.entityType, *entity.observations]
+            )
+        if self.vector_index is not None:
+            self.vector_index.add(name, entity.observations)
+        return True
+
+    def detach(self, name: str) -> int:
+        """Remove every relation from or to ``name``; returns how many there were."""
+        symbol = self._symbol(name)
+        if symbol is None:
+            return 0
+        self._load_node(symbol)
+        keys = dict.fromkeys(self.outgoing.get(symbol, ()))
+        keys.update(dict.fromkeys(self.incoming.get(symbol, ())))
+        for key in keys:
+            self._remove_key(key)
+        return len(keys)
+
+    def remove_entity(self, name: str) -> bool:
+        """Remove an entity together with every relation that touches it."""
+        self.detach(name)
+        entity = self._added.pop(name, None)
+        if entity is not None:
+            del self._positions[name]
+        else:
+            entity = self._entity(name, keep=False)
+            if entity is None:
+                return False
+            self._loaded.pop(name, None)
+            self._deleted.add(name)
+        if self._sorted_names is not None:
+            del self._sorted_names[bisect_left(self._sorted_names, name)]
+        if self.text_index is not None:
+            self.text_index.remove_entity(
+                name, [name, entity.entityType, *entity.observations]
+            )
+        if self.vector_index is not None:
+            self.vector_index.remove_entity(name)
+        return True
+
+    def _position(self, name: str) -> int:
+        position = self._positions.get(name)
+        return position if position is not None else self._base_index(name)
+
+    # -- observations --
+
+    def add_observations(
+        self, entity: EntityRecord, contents: List[str], version: int = 0
+    ) -> List[str]:
+        """Append the new ``contents`` in order; returns the ones added."""
+        observations = entity.observations
+        added = []
+        for content in contents:
+            if content not in observations:
+                observations[content] = None
+                added.append(content)
+        if added:
+            entity.version = version
+        if self.text_index is not None:
+            self.text_index.add_texts(entity.name, added)
+        if self.vector_index is not None:
+            self.vector_index.add(entity.name, added)
+        return added
+
+    def remove_observations(
+        self, entity: EntityRecord, to_delete: List[str], version: int = 0
+    ):
+        observations = entity.observations
+        removed = []
+        for content in to_delete:
+            if content in observations:
+                del observations[content]
+                removed.append(content)
+        if removed:
+            entity.version = version
+        if self.text_index is not None:
+            self.text_index.remove_texts(
+                entity.name,
+                removed,
+                [entity.name, entity.entityType, *entity.observations],
+            )
+        if self.vector_index is not None:
+            self.vector_index.remove(entity.name, removed)
+
+    # -- relations --
+
+    def _load_node(self, symbol: int):
+        """Copy a base symbol's adjacency out of the snapshot, once."""
+        if symbol >= self._base_strings or symbol in self._loaded_nodes:
+            return
+        self._loaded_nodes.add(symbol)
+        ids = self.base.relations
+        for index, positions in (
+            (self.outgoing, self.base.outgoing(symbol)),
+            (self.incoming, self.base.incoming(symbol)),
+        ):
+            bucket = {}
+            for i in positions:
+                key = pack(ids[3 * i], ids[3 * i + 1], ids[3 * i + 2])
+                if key not in self._deleted_relations:
+                    bucket[key] = None
+            if bucket:
+                index[symbol] = bucket
+
+    def _has_key(self, key: int) -> bool:
+        from_id = key >> (2 * ID_BITS)
+        self._load_node(from_id)
+        return key in self.outgoing.get(from_id, ())
+
+    def add_relation(self, from_: str, to: str, relation_type: str) -> bool:
+        key = self._lookup(from_, to, relation_type)
+        if key is not None and self._has_key(key):
+            return False
+        from_id = self._acquire(from_)
+        to_id = self._acquire(to)
+        type_id = self._acquire(relation_type)
+        self._load_node(from_id)
+        self._load_node(to_id)
+        key = pack(from_id, to_id, type_id)
+        self._added_relations[key] = None
+        self.outgoing.setdefault(from_id, {})[key] = None
+        self.incoming.setdefault(to_id, {})[key] = None
+        if self._sorted_relation_keys is not None:
+            insort(self._sorted_relation_keys, key, key=self._unpack)
+        return True
+
+    def remove_relation(self, from_: str, to: str, relation_type: str) -> bool:
+        key = self._lookup(from_, to, relation_type)
+        if key is None or not self._has_key(key):
+            return False
+        self._remove_key(key)
+        return True
+
+    def _remove_key(self, key: int):
+        if self._sorted_relation_keys is not None:
+            keys = self._sorted_relation_keys
+            del keys[bisect_left(keys, self._unpack(key), key=self._unpack)]
+        from_id = key >> (2 * ID_BITS)
+        to_id = (key >> ID_BITS) & ID_MASK
+        self._load_node(from_id)
+        self._load_node(to_id)
+        if key in self._added_relations:
+            del self._added_relations[key]
+        else:
+            self._deleted_relations.add(key)
+        for index, symbol in ((self.outgoing, from_id), (self.incoming, to_id)):
+            bucket = index[symbol]
+            del bucket[key]
+            if not bucket:
+                del index[symbol]
+        self._release(from_id)
+        self._release(to_id)
+        self._release(key & ID_MASK)
+
+    def _keys(self) -> Iterator[int]:
+        if self.base is not None:
+            ids = self.base.relations
+            deleted = self._deleted_relations
+            for triple in zip(ids[0::3], ids[1::3], ids[2::3]):
+                key = pack(*triple)
+                if key not in deleted:
+                    yield key
+        yield from self._added_relations
+
+    def relation_keys(self) -> Iterator[RelationKey]:
+        """Every relation as a (from, to, relationType) triple, in insertion order."""
+        return map(self._unpack, self._keys())
+
+    def relation_count(self) -> int:
+        return (
+            self._base_relations
+            - len(self._deleted_relations)
+            + len(self._added_relations)
+        )
+
+    def _members(self, names: Iterable[str]) -> Dict[int, None]:
+        members = {}
+        for name in names:
+            symbol = self._symbol(name)
+            if symbol is not None:
+                self._load_node(symbol)
+                members[symbol] = None
+        return members
+
+    def relations_among(self, names: Iterable[str]) -> List[RelationKey]:
+        """Relations whose endpoints are both in ``names``, grouped by source."""
+        members = self._members(names)
+        return [
+            self._unpack(key)
+            for symbol in members
+            for key in self.outgoing.get(symbol, ())
+            if (key >> ID_BITS) & ID_MASK in members
+        ]
+
+    def neighbors(self, names: Iterable[str], direction: str) -> List[RelationKey]:
+        """Relations leaving (``outgoing``), entering (``incoming``) or touching
+        (``both``) any of ``names``."""
+        indexes = {
+            "outgoing": (self.outgoing,),
+            "incoming": (self.incoming,),
+            "both": (self.outgoing, self.incoming),
+        }[direction]
+        keys = []
+        for symbol in self._members(names):
+            for index in indexes:
+                keys.extend(index.get(symbol, ()))
+        return [self._unpack(key) for key in keys]
+
+    # -- pagination --
+
+    def entities_after(self, after: Optional[str], limit: int) -> List[EntityRecord]:
+        """Up to ``limit`` entities whose names sort after ``after``."""
+        if self._sorted_names is None:
+            names = []
+            if self.base is not None:
+                names = [
+                    n for n in self.base.names_in_order() if n not in self._deleted
+                ]
+            # Both parts are already sorted runs, which sorted() merges.
+            self._sorted_names = sorted(names + sorted(self._added))
+        names = self._sorted_names
+        start = 0 if after is None else bisect_right(names, after)
+        return [self._entity(n, keep=False) for n in names[start : start + limit]]
+
+    def relations_after(
+        self, after: Optional[RelationKey], limit: int
+    ) -> List[RelationKey]:
+        """Up to ``limit`` relations whose keys sort after ``after``."""
+        if self._sorted_relation_keys is None:
+            self._sorted_relation_keys = sorted(self._keys(), key=self._unpack)
+        keys = self._sorted_relation_keys
+        start = 0 if after is None else bisect_right(keys, after, key=self._unpack)
+        return [self._unpack(key) for key in keys[start : start + limit]]
+
+    # -- search --
+
+    def search(self, query: str) -> List[EntityRecord]:
+        """
+        Entities whose name, type or any observation contains ``query``
+        (case-insensitively), best matches first.
+        """
+        if self.text_index is None:
+            self.text_index = TextIndex()
+            for e in self.iter_entities():
+                self.text_index.add_texts(
+                    e.name, [e.name, e.entityType, *e.observations]
+                )
+        query = query.lower()
+        names = self.text_index.candidates(query)
+        if names is None:
+            candidates = enumerate(self.iter_entities())
+        else:
+            candidates = (
+                (self._position(n), self._entity(n, keep=False)) for n in names
+            )
+        return rank(candidates, query)
+
+    # -- persistence --
+
+    def capture(self) -> Tuple[Iterator[EntityTuple], Iterator[RelationKey]]:
+        """
+        The graph's contents as (name, entityType, observations, version) and
+        (from, to, relationType) tuples, in insertion order.
+
+        Changes made on top of the base are copied now; the base itself is
+        immutable, so the iterators may be consumed after the graph has
+        moved on (and without holding its lock).
+        """
+        base = self.base
+        base_entities = self._base_entities
+        deleted = set(self._deleted)
+        loaded = {
+            name: (name, e.entityType, list(e.observations), e.version)
+            for name, e in self._loaded.items()
+        }
+        added = [
+            (e.name, e.entityType, list(e.observations), e.version)
+            for e in self._added.values()
+        ]
+        deleted_relations = set(self._deleted_relations)
+        added_relations = [self._unpack(key) for key in self._added_relations]
+
+        def entities():
+            for index in range(base_entities):
+                name = base.entity_name(index)
+                if name in deleted:
+                    continue
+                entity = loaded.get(name)
+                if entity is None:
+                    entity = (
+                        name,
+                        base.entity_type(index),
+                        base.observations(index),
+                        base.entity_version(index),
+                    )
+                yield entity
+            yield from added
+
+        def relations():
+            if base is not None:
+                ids = base.relations
+                for triple in zip(ids[0::3], ids[1::3], ids[2::3]):
+                    if pack(*triple) not in deleted_relations:
+                        yield tuple(map(base.string, triple))
+            yield from added_relations
+
+        return entities(), relations()
@@ -0,0 +1,158 @@
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional
+import contextvars
+import json
+import logging
+import queue
+import random
+import sys
+import time
+
+logger = logging.getLogger("memory")
+
+# Whether the request being handled was picked for detailed logging.
+_sampled = contextvars.ContextVar("memory_log_sampled", default=False)
+_rates: Dict[str, float] = {}
+_default_rate = 0.0
+_listener: Optional[QueueListener] = None
+
+
+# ----- Formatting -----
+class TextFormatter(logging.Formatter):
+    """``time level message key=value ...``, values JSON-encoded."""
+
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        line = super().format(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            line += "".join(
+                f" {key}={json.dumps(value, default=str)}"
+                for key, value in fields.items()
+            )
+        return line
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        item = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "message": record.getMessage(),
+            **getattr(record, "fields", {}),
+        }
+        if record.exc_info:
+            item["exception"] = self.formatException(record.exc_info)
+        return json.dumps(item, default=str)
+
+
+# ----- Setup -----
+def parse_rates(spec: str):
+    """
+    Parse ``"0.1,search_nodes=1,read_graph=0"`` into a default sampling rate
+    and per-endpoint overrides.
+    """
+    default = 0.0
+    rates = {}
+    for part in filter(None, (p.strip() for p in spec.split(","))):
+        endpoint, _, rate = part.rpartition("=")
+        if endpoint in ("", "*"):
+            default = float(rate)
+        else:
+            rates[endpoint] = float(rate)
+    return default, rates
+
+
+def configure(level: str = "INFO", fmt: str = "text", sample: str = "0"):
+    """
+    Route the ``memory`` logger through a queue to stderr.
+
+    Handlers only enqueue records; a listener thread formats and writes
+    them, so a slow or blocked stderr never stalls a request.
+    """
+    global _listener, _default_rate, _rates
+    shutdown()
+    _default_rate, _rates = parse_rates(sample)
+    stream = logging.StreamHandler(sys.stderr)
+    stream.setFormatter(JsonFormatter() if fmt == "json" else TextFormatter())
+    records = queue.SimpleQueue()
+    logger.handlers = [QueueHandler(records)]
+    logger.setLevel(level.upper())
+    logger.propagate = False
+    _listener = QueueListener(records, stream)
+    _listener.start()
+
+
+def shutdown():
+    """Write out queued records and stop the listener thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+# ----- Logging -----
+def event(level: int, message: str, **fields):
+    """Log ``message`` with structured ``fields``."""
+    if logger.isEnabledFor(level):
+        logger.log(level, message, extra={"fields": fields})
+
+
+def detail(message: str, **fields):
+    """
+    Event logged only for sampled requests. Sampling is what opts a request
+    in, so details are logged at INFO, the default level, like the request
+    line they go with.
+    """
+    if _sampled.get():
+        event(logging.INFO, message, **fields)
+
+
+# ----- Request Middleware -----
+class RequestLogMiddleware:
+    """
+    Sample requests per endpoint and log one line for each sampled request.
+
+    The endpoint is the last path segment, so ``/search_nodes`` and
+    ``/namespaces/x/search_nodes`` share a rate. Unsampled requests pass
+    straight through; sampled ones also enable ``detail()`` events made
+    while they are handled.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        endpoint = scope["path"].rstrip("/").rpartition("/")[2]
+        rate = _rates.get(endpoint, _default_rate)
+        if rate <= 0 or (rate < 1 and random.random() >= rate):
+            return await self.app(scope, receive, send)
+
+        token = _sampled.set(True)
+        start = time.perf_counter()
+        status = None
+
+        async def send_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_status)
+        finally:
+            event(
+                logging.INFO,
+                "request",
+                method=scope["method"],
+                path=scope["path"],
+                status=status,
+                ms=round((time.perf_counter() - start) * 1000, 2),
+            )
+            _sampled.reset(token)
@@ -1,29 +1,33 @@
-from fastapi import FastAPI, HTTPException, Body
+from fastapi import (
+    APIRouter,
+    Body,
+    Depends,
+    FastAPI,
+    Header,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+)
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import StreamingResponse
+from contextlib import asynccontextmanager
 
 
 from pydantic import BaseModel, Field
-from typing import List, Literal, Union
+from typing import AsyncIterator, Dict, Iterable, Iterator, List, Literal, Optional
 from pathlib import Path
+import asyncio
 import json
 import os
 
-app = FastAPI(
-    title="Knowledge Graph Server",
-    version="1.0.0",
-    description="A structured knowledge graph memory system that supports entity and relation storage, observation tracking, and manipulation.",
-)
-
-origins = ["*"]
-
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=origins,
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+import anyio
 
+from models import Entity, Relation, KnowledgeGraph, KnowledgeGraphPage, SemanticMatch
+import logs
+from namespaces import StoreRegistry, check_namespace
+from store import ChangesExpired, ImportBatch, JsonlStore, Store, VersionConflict
 
 # ----- Persistence Setup -----
 MEMORY_FILE_PATH_ENV = os.getenv("MEMORY_FILE_PATH", "memory.json")
@@ -32,78 +36,120 @@ MEMORY_FILE_PATH = Path(
     if Path(MEMORY_FILE_PATH_ENV).is_absolute()
     else Path(__file__).parent / MEMORY_FILE_PATH_ENV
 )
+# Seconds between fsyncs of the write-ahead log; 0 fsyncs every mutation.
+MEMORY_WAL_SYNC_INTERVAL = float(os.getenv("MEMORY_WAL_SYNC_INTERVAL", "1.0"))
+# Size at which the write-ahead log is folded into a new memory.json snapshot.
+MEMORY_WAL_COMPACT_BYTES = int(os.getenv("MEMORY_WAL_COMPACT_BYTES", str(8 << 20)))
+# Mutations arriving within this many milliseconds are persisted in one durable
+# write (group commit); 0 persists each mutation on its own.
+MEMORY_GROUP_COMMIT_MS = float(os.getenv("MEMORY_GROUP_COMMIT_MS", "0"))
+# Storage backend: "jsonl" (MEMORY_FILE_PATH plus its log) or "sqlite".
+MEMORY_STORAGE = os.getenv("MEMORY_STORAGE", "jsonl").lower()
+MEMORY_SQLITE_PATH_ENV = os.getenv(
+    "MEMORY_SQLITE_PATH", str(MEMORY_FILE_PATH.with_suffix(".db"))
+)
+MEMORY_SQLITE_PATH = Path(
+    MEMORY_SQLITE_PATH_ENV
+    if Path(MEMORY_SQLITE_PATH_ENV).is_absolute()
+    else Path(__file__).parent / MEMORY_SQLITE_PATH_ENV
+)
 
-
-# ----- Data Models -----
-class Entity(BaseModel):
-    name: str = Field(..., description="The name of the entity")
-    entityType: str = Field(..., description="The type of the entity")
-    observations: List[str] = Field(
-        ..., description="An array of observation contents associated with the entity"
+# Requests select a separate graph (namespace) with this header, or by
+# prefixing the path with /namespaces/{namespace}; the rest use the default
+# graph above. Namespace graphs are kept under MEMORY_NAMESPACE_DIR.
+MEMORY_NAMESPACE_HEADER = os.getenv("MEMORY_NAMESPACE_HEADER", "X-Memory-Namespace")
+MEMORY_NAMESPACE_DIR_ENV = os.getenv(
+    "MEMORY_NAMESPACE_DIR", str(MEMORY_FILE_PATH.parent / "namespaces")
+)
+MEMORY_NAMESPACE_DIR = Path(
+    MEMORY_NAMESPACE_DIR_ENV
+    if Path(MEMORY_NAMESPACE_DIR_ENV).is_absolute()
+    else Path(__file__).parent / MEMORY_NAMESPACE_DIR_ENV
+)
+# Idle namespaces are closed, least recently used first, once the open ones
+# are estimated to take more memory than this.
+MEMORY_NAMESPACE_BUDGET_MB = float(os.getenv("MEMORY_NAMESPACE_BUDGET_MB", "512"))
+
+# Number of recent mutations each graph keeps for /changes.
+MEMORY_CHANGES_HISTORY = int(os.getenv("MEMORY_CHANGES_HISTORY", "10000"))
+# Seconds between keep-alive comments on an idle /changes/stream.
+MEMORY_CHANGES_KEEPALIVE = float(os.getenv("MEMORY_CHANGES_KEEPALIVE", "15"))
+
+# Embedding model for /semantic_search: "hashing" (built in, NumPy only) or
+# a sentence-transformers model name. Empty disables semantic search.
+MEMORY_SEMANTIC_MODEL = os.getenv("MEMORY_SEMANTIC_MODEL", "")
+
+if MEMORY_STORAGE == "sqlite":
+    from sqlite_store import SqliteStore
+elif MEMORY_STORAGE != "jsonl":
+    raise ValueError(f"Unknown MEMORY_STORAGE: {MEMORY_STORAGE!r}")
+
+embedder = None
+if MEMORY_SEMANTIC_MODEL:
+    from semantic import load_embedder
+
+    embedder = load_embedder(MEMORY_SEMANTIC_MODEL)
+
+
+def open_store(namespace: str) -> Store:
+    if namespace:
+        MEMORY_NAMESPACE_DIR.mkdir(parents=True, exist_ok=True)
+        file_path = MEMORY_NAMESPACE_DIR / f"{namespace}.json"
+        sqlite_path = MEMORY_NAMESPACE_DIR / f"{namespace}.db"
+    else:
+        file_path, sqlite_path = MEMORY_FILE_PATH, MEMORY_SQLITE_PATH
+    if MEMORY_STORAGE == "sqlite":
+        # An existing memory.json is imported the first time the database is created.
+        return SqliteStore(
+            sqlite_path,
+            migrate_from=file_path,
+            group_commit_window=MEMORY_GROUP_COMMIT_MS / 1000,
+            change_history=MEMORY_CHANGES_HISTORY,
+        )
+    return JsonlStore(
+        file_path,
+        sync_interval=MEMORY_WAL_SYNC_INTERVAL,
+        compact_bytes=MEMORY_WAL_COMPACT_BYTES,
+        group_commit_window=MEMORY_GROUP_COMMIT_MS / 1000,
+        embedder=embedder,
+        change_history=MEMORY_CHANGES_HISTORY,
     )
 
 
-class Relation(BaseModel):
-    from_: str = Field(
-        ...,
-        alias="from",
-        description="The name of the entity where the relation starts",
-    )
-    to: str = Field(..., description="The name of the entity where the relation ends")
-    relationType: str = Field(..., description="The type of the relation")
-
-
-class KnowledgeGraph(BaseModel):
-    entities: List[Entity]
-    relations: List[Relation]
-
-
-class EntityWrapper(BaseModel):
-    type: Literal["entity"]
-    name: str
-    entityType: str
-    observations: List[str]
-
-
-class RelationWrapper(BaseModel):
-    type: Literal["relation"]
-    from_: str = Field(..., alias="from")
-    to: str
-    relationType: str
-
-
-# ----- I/O Handlers -----
-def read_graph_file() -> KnowledgeGraph:
-    if not MEMORY_FILE_PATH.exists():
-        return KnowledgeGraph(entities=[], relations=[])
-    with open(MEMORY_FILE_PATH, "r", encoding="utf-8") as f:
-        lines = [line for line in f if line.strip()]
-        entities = []
-        relations = []
-        for line in lines:
-            print(line)
-            item = json.loads(line)
-            if item["type"] == "entity":
-                entities.append(
-                    Entity(
-                        name=item["name"],
-                        entityType=item["entityType"],
-                        observations=item["observations"],
-                    )
-                )
-            elif item["type"] == "relation":
-                relations.append(Relation(**item))
+# Logging: level, "text" or "json" lines, and the fraction of requests that
+# are logged, e.g. "0.01,search_nodes=1" (see logs.parse_rates).
+MEMORY_LOG_LEVEL = os.getenv("MEMORY_LOG_LEVEL", "INFO")
+MEMORY_LOG_FORMAT = os.getenv("MEMORY_LOG_FORMAT", "text")
+MEMORY_LOG_SAMPLE = os.getenv("MEMORY_LOG_SAMPLE", "0")
+logs.configure(MEMORY_LOG_LEVEL, MEMORY_LOG_FORMAT, MEMORY_LOG_SAMPLE)
+
+stores = StoreRegistry(open_store, int(MEMORY_NAMESPACE_BUDGET_MB * (1 << 20)))
+
 
-        return KnowledgeGraph(entities=entities, relations=relations)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    stores.close()
+    logs.shutdown()
+
+
+app = FastAPI(
+    title="Knowledge Graph Server",
+    version="1.0.0",
+    description="A structured knowledge graph memory system that supports entity and relation storage, observation tracking, and manipulation.",
+    lifespan=lifespan,
+)
 
+origins = ["*"]
 
-def save_graph(graph: KnowledgeGraph):
-    lines = [json.dumps({"type": "entity", **e.dict()}) for e in graph.entities] + [
-        json.dumps({"type": "relation", **r.dict(by_alias=True)})
-        for r in graph.relations
-    ]
-    with open(MEMORY_FILE_PATH, "w", encoding="utf-8") as f:
-        f.write("\n".join(lines))
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=origins,
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+app.add_middleware(logs.RequestLogMiddleware)
 
 
 # ----- Request Models -----
@@ -126,6 +172,9 @@ class ObservationItem(BaseModel):
     contents: List[str] = Field(
         ..., description="An array of observation contents to add"
     )
+    expectedVersion: Optional[int] = Field(
+        None, description="Only add if the entity is still at this version"
+    )
 
 
 class DeletionItem(BaseModel):
@@ -135,6 +184,9 @@ class DeletionItem(BaseModel):
     observations: List[str] = Field(
         ..., description="An array of observations to delete"
     )
+    expectedVersion: Optional[int] = Field(
+        None, description="Only delete if the entity is still at this version"
+    )
 
 
 class AddObservationsRequest(BaseModel):
@@ -155,6 +207,10 @@ class DeleteEntitiesRequest(BaseModel):
     entityNames: List[str] = Field(
         ..., description="An array of entity names to delete"
     )
+    expectedVersions: Optional[Dict[str, int]] = Field(
+        None,
+        description="Only delete if each named entity is still at the given version",
+    )
 
 
 class DeleteRelationsRequest(BaseModel):
@@ -168,130 +224,552 @@ class SearchNodesRequest(BaseModel):
         ...,
         description="The search query to match against entity names, types, and observation content",
     )
+    limit: Optional[int] = Field(
+        None, ge=0, description="Maximum number of entities to return, best first"
+    )
+    offset: int = Field(
+        0, ge=0, description="Number of ranked entities to skip, for paging"
+    )
+
+
+class SemanticSearchRequest(BaseModel):
+    query: str = Field(..., description="Text to find similar observations for")
+    limit: int = Field(
+        10, ge=1, le=100, description="Number of observations to return, closest first"
+    )
 
 
 class OpenNodesRequest(BaseModel):
     names: List[str] = Field(..., description="An array of entity names to retrieve")
 
 
+class TraverseRequest(BaseModel):
+    names: List[str] = Field(
+        ..., description="Entity names to start the breadth-first traversal from"
+    )
+    maxDepth: int = Field(
+        2, ge=0, le=16, description="Maximum number of relation hops from the seeds"
+    )
+    relationTypes: Optional[List[str]] = Field(
+        None, description="Only follow relations of these types (default: all)"
+    )
+    direction: Literal["outgoing", "incoming", "both"] = Field(
+        "both", description="Which way relations may be followed"
+    )
+    maxNodes: int = Field(
+        1000, ge=1, description="Stop adding entities once this many were visited"
+    )
+    maxEdges: int = Field(
+        5000,
+        ge=0,
+        description="Stop the traversal once this many relations were returned",
+    )
+
+
+# ----- Namespaces -----
+
+
+def get_namespace(
+    request: Request,
+    header: Optional[str] = Header(
+        None, alias=MEMORY_NAMESPACE_HEADER, include_in_schema=False
+    ),
+) -> str:
+    namespace = request.path_params.get("namespace", header) or ""
+    if namespace:
+        try:
+            check_namespace(namespace)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    return namespace
+
+
+def get_store(namespace: str = Depends(get_namespace)) -> Iterator[Store]:
+    with stores.lease(namespace) as store:
+        yield store
+
+
+def leased(namespace: str, records) -> Iterator[Dict]:
+    # Streams outlive the request handler, so they hold their own lease.
+    with stores.lease(namespace) as store:
+        yield from records(store)
+
+
+# ----- Streaming -----
+
+
+def ndjson(records: Iterable[Dict], batch_size: int = 1000) -> Iterator[str]:
+    # A sync iterator costs a threadpool round trip per chunk, so send lines
+    # in batches rather than one at a time.
+    lines = []
+    for record in records:
+        lines.append(json.dumps(record) + "\n")
+        if len(lines) >= batch_size:
+            yield "".join(lines)
+            lines = []
+    if lines:
+        yield "".join(lines)
+
+
+def sse(event: str, data: Dict, id: Optional[int] = None) -> str:
+    head = f"id: {id}\n" if id is not None else ""
+    return f"{head}event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def change_events(namespace: str, since: Optional[int]) -> AsyncIterator[str]:
+    """
+    Server-sent events for every change after version ``since`` (by default
+    the current one), then for each new change as it is committed. If the
+    feed no longer holds the changes a ``reset`` event with the current
+    version ends the stream.
+    """
+    loop = asyncio.get_running_loop()
+    wake = asyncio.Event()
+
+    def notify():
+        # Called from whichever thread committed.
+        loop.call_soon_threadsafe(wake.set)
+
+    # The stream outlives the request handler, so it holds its own lease;
+    # opening or closing a store does I/O, so that happens off the loop.
+    lease = stores.lease(namespace)
+    store = await run_in_threadpool(lease.__enter__)
+    store.feed.subscribe(notify)
+    try:
+        if since is None:
+            since = await run_in_threadpool(store.version)
+        while True:
+            wake.clear()
+            try:
+                _, changes = await run_in_threadpool(store.changes, since)
+            except ChangesExpired as e:
+                yield sse("reset", {"version": e.version})
+                return
+            for change in changes:
+                yield sse("change", change, id=change["version"])
+            if changes:
+                since = changes[-1]["version"]
+                continue
+            try:
+                await asyncio.wait_for(wake.wait(), MEMORY_CHANGES_KEEPALIVE)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+    finally:
+        store.feed.unsubscribe(notify)
+        with anyio.CancelScope(shield=True):
+            await run_in_threadpool(lease.__exit__, None, None, None)
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = [t.strip().removeprefix("W/") for t in if_none_match.split(",")]
+    return "*" in tags or etag in tags
+
+
+def if_match_version(if_match: Optional[str]) -> Optional[int]:
+    """The entity version an If-Match header asks for; None for none or *."""
+    if not if_match or if_match.strip() == "*":
+        return None
+    try:
+        return int(if_match.strip().removeprefix("W/").strip('"'))
+    except ValueError:
+        raise HTTPException(
+            status_code=400, detail="If-Match must be a single entity version"
+        )
+
+
+def expect(item: Dict, expected: Optional[int]) -> Dict:
+    """``item`` with an expectedVersion, if there is one."""
+    return item if expected is None else {**item, "expectedVersion": expected}
+
+
+def version_conflict(e: VersionConflict) -> HTTPException:
+    return HTTPException(
+        status_code=409,
+        detail={
+            "entityName": e.name,
+            "expectedVersion": e.expected,
+            "currentVersion": e.actual,
+        },
+    )
+
+
 # ----- Endpoints -----
 
+router = APIRouter()
+
+
+@router.post("/create_entities", summary="Create multiple entities in the graph")
+def create_entities(req: CreateEntitiesRequest, store: Store = Depends(get_store)):
+    return store.commit(
+        {
+            "op": "create_entities",
+            "entities": [e.dict(exclude={"version"}) for e in req.entities],
+        }
+    )
+
+
+@router.post("/create_relations", summary="Create multiple relations between entities")
+def create_relations(req: CreateRelationsRequest, store: Store = Depends(get_store)):
+    return store.commit(
+        {
+            "op": "create_relations",
+            "relations": [r.dict(by_alias=True) for r in req.relations],
+        }
+    )
+
 
-@app.post("/create_entities", summary="Create multiple entities in the graph")
-def create_entities(req: CreateEntitiesRequest):
-    graph = read_graph_file()
-    existing_names = {e.name for e in graph.entities}
-    new_entities = [e for e in req.entities if e.name not in existing_names]
-    graph.entities.extend(new_entities)
-    save_graph(graph)
-    return new_entities
-
-
-@app.post("/create_relations", summary="Create multiple relations between entities")
-def create_relations(req: CreateRelationsRequest):
-    graph = read_graph_file()
-    existing = {(r.from_, r.to, r.relationType) for r in graph.relations}
-    new = [r for r in req.relations if (r.from_, r.to, r.relationType) not in existing]
-    graph.relations.extend(new)
-    save_graph(graph)
-    return new
-
-
-@app.post("/add_observations", summary="Add new observations to existing entities")
-def add_observations(req: AddObservationsRequest):
-    graph = read_graph_file()
-    results = []
-
-    for obs in req.observations:
-        name = obs.entityName.lower()
-        contents = obs.contents
-        entity = next((e for e in graph.entities if e.name == name), None)
-        if not entity:
-            raise HTTPException(status_code=404, detail=f"Entity {name} not found")
-        added = [c for c in contents if c not in entity.observations]
-        entity.observations.extend(added)
-        results.append({"entityName": name, "addedObservations": added})
-
-    save_graph(graph)
-    return results
-
-
-@app.post("/delete_entities", summary="Delete entities and associated relations")
-def delete_entities(req: DeleteEntitiesRequest):
-    graph = read_graph_file()
-    graph.entities = [e for e in graph.entities if e.name not in req.entityNames]
-    graph.relations = [
-        r
-        for r in graph.relations
-        if r.from_ not in req.entityNames and r.to not in req.entityNames
-    ]
-    save_graph(graph)
-    return {"message": "Entities deleted successfully"}
-
-
-@app.post("/delete_observations", summary="Delete specific observations from entities")
-def delete_observations(req: DeleteObservationsRequest):
-    graph = read_graph_file()
-
-    for deletion in req.deletions:
-        name = deletion.entityName.lower()
-        to_delete = deletion.observations
-        entity = next((e for e in graph.entities if e.name == name), None)
-        if entity:
-            entity.observations = [
-                obs for obs in entity.observations if obs not in to_delete
-            ]
-
-    save_graph(graph)
-    return {"message": "Observations deleted successfully"}
-
-
-@app.post("/delete_relations", summary="Delete relations from the graph")
-def delete_relations(req: DeleteRelationsRequest):
-    graph = read_graph_file()
-    del_set = {(r.from_, r.to, r.relationType) for r in req.relations}
-    graph.relations = [
-        r for r in graph.relations if (r.from_, r.to, r.relationType) not in del_set
-    ]
-    save_graph(graph)
-    return {"message": "Relations deleted successfully"}
-
-
-@app.get(
-    "/read_graph", response_model=KnowledgeGraph, summary="Read entire knowledge graph"
+# Mutations of named entities take preconditions: an expected entity version
+# per item, or an If-Match header for every item without one. The write is
+# refused with 409 Conflict if any entity has moved on.
+
+
+@router.post("/add_observations", summary="Add new observations to existing entities")
+def add_observations(
+    req: AddObservationsRequest,
+    if_match: Optional[str] = Header(None),
+    store: Store = Depends(get_store),
+):
+    expected = if_match_version(if_match)
+    record = {
+        "op": "add_observations",
+        "observations": [
+            expect(
+                {"entityName": obs.entityName.lower(), "contents": obs.contents},
+                obs.expectedVersion if obs.expectedVersion is not None else expected,
+            )
+            for obs in req.observations
+        ],
+    }
+    try:
+        return store.commit(record)
+    except KeyError as e:
+        raise HTTPException(status_code=404, detail=f"Entity {e.args[0]} not found")
+    except VersionConflict as e:
+        raise version_conflict(e)
+
+
+@router.post("/delete_entities", summary="Delete entities and associated relations")
+def delete_entities(
+    req: DeleteEntitiesRequest,
+    if_match: Optional[str] = Header(None),
+    store: Store = Depends(get_store),
+):
+    expected = if_match_version(if_match)
+    versions = dict.fromkeys(req.entityNames, expected) if expected is not None else {}
+    versions.update(req.expectedVersions or {})
+    record = {"op": "delete_entities", "entityNames": req.entityNames}
+    if versions:
+        record["expectedVersions"] = versions
+    try:
+        deleted = store.commit(record)
+    except VersionConflict as e:
+        raise version_conflict(e)
+    return {
+        "message": "Entities deleted successfully",
+        "deletedEntities": deleted["entities"],
+        "deletedRelations": deleted["relations"],
+    }
+
+
+@router.post(
+    "/delete_observations", summary="Delete specific observations from entities"
 )
-def read_graph():
-    return read_graph_file()
+def delete_observations(
+    req: DeleteObservationsRequest,
+    if_match: Optional[str] = Header(None),
+    store: Store = Depends(get_store),
+):
+    expected = if_match_version(if_match)
+    try:
+        versions = store.commit(
+            {
+                "op": "delete_observations",
+                "deletions": [
+                    expect(
+                        {
+                            "entityName": d.entityName.lower(),
+                            "observations": d.observations,
+                        },
+                        (
+                            d.expectedVersion
+                            if d.expectedVersion is not None
+                            else expected
+                        ),
+                    )
+                    for d in req.deletions
+                ],
+            }
+        )
+    except VersionConflict as e:
+        raise version_conflict(e)
+    return {"message": "Observations deleted successfully", "versions": versions}
+
+
+@router.post("/delete_relations", summary="Delete relations from the graph")
+def delete_relations(req: DeleteRelationsRequest, store: Store = Depends(get_store)):
+    deleted = store.commit(
+        {
+            "op": "delete_relations",
+            "relations": [r.dict(by_alias=True) for r in req.relations],
+        }
+    )
+    return {
+        "message": "Relations deleted successfully",
+        "deletedRelations": deleted["relations"],
+    }
+
+
+@router.post("/bulk_import", summary="Import a graph from newline-delimited JSON")
+async def bulk_import(request: Request, store: Store = Depends(get_store)):
+    """
+    Load entities and relations in memory.json format, sent either as the raw
+    request body (application/x-ndjson) or as an uploaded file in the
+    multipart field ``file``. The upload is parsed as it streams in, checked
+    and deduplicated as a whole, and committed as a single mutation: either
+    every line is valid and the import is applied, or nothing changes.
+    Entities and relations that already exist are skipped.
+    """
+    batch = ImportBatch()
+    try:
+        if request.headers.get("content-type", "").startswith("multipart/form-data"):
+            form = await request.form()
+            upload = form.get("file")
+            if upload is None or isinstance(upload, str):
+                raise HTTPException(
+                    status_code=400, detail="Expected an uploaded file in 'file'"
+                )
+            while chunk := await upload.read(1 << 16):
+                await run_in_threadpool(batch.feed, chunk)
+        else:
+            async for chunk in request.stream():
+                await run_in_threadpool(batch.feed, chunk)
+        batch.close()
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    created = await run_in_threadpool(store.commit, batch.record())
+    return {
+        "createdEntities": created["entities"],
+        "createdRelations": created["relations"],
+        "skippedEntities": batch.entity_lines - created["entities"],
+        "skippedRelations": batch.relation_lines - created["relations"],
+    }
+
+
+@router.get("/bulk_export", summary="Export the graph as newline-delimited JSON")
+def bulk_export(namespace: str = Depends(get_namespace)):
+    """
+    Stream every entity and then every relation in memory.json format, ready
+    to be fed back to /bulk_import.
+    """
+    return StreamingResponse(
+        ndjson(leased(namespace, lambda store: store.iter_records())),
+        media_type="application/x-ndjson",
+        headers={"Content-Disposition": 'attachment; filename="memory.json"'},
+    )
 
 
-@app.post(
+@router.get(
+    "/read_graph",
+    response_model=KnowledgeGraphPage,
+    response_model_exclude_none=True,
+    summary="Read entire knowledge graph",
+)
+def read_graph(
+    response: Response,
+    limit: Optional[int] = Query(
+        None,
+        ge=1,
+        le=10000,
+        description="Return at most this many entities and relations, plus a nextCursor",
+    ),
+    cursor: Optional[str] = Query(
+        None, description="nextCursor from the previous page"
+    ),
+    stream: bool = Query(
+        False,
+        description="Stream the whole graph as newline-delimited JSON in memory.json format",
+    ),
+    if_none_match: Optional[str] = Header(None),
+    namespace: str = Depends(get_namespace),
+    store: Store = Depends(get_store),
+):
+    """
+    Without parameters the whole graph is returned in one document. With a
+    limit (or cursor), entities are paged in name order followed by relations,
+    and each page carries the cursor for the next one. With stream=true the
+    graph is sent as NDJSON while it is being read, so neither side has to
+    hold all of it at once.
+
+    The ETag is the graph's version (see /changes); a request whose
+    If-None-Match carries it gets 304 Not Modified.
+    """
+    # Taken before reading: at worst the graph is newer than its tag, and
+    # changes a client then fetches are harmless to apply again.
+    headers = {"ETag": f'"{store.version()}"', "Vary": MEMORY_NAMESPACE_HEADER}
+    if etag_matches(if_none_match, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    if stream:
+        return StreamingResponse(
+            ndjson(leased(namespace, lambda store: store.iter_records())),
+            media_type="application/x-ndjson",
+            headers=headers,
+        )
+    response.headers.update(headers)
+    if limit is None and cursor is None:
+        return store.read_graph()
+    try:
+        entities, relations, next_cursor = store.read_page(cursor, limit or 100)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return KnowledgeGraphPage(
+        entities=entities, relations=relations, nextCursor=next_cursor
+    )
+
+
+@router.get("/changes", summary="List the mutations made since a graph version")
+def changes(
+    since: int = Query(
+        ..., ge=0, description="Graph version the client has (an ETag of /read_graph)"
+    ),
+    limit: int = Query(
+        1000, ge=1, le=10000, description="Return at most this many changes"
+    ),
+    store: Store = Depends(get_store),
+):
+    """
+    Every committed mutation advances the graph's version by one. This
+    returns the current version and the mutations after ``since``, oldest
+    first, each as its request body plus ``op`` and ``version``. Applying
+    them in order brings a copy of the graph at ``since`` up to date; if
+    fewer than ``version - since`` came back, ask again from the last one.
+    The server keeps a limited history: when it no longer has the changes,
+    the answer is 410 and the client should read the graph again.
+    """
+    try:
+        version, found = store.changes(since, limit)
+    except ChangesExpired as e:
+        raise HTTPException(
+            status_code=410,
+            detail=f"Changes since version {since} are no longer available;"
+            f" the graph is at version {e.version}",
+        )
+    return {"version": version, "changes": found}
+
+
+@router.get(
+    "/changes/stream", summary="Follow the graph's mutations as server-sent events"
+)
+def changes_stream(
+    since: Optional[int] = Query(
+        None, ge=0, description="Start after this version (default: the current one)"
+    ),
+    last_event_id: Optional[int] = Header(None),
+    namespace: str = Depends(get_namespace),
+):
+    """
+    An event stream with one ``change`` event per mutation (the same objects
+    as /changes, with the version as event id) as soon as it is committed.
+    A reconnecting client's Last-Event-ID takes precedence over ``since``.
+    If the client has fallen behind the kept history, a ``reset`` event
+    with the current version closes the stream.
+    """
+    if last_event_id is not None:
+        since = last_event_id
+    return StreamingResponse(
+        change_events(namespace, since),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache"},
+    )
+
+
+@router.post(
     "/search_nodes",
     response_model=KnowledgeGraph,
     summary="Search for nodes by keyword",
 )
-def search_nodes(req: SearchNodesRequest):
-    graph = read_graph_file()
-    print(graph)
-    entities = [
-        e
-        for e in graph.entities
-        if req.query.lower() in e.name.lower()
-        or req.query.lower() in e.entityType.lower()
-        or any(req.query.lower() in o.lower() for o in e.observations)
-    ]
-    names = {e.name for e in entities}
-    relations = [r for r in graph.relations if r.from_ in names and r.to in names]
-
-    print(names, relations)
-    return KnowledgeGraph(entities=entities, relations=relations)
-
-
-@app.post(
+def search_nodes(
+    req: SearchNodesRequest, response: Response, store: Store = Depends(get_store)
+):
+    total, graph = store.search_nodes(req.query, req.limit, req.offset)
+    response.headers["X-Total-Count"] = str(total)
+    logs.detail(
+        "search_nodes",
+        query=req.query,
+        total=total,
+        entities=len(graph.entities),
+        relations=len(graph.relations),
+    )
+    return graph
+
+
+@router.post(
+    "/semantic_search",
+    response_model=List[SemanticMatch],
+    summary="Find observations similar in meaning to a query",
+)
+def semantic_search(req: SemanticSearchRequest, store: Store = Depends(get_store)):
+    """
+    Rank observations by the similarity of their embeddings to the query's,
+    using an approximate nearest-neighbor index. Available when the server
+    runs with MEMORY_SEMANTIC_MODEL and the jsonl storage backend.
+    """
+    try:
+        matches = store.semantic_search(req.query, req.limit)
+    except NotImplementedError:
+        raise HTTPException(
+            status_code=501, detail="Semantic search is not enabled on this server"
+        )
+    logs.detail("semantic_search", query=req.query, matches=len(matches))
+    return matches
+
+
+@router.post(
     "/open_nodes", response_model=KnowledgeGraph, summary="Open specific nodes by name"
 )
-def open_nodes(req: OpenNodesRequest):
-    graph = read_graph_file()
-    entities = [e for e in graph.entities if e.name in req.names]
-    names = {e.name for e in entities}
-    relations = [r for r in graph.relations if r.from_ in names and r.to in names]
-    return KnowledgeGraph(entities=entities, relations=relations)
+def open_nodes(req: OpenNodesRequest, store: Store = Depends(get_store)):
+    return store.open_nodes(req.names)
+
+
+@router.post(
+    "/traverse",
+    response_class=StreamingResponse,
+    summary="Explore the neighborhood of entities breadth-first",
+)
+def traverse(req: TraverseRequest, namespace: str = Depends(get_namespace)):
+    """
+    Walk the graph breadth-first from the given entities and stream the result
+    as newline-delimited JSON, one level at a time: entity lines (with the
+    depth they were reached at), relation lines, and a closing summary line
+    that reports whether a limit cut the traversal short.
+    """
+    records = leased(
+        namespace,
+        lambda store: store.traverse(
+            req.names,
+            req.maxDepth,
+            relation_types=req.relationTypes,
+            direction=req.direction,
+            max_nodes=req.maxNodes,
+            max_edges=req.maxEdges,
+        ),
+    )
+    return StreamingResponse(
+        ndjson(records),
+        media_type="application/x-ndjson",
+    )
+
+
+namespaced = APIRouter(prefix="/namespaces/{namespace}", include_in_schema=False)
+
+
+@namespaced.get("/openapi.json")
+def namespace_openapi():
+    # Lets a client be pointed at /namespaces/{namespace} as its base URL.
+    return app.openapi()
+
+
+namespaced.include_router(router)
+app.include_router(router)
+app.include_router(namespaced)
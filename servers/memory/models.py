@@ -0,0 +1,59 @@
+from pydantic import BaseModel, Field
+from typing import List, Literal, Optional
+
+
+# ----- Data Models -----
+class Entity(BaseModel):
+    name: str = Field(..., description="The name of the entity")
+    entityType: str = Field(..., description="The type of the entity")
+    observations: List[str] = Field(
+        ..., description="An array of observation contents associated with the entity"
+    )
+    version: Optional[int] = Field(
+        None,
+        description="Graph version of the entity's last change (ignored on input)",
+    )
+
+
+class Relation(BaseModel):
+    from_: str = Field(
+        ...,
+        alias="from",
+        description="The name of the entity where the relation starts",
+    )
+    to: str = Field(..., description="The name of the entity where the relation ends")
+    relationType: str = Field(..., description="The type of the relation")
+
+
+class KnowledgeGraph(BaseModel):
+    entities: List[Entity]
+    relations: List[Relation]
+
+
+class KnowledgeGraphPage(KnowledgeGraph):
+    nextCursor: Optional[str] = Field(
+        None,
+        description="Pass as cursor to fetch the next page; absent on the last page",
+    )
+
+
+class SemanticMatch(BaseModel):
+    entityName: str = Field(..., description="The entity the observation belongs to")
+    observation: str = Field(..., description="The matching observation")
+    score: float = Field(
+        ..., description="Cosine similarity to the query; higher is closer"
+    )
+
+
+class EntityWrapper(BaseModel):
+    type: Literal["entity"]
+    name: str
+    entityType: str
+    observations: List[str]
+
+
+class RelationWrapper(BaseModel):
+    type: Literal["relation"]
+    from_: str = Field(..., alias="from")
+    to: str
+    relationType: str
@@ -0,0 +1,109 @@
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Iterator, List, Optional
+import logging
+import re
+import threading
+
+from store import Store
+import logs
+
+# Namespaces become file names, so keep them to a safe alphabet.
+NAMESPACE_PATTERN = re.compile(r"[A-Za-z0-9_-][A-Za-z0-9_.-]{0,127}")
+
+
+def check_namespace(namespace: str) -> str:
+    """Return ``namespace`` if it is usable as a file name; raises ValueError."""
+    if not NAMESPACE_PATTERN.fullmatch(namespace):
+        raise ValueError(f"Invalid namespace: {namespace!r}")
+    return namespace
+
+
+class _Entry:
+    __slots__ = ("namespace", "store", "users", "lock")
+
+    def __init__(self, namespace: str):
+        self.namespace = namespace
+        self.store: Optional[Store] = None
+        # Requests currently holding a lease; only idle stores are evicted.
+        self.users = 0
+        # Serializes opening and closing this namespace's store, so its
+        # files are never owned by two stores at once.
+        self.lock = threading.Lock()
+
+
+# ----- Namespace Registry -----
+class StoreRegistry:
+    """
+    One store per namespace, opened on first use and closed when idle.
+
+    Requests hold a lease on their namespace's store for as long as they use
+    it. Open stores are kept in least-recently-used order, and whenever
+    their estimated resident size exceeds ``budget_bytes``, idle stores are
+    closed oldest first (the most recent one always stays open). A closed
+    namespace is simply reopened, from its files, by the next request.
+    """
+
+    def __init__(self, open_store: Callable[[str], Store], budget_bytes: int):
+        self.open_store = open_store
+        self.budget_bytes = budget_bytes
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+
+    @contextmanager
+    def lease(self, namespace: str) -> Iterator[Store]:
+        with self._lock:
+            entry = self._entries.get(namespace)
+            if entry is None:
+                entry = self._entries[namespace] = _Entry(namespace)
+            entry.users += 1
+            self._entries.move_to_end(namespace)
+        try:
+            with entry.lock:
+                if entry.store is None:
+                    entry.store = self.open_store(namespace)
+                store = entry.store
+            yield store
+        finally:
+            with self._lock:
+                entry.users -= 1
+                victims = self._victims()
+            for victim in victims:
+                self._evict(victim)
+
+    def _victims(self) -> List[_Entry]:
+        # Called with _lock held.
+        open_entries = [e for e in self._entries.values() if e.store is not None]
+        total = sum(e.store.resident_bytes() for e in open_entries)
+        victims = []
+        for entry in open_entries[:-1]:
+            if total <= self.budget_bytes:
+                break
+            if not entry.users:
+                victims.append(entry)
+                total -= entry.store.resident_bytes()
+        return victims
+
+    def _evict(self, entry: _Entry):
+        with entry.lock:
+            with self._lock:
+                # A request may have leased the store since it was picked.
+                if entry.users or entry.store is None:
+                    return
+                store, entry.store = entry.store, None
+            # Leases arriving meanwhile find this entry and wait for the close.
+            store.close()
+            logs.event(logging.INFO, "closed idle namespace", namespace=entry.namespace)
+            with self._lock:
+                if not entry.users and self._entries.get(entry.namespace) is entry:
+                    del self._entries[entry.namespace]
+
+    def close(self):
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+        for entry in entries:
+            with entry.lock:
+                if entry.store is not None:
+                    entry.store.close()
+                    entry.store = None
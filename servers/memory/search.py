@@ -0,0 +1,177 @@
+from array import array
+from bisect import bisect_left
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+import re
+
+# Only trigrams are indexed; shorter queries have no posting list and fall
+# back to a scan, which rank() verifies like any other candidate set.
+NGRAM = 3
+TOKEN_PATTERN = re.compile(r"\w+")
+
+
+def ngrams(text: str) -> Set[str]:
+    return {text[i : i + NGRAM] for i in range(len(text) - NGRAM + 1)}
+
+
+def tokens(text: str) -> Set[str]:
+    return set(TOKEN_PATTERN.findall(text))
+
+
+class Postings:
+    """
+    Key -> sorted array of entity ids, maintained incrementally.
+
+    An entity may contribute the same key through several texts (its name,
+    type and each observation). Rather than counting them, removals are
+    given only the keys none of the entity's remaining texts carry.
+    """
+
+    def __init__(self):
+        self.postings: Dict[str, array] = {}
+
+    def add(self, entity_id: int, keys: Iterable[str]):
+        for key in keys:
+            posting = self.postings.get(key)
+            if posting is None:
+                self.postings[key] = array("I", (entity_id,))
+            elif posting[-1] < entity_id:
+                posting.append(entity_id)
+            else:
+                i = bisect_left(posting, entity_id)
+                if posting[i] != entity_id:
+                    posting.insert(i, entity_id)
+
+    def remove(self, entity_id: int, keys: Iterable[str]):
+        for key in keys:
+            posting = self.postings.get(key)
+            if posting is None:
+                continue
+            i = bisect_left(posting, entity_id)
+            if i < len(posting) and posting[i] == entity_id:
+                del posting[i]
+                if not posting:
+                    del self.postings[key]
+
+    def intersect(self, keys: Iterable[str]) -> List[int]:
+        lists = sorted((self.postings.get(key, EMPTY) for key in keys), key=len)
+        if not lists:
+            return []
+        result = list(lists[0])
+        for posting in lists[1:]:
+            if not result:
+                break
+            result = [i for i in result if _contains(posting, i)]
+        return result
+
+
+EMPTY = array("I")
+
+
+def _contains(posting: array, entity_id: int) -> bool:
+    i = bisect_left(posting, entity_id)
+    return i < len(posting) and posting[i] == entity_id
+
+
+def _grams_of(texts: Iterable[str]) -> Set[str]:
+    grams: Set[str] = set()
+    for text in texts:
+        grams |= ngrams(text.lower())
+    return grams
+
+
+# ----- Text Index -----
+class TextIndex:
+    """
+    Inverted index over entity names, types and observations.
+
+    Trigram postings narrow a substring query to the entities that can
+    possibly match, and the candidates are then verified against their text
+    so results are exactly those of a case-insensitive substring scan.
+    """
+
+    def __init__(self):
+        self.grams = Postings()
+        # Postings hold small ids rather than names; ids of removed entities
+        # are reused.
+        self._ids: Dict[str, int] = {}
+        self._names: List[Optional[str]] = []
+        self._free: List[int] = []
+
+    def _id(self, name: str) -> int:
+        entity_id = self._ids.get(name)
+        if entity_id is None:
+            if self._free:
+                entity_id = self._free.pop()
+                self._names[entity_id] = name
+            else:
+                entity_id = len(self._names)
+                self._names.append(name)
+            self._ids[name] = entity_id
+        return entity_id
+
+    def add_texts(self, name: str, texts: Iterable[str]):
+        self.grams.add(self._id(name), _grams_of(texts))
+
+    def remove_texts(self, name: str, texts: Iterable[str], remaining: Iterable[str]):
+        """Unindex ``texts`` of ``name``, which still has ``remaining``."""
+        entity_id = self._ids.get(name)
+        if entity_id is not None:
+            self.grams.remove(entity_id, _grams_of(texts) - _grams_of(remaining))
+
+    def remove_entity(self, name: str, texts: Iterable[str]):
+        """Unindex ``name``, whose texts were ``texts``."""
+        entity_id = self._ids.pop(name, None)
+        if entity_id is None:
+            return
+        self.grams.remove(entity_id, _grams_of(texts))
+        self._names[entity_id] = None
+        self._free.append(entity_id)
+
+    def candidates(self, query: str) -> Optional[Set[str]]:
+        """Names that may contain ``query``; None means every entity may."""
+        if len(query) < NGRAM:
+            return None
+        return {self._names[i] for i in self.grams.intersect(ngrams(query))}
+
+
+def word_patterns(query: str) -> List["re.Pattern[str]"]:
+    """A pattern per word of ``query`` matching it only as a whole word."""
+    return [re.compile(rf"(?<!\w){re.escape(t)}(?!\w)") for t in tokens(query)]
+
+
+def score(entity, query: str, words: List["re.Pattern[str]"]) -> int:
+    """
+    Rank a candidate, returning 0 if it does not contain ``query`` at all.
+
+    Name hits outweigh type hits, which outweigh observation hits; every
+    matching observation counts, and a bonus goes to entities containing
+    every one of ``words`` (see word_patterns) as a whole word.
+    """
+    total = 0
+    name = entity.name.lower()
+    if name == query:
+        total += 100
+    elif query in name:
+        total += 10
+    entity_type = entity.entityType.lower()
+    if query in entity_type:
+        total += 5
+    observations = [o.lower() for o in entity.observations]
+    total += sum(1 for o in observations if query in o)
+    if total and words:
+        texts = [name, entity_type, *observations]
+        if all(any(w.search(t) for t in texts) for w in words):
+            total += 3
+    return total
+
+
+def rank(entities: Iterable[Tuple[int, object]], query: str) -> List:
+    """Score ``(position, entity)`` pairs and order them best-first."""
+    words = word_patterns(query)
+    scored = []
+    for position, entity in entities:
+        s = score(entity, query, words)
+        if s:
+            scored.append((-s, position, entity))
+    scored.sort(key=lambda item: item[:2])
+    return [entity for _, _, entity in scored]
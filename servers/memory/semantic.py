@@ -0,0 +1,461 @@
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+import json
+import os
+import re
+import zlib
+
+import numpy as np
+
+WORD = re.compile(r"\w+")
+
+# Below this many observations a query is compared against every vector; at
+# and above it the index is partitioned into clusters (see VectorIndex).
+TRAIN_MIN_ROWS = 20_000
+# Sample size per cluster used to train the clusters.
+TRAIN_SAMPLE_PER_CLUSTER = 40
+TRAIN_ITERATIONS = 8
+# Vector components are stored as int8 multiples of 1/SCALE.
+SCALE = 127
+
+
+# ----- Embedders -----
+class HashingEmbedder:
+    """
+    Dependency-free embedding of words and character trigrams.
+
+    Every lowercased word and every trigram of ``#word#`` is hashed (crc32,
+    so vectors are stable across processes) to a signed bucket of a ``dim``
+    vector, which is then L2-normalized. Texts sharing words, stems or
+    spelling variants land close together; meaning beyond that needs a
+    trained model (see SentenceTransformerEmbedder).
+    """
+
+    def __init__(self, dim: int = 256):
+        self.dim = dim
+        self.name = f"hashing-{dim}"
+        # Feature -> (bucket, signed weight), bounded by clearing when full.
+        self._buckets: Dict[str, Tuple[int, float]] = {}
+
+    def _bucket(self, feature: str, weight: float) -> Tuple[int, float]:
+        bucket = self._buckets.get(feature)
+        if bucket is None:
+            if len(self._buckets) >= 1 << 20:
+                self._buckets.clear()
+            h = zlib.crc32(feature.encode("utf-8", "surrogatepass"))
+            bucket = (h % self.dim, weight if h & (1 << 31) else -weight)
+            self._buckets[feature] = bucket
+        return bucket
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        rows, columns, values = [], [], []
+        for row, text in enumerate(texts):
+            for word in WORD.findall(text.lower()):
+                features = [(word, 1.0)]
+                padded = f"#{word}#"
+                features.extend(
+                    (padded[i : i + 3], 0.5) for i in range(len(padded) - 2)
+                )
+                for feature, weight in features:
+                    column, value = self._bucket(feature, weight)
+                    rows.append(row)
+                    columns.append(column)
+                    values.append(value)
+        vectors = np.zeros((len(texts), self.dim), np.float32)
+        np.add.at(vectors, (rows, columns), values)
+        return normalize(vectors)
+
+
+class SentenceTransformerEmbedder:
+    """A sentence-transformers model run on the CPU (optional dependency)."""
+
+    def __init__(self, model_name: str):
+        from sentence_transformers import SentenceTransformer
+
+        self._model = SentenceTransformer(model_name, device="cpu")
+        self.dim = self._model.get_sentence_embedding_dimension()
+        self.name = f"sentence-transformers:{model_name}"
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        vectors = self._model.encode(
+            texts, convert_to_numpy=True, normalize_embeddings=True
+        )
+        return np.asarray(vectors, np.float32).reshape(len(texts), self.dim)
+
+
+def load_embedder(spec: str):
+    """``hashing`` or ``hashing:<dim>``, else a sentence-transformers model name."""
+    kind, _, dim = spec.partition(":")
+    if kind == "hashing":
+        return HashingEmbedder(int(dim) if dim else 256)
+    return SentenceTransformerEmbedder(spec)
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return vectors / norms
+
+
+# ----- Vector Index -----
+class VectorIndex:
+    """
+    Approximate nearest-neighbor index over observations (IVF).
+
+    One unit vector per (entity, observation) is kept, quantized to int8, in
+    a growable matrix whose freed rows are reused. Once there are
+    TRAIN_MIN_ROWS of them, k-means splits the vectors into about sqrt(n)
+    clusters, and a query only scores the rows of the ``nprobe`` clusters
+    whose centroids are closest to it; those rows are picked out by one
+    vectorized lookup of each row's cluster. New vectors join their nearest
+    cluster as they are added; the clusters are retrained when the index has
+    grown fourfold since they were last trained. Scores are cosine
+    similarities.
+
+    Building and training are split so that the slow parts (embedding every
+    observation, k-means) can run outside the caller's lock: see
+    start_build()/add_embedded()/finish_build() and begin_training()/
+    fit_clusters()/finish_training(). Until new clusters are swapped in,
+    queries use the current ones, or compare against every vector.
+    """
+
+    def __init__(self, embedder):
+        self.embedder = embedder
+        self.vectors = np.zeros((1024, embedder.dim), np.int8)
+        # Cluster of each row, or -1 for a free row (0 for all rows before
+        # the clusters are trained).
+        self.cluster = np.full(1024, -1, np.int32)
+        self.owners: List[Optional[Tuple[str, str]]] = []
+        self.rows: Dict[str, Dict[str, int]] = {}
+        self.centroids: Optional[np.ndarray] = None
+        self._free: List[int] = []
+        self._trained_rows = 0
+        # Names changed while the index is being built, or None once built.
+        self._changed: Optional[Set[str]] = None
+        # Rows written while new clusters are being trained, or None.
+        self._rewritten: Optional[Set[int]] = None
+
+    def __len__(self) -> int:
+        return len(self.owners) - len(self._free)
+
+    def nbytes(self) -> int:
+        centroids = 0 if self.centroids is None else self.centroids.nbytes
+        return self.vectors.nbytes + self.cluster.nbytes + centroids
+
+    # -- updates --
+
+    def add_entities(self, entities: Iterable, batch_size: int = 4096):
+        """Index every observation of ``entities`` (EntityRecord or models)."""
+        batch: List[Tuple[str, str]] = []
+        for entity in entities:
+            for text in entity.observations:
+                batch.append((entity.name, text))
+                if len(batch) >= batch_size:
+                    self._add_pairs(batch)
+                    batch = []
+        self._add_pairs(batch)
+
+    def add(self, name: str, texts: Iterable[str]):
+        if self._changed is not None:
+            self._changed.add(name)
+        self._add_pairs([(name, text) for text in texts])
+
+    def _add_pairs(self, pairs: List[Tuple[str, str]]):
+        pairs = self._missing(pairs)
+        if pairs:
+            self._insert(pairs, self.embedder.embed([text for _, text in pairs]))
+
+    def _missing(self, pairs: List[Tuple[str, str]]) -> List[Tuple[str, str]]:
+        return [
+            (name, text)
+            for name, text in dict.fromkeys(pairs)
+            if text not in self.rows.get(name, ())
+        ]
+
+    def _insert(self, pairs: List[Tuple[str, str]], vectors: np.ndarray):
+        clusters = np.zeros(len(pairs), np.int32)
+        if self.centroids is not None:
+            clusters = np.argmax(vectors @ self.centroids.T, axis=1).astype(np.int32)
+        quantized = np.round(vectors * SCALE).astype(np.int8)
+        for (name, text), vector, cluster in zip(pairs, quantized, clusters):
+            row = self._allocate()
+            self.vectors[row] = vector
+            self.cluster[row] = cluster
+            self.owners[row] = (name, text)
+            self.rows.setdefault(name, {})[text] = row
+            if self._rewritten is not None:
+                self._rewritten.add(row)
+
+    def _allocate(self) -> int:
+        if self._free:
+            return self._free.pop()
+        row = len(self.owners)
+        if row == len(self.vectors):
+            self.vectors = np.concatenate([self.vectors, np.zeros_like(self.vectors)])
+            self.cluster = np.concatenate(
+                [self.cluster, np.full_like(self.cluster, -1)]
+            )
+        self.owners.append(None)
+        return row
+
+    def remove(self, name: str, texts: Iterable[str]):
+        if self._changed is not None:
+            self._changed.add(name)
+        rows = self.rows.get(name)
+        if not rows:
+            return
+        for text in texts:
+            row = rows.pop(text, None)
+            if row is not None:
+                self._release(row)
+        if not rows:
+            del self.rows[name]
+
+    def remove_entity(self, name: str):
+        if self._changed is not None:
+            self._changed.add(name)
+        for row in self.rows.pop(name, {}).values():
+            self._release(row)
+
+    def _release(self, row: int):
+        self.cluster[row] = -1
+        self.owners[row] = None
+        self._free.append(row)
+
+    # -- building --
+
+    @property
+    def building(self) -> bool:
+        return self._changed is not None
+
+    def start_build(self):
+        """
+        Mark the index as being built: add_embedded() then fills it while
+        add() and remove() keep taking writes, whose names are noted.
+        """
+        self._changed = set()
+
+    def add_embedded(self, pairs: List[Tuple[str, str]], vectors: np.ndarray):
+        """
+        Insert (name, observation) pairs read before the build started, with
+        their ``vectors``. Pairs of names changed since are skipped: they may
+        be stale, and finish_build() hands those names back to be redone.
+        """
+        keep = [
+            i
+            for i, (name, text) in enumerate(pairs)
+            if name not in self._changed and text not in self.rows.get(name, ())
+        ]
+        if keep:
+            self._insert([pairs[i] for i in keep], vectors[keep])
+
+    def finish_build(self) -> Set[str]:
+        """End the build; returns the names changed during it."""
+        changed, self._changed = self._changed, None
+        return changed
+
+    # -- clusters --
+
+    def _live_rows(self) -> np.ndarray:
+        return np.flatnonzero(self.cluster[: len(self.owners)] >= 0)
+
+    def _unit_vectors(self, rows: np.ndarray) -> np.ndarray:
+        return self.vectors[rows].astype(np.float32) / SCALE
+
+    def needs_training(self) -> bool:
+        """Whether the clusters are due (re)training and none is under way."""
+        if self._rewritten is not None or self.building:
+            return False
+        size = len(self)
+        if self.centroids is None:
+            return size >= TRAIN_MIN_ROWS
+        return size >= 4 * self._trained_rows
+
+    def begin_training(self) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Start retraining: returns the vector matrix and its live rows, to
+        pass to fit_clusters() outside any lock. Rows written from now on are
+        noted, since they may not match what fit_clusters() reads.
+        """
+        self._rewritten = set()
+        return self.vectors, self._live_rows()
+
+    def finish_training(self, live: np.ndarray, centroids: np.ndarray, nearest: np.ndarray):
+        """Swap in clusters from fit_clusters(), fixing up rows changed meanwhile."""
+        rewritten, self._rewritten = self._rewritten, None
+        # Rows freed since keep their -1; rewritten ones are assigned below.
+        keep = self.cluster[live] >= 0
+        self.cluster[live[keep]] = nearest[keep]
+        rows = np.array(sorted(rewritten), np.int64)
+        rows = rows[self.cluster[rows] >= 0]
+        if len(rows):
+            self.cluster[rows] = np.argmax(self._unit_vectors(rows) @ centroids.T, axis=1)
+        self.centroids = centroids
+        self._trained_rows = len(live)
+
+    def abandon_training(self):
+        self._rewritten = None
+
+    def train(self, seed: int = 0):
+        """(Re)compute the clusters with k-means and reassign every vector."""
+        vectors, live = self.begin_training()
+        self.finish_training(live, *fit_clusters(vectors, live, seed))
+
+    # -- queries --
+
+    def search(
+        self, query: str, limit: int = 10, nprobe: Optional[int] = None
+    ) -> List[Tuple[str, str, float]]:
+        """
+        The ``limit`` observations closest to ``query``, as (entity,
+        observation, score). Observations unrelated to it (score 0 or less)
+        are left out, so fewer may be returned.
+        """
+        return self.search_vector(self.embedder.embed([query])[0], limit, nprobe)
+
+    def search_vector(
+        self, vector: np.ndarray, limit: int = 10, nprobe: Optional[int] = None
+    ) -> List[Tuple[str, str, float]]:
+        """As search(), for a query already embedded."""
+        if not len(self) or limit <= 0:
+            return []
+        if self.centroids is None:
+            rows = self._live_rows()
+        else:
+            if nprobe is None:
+                nprobe = 8 + len(self.centroids) // 16
+            nprobe = min(nprobe, len(self.centroids))
+            closest = np.argpartition(self.centroids @ vector, -nprobe)[-nprobe:]
+            # One slot past the clusters, so free rows (-1) look up False.
+            probed = np.zeros(len(self.centroids) + 1, bool)
+            probed[closest] = True
+            rows = np.flatnonzero(probed[self.cluster[: len(self.owners)]])
+        scores = self._unit_vectors(rows) @ vector
+        related = scores > 0
+        rows, scores = rows[related], scores[related]
+        if len(rows) > limit:
+            top = np.argpartition(scores, -limit)[-limit:]
+            rows, scores = rows[top], scores[top]
+        order = np.argsort(-scores, kind="stable")
+        return [
+            (*self.owners[row], float(score))
+            for row, score in zip(rows[order].tolist(), scores[order].tolist())
+        ]
+
+    # -- persistence --
+
+    def state(self) -> Dict:
+        """A copy of the index's contents, for ``write_vectors`` outside any lock."""
+        high = len(self.owners)
+        return {
+            "vectors": self.vectors[:high].copy(),
+            "cluster": self.cluster[:high].copy(),
+            "centroids": self.centroids,
+            "owners": list(self.owners),
+            "trained_rows": self._trained_rows,
+        }
+
+    @classmethod
+    def from_state(cls, embedder, state: Dict) -> "VectorIndex":
+        index = cls(embedder)
+        high = len(state["owners"])
+        capacity = max(1024, high)
+        index.vectors = np.zeros((capacity, embedder.dim), np.int8)
+        index.vectors[:high] = state["vectors"]
+        index.cluster = np.full(capacity, -1, np.int32)
+        index.cluster[:high] = state["cluster"]
+        index.owners = state["owners"]
+        index.centroids = state["centroids"]
+        index._trained_rows = state["trained_rows"]
+        for row, owner in enumerate(index.owners):
+            if owner is None:
+                index._free.append(row)
+            else:
+                name, text = owner
+                index.rows.setdefault(name, {})[text] = row
+        return index
+
+
+def fit_clusters(
+    vectors: np.ndarray, live: np.ndarray, seed: int = 0
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    k-means over the ``live`` rows of ``vectors`` (as from
+    VectorIndex.begin_training); returns the centroids and each live row's
+    nearest one.
+    """
+    count = max(1, int(np.sqrt(len(live))))
+    rng = np.random.default_rng(seed)
+    sample = live
+    if len(sample) > count * TRAIN_SAMPLE_PER_CLUSTER:
+        sample = rng.choice(live, count * TRAIN_SAMPLE_PER_CLUSTER, replace=False)
+    points = vectors[sample].astype(np.float32) / SCALE
+    centroids = points[rng.choice(len(points), count, replace=False)]
+    for _ in range(TRAIN_ITERATIONS):
+        nearest = np.argmax(points @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, nearest, points)
+        empty = ~sums.any(axis=1)
+        # Reseed clusters that lost all their points.
+        sums[empty] = points[rng.choice(len(points), int(empty.sum()))]
+        centroids = normalize(sums)
+
+    nearest = np.empty(len(live), np.int32)
+    for start in range(0, len(live), 65536):
+        rows = live[start : start + 65536]
+        units = vectors[rows].astype(np.float32) / SCALE
+        nearest[start : start + 65536] = np.argmax(units @ centroids.T, axis=1)
+    return centroids, nearest
+
+
+def write_vectors(path: Path, embedder_name: str, state: Dict, source=None, log=None):
+    """
+    Save an index state atomically, with the memory.json and log signatures
+    it corresponds to (as for snapshots).
+    """
+    meta = {
+        "embedder": embedder_name,
+        "source": source,
+        "log": log,
+        "trained_rows": state["trained_rows"],
+        "owners": state["owners"],
+    }
+    centroids = state["centroids"]
+    if centroids is None:
+        centroids = np.zeros((0, state["vectors"].shape[1]), np.float32)
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "wb") as f:
+        np.savez(
+            f,
+            vectors=state["vectors"],
+            cluster=state["cluster"],
+            centroids=centroids,
+            meta=np.frombuffer(
+                json.dumps(meta).encode("utf-8", "surrogatepass"), np.uint8
+            ),
+        )
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_vectors(path: Path, embedder) -> Tuple[VectorIndex, tuple, tuple]:
+    """
+    Load an index saved by ``write_vectors``, with its source and log
+    signatures. Raises ValueError if it was built by another embedder.
+    """
+    with np.load(path, allow_pickle=False) as data:
+        meta = json.loads(data["meta"].tobytes().decode("utf-8", "surrogatepass"))
+        if meta["embedder"] != embedder.name:
+            raise ValueError(f"{path} was built with {meta['embedder']}")
+        centroids = data["centroids"]
+        state = {
+            "vectors": data["vectors"],
+            "cluster": data["cluster"],
+            "centroids": centroids if len(centroids) else None,
+            "owners": [tuple(owner) if owner else None for owner in meta["owners"]],
+            "trained_rows": meta["trained_rows"],
+        }
+    source = meta["source"] and tuple(meta["source"])
+    log = meta["log"] and tuple(meta["log"])
+    return VectorIndex.from_state(embedder, state), source, log
@@ -0,0 +1,305 @@
+from array import array
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+import json
+import mmap
+import os
+import struct
+import sys
+
+# Binary snapshot layout:
+#
+#   MAGIC | section ... | header JSON | u64 header offset | u64 header length | MAGIC
+#
+# Sections are 8-byte aligned arrays in native byte order (recorded in the
+# header). Strings (entity names and types, relation endpoints and types)
+# live once in a table sorted by their UTF-8 bytes, so a string's id is its
+# rank and lookups are binary searches. Everything else refers to string ids:
+#
+#   string_offsets   u64[S+1]  byte ranges of each string in string_data
+#   string_data      UTF-8
+#   entity_of_string u32[S]    entity index named by each string, or NO_ENTITY
+#   entities         u32[2n]   (name id, type id) per entity, in graph order
+#   entity_versions  u64[n]    graph version of each entity's last change
+#   obs_offsets      u64[n+1]  byte ranges of each entity's observations
+#   obs_data         one JSON array of observations per entity
+#   relations        u32[3r]   (from id, to id, type id) per relation, in order
+#   out_offsets      u64[S+1]  ranges of out_index per string id
+#   out_index        u32[r]    relation indexes grouped by source, in order
+#   in_offsets       u64[S+1]  ranges of in_index per string id
+#   in_index         u32[r]    relation indexes grouped by target, in order
+
+MAGIC = b"MEMSNAP\x01"
+VERSION = 1
+NO_ENTITY = 0xFFFFFFFF
+TRAILER = struct.Struct("<QQ8s")
+
+
+def encode(text: str) -> bytes:
+    # JSON may carry lone surrogates, which strict UTF-8 cannot encode.
+    return text.encode("utf-8", "surrogatepass")
+
+
+def decode(data: bytes) -> str:
+    return data.decode("utf-8", "surrogatepass")
+
+
+def u32(values: Iterable[int] = ()) -> array:
+    return array("I", values)
+
+
+def u64(values: Iterable[int] = ()) -> array:
+    return array("Q", values)
+
+
+# ----- Writing -----
+def _group(keys: List[int], count: int) -> Tuple[array, array]:
+    """Offsets and indexes listing the positions of each key, in order."""
+    offsets = u64([0]) * (count + 1)
+    for key in keys:
+        offsets[key + 1] += 1
+    for i in range(count):
+        offsets[i + 1] += offsets[i]
+    index = u32([0]) * len(keys)
+    fill = offsets[:-1]
+    for position, key in enumerate(keys):
+        index[fill[key]] = position
+        fill[key] += 1
+    return offsets, index
+
+
+def write_snapshot(
+    path: Path,
+    entities: Iterable[Tuple[str, str, List[str], int]],
+    relations: Iterable[Tuple[str, str, str]],
+    source=None,
+    log=None,
+    version: int = 0,
+):
+    """
+    Write a snapshot atomically. ``source`` and ``log`` record which
+    memory.json and write-ahead log the state was taken from (see Snapshot),
+    ``version`` the graph version it is at.
+    """
+    entities = list(entities)
+    relations = list(relations)
+    texts = set()
+    for name, entity_type, _, _ in entities:
+        texts.add(name)
+        texts.add(entity_type)
+    for triple in relations:
+        texts.update(triple)
+    encoded = sorted((encode(t), t) for t in texts)
+    string_ids: Dict[str, int] = {t: i for i, (_, t) in enumerate(encoded)}
+    count = len(encoded)
+
+    string_offsets = u64([0])
+    for data, _ in encoded:
+        string_offsets.append(string_offsets[-1] + len(data))
+    entity_of_string = u32([NO_ENTITY]) * count
+    entity_ids = u32()
+    entity_versions = u64()
+    for i, (name, entity_type, _, entity_version) in enumerate(entities):
+        entity_of_string[string_ids[name]] = i
+        entity_ids.append(string_ids[name])
+        entity_ids.append(string_ids[entity_type])
+        entity_versions.append(entity_version)
+    relation_ids = u32(string_ids[t] for triple in relations for t in triple)
+    out_offsets, out_index = _group(relation_ids[0::3].tolist(), count)
+    in_offsets, in_index = _group(relation_ids[1::3].tolist(), count)
+
+    sections = {}
+    tmp_path = path.with_name(path.name + ".tmp")
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+
+        def begin(name: str):
+            padding = -f.tell() % 8
+            f.write(b"\0" * padding)
+            sections[name] = [f.tell(), 0]
+
+        def end(name: str):
+            sections[name][1] = f.tell() - sections[name][0]
+
+        def put(name: str, data):
+            begin(name)
+            f.write(data)
+            end(name)
+
+        put("string_offsets", string_offsets)
+        begin("string_data")
+        for data, _ in encoded:
+            f.write(data)
+        end("string_data")
+        put("entity_of_string", entity_of_string)
+        put("entities", entity_ids)
+        put("entity_versions", entity_versions)
+
+        obs_offsets = u64([0])
+        begin("obs_data")
+        for _, _, observations, _ in entities:
+            data = json.dumps(list(observations)).encode("utf-8")
+            f.write(data)
+            obs_offsets.append(obs_offsets[-1] + len(data))
+        end("obs_data")
+        put("obs_offsets", obs_offsets)
+
+        put("relations", relation_ids)
+        put("out_offsets", out_offsets)
+        put("out_index", out_index)
+        put("in_offsets", in_offsets)
+        put("in_index", in_index)
+
+        header = json.dumps(
+            {
+                "version": VERSION,
+                "byteorder": sys.byteorder,
+                "strings": count,
+                "entities": len(entities),
+                "relations": len(relations),
+                "source": source,
+                "log": log,
+                "graphVersion": version,
+                "sections": sections,
+            }
+        ).encode("utf-8")
+        header_offset = f.tell()
+        f.write(header)
+        f.write(TRAILER.pack(header_offset, len(header), MAGIC))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+# ----- Reading -----
+class Snapshot:
+    """
+    A memory-mapped snapshot, decoded on demand.
+
+    Opening one only reads its header; strings, entities and adjacency are
+    decoded from the mapping when asked for. ``source`` and ``log`` are the
+    (inode, mtime, size) signatures of the memory.json and write-ahead log
+    the snapshot was written from, and ``version`` the graph version it
+    holds. Raises ValueError for a file that is not a complete snapshot.
+    """
+
+    def __init__(self, path: Path):
+        with open(path, "rb") as f:
+            try:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                raise ValueError(f"{path} is empty")
+        mm = self._mmap
+        if len(mm) < len(MAGIC) + TRAILER.size or mm[: len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a memory snapshot")
+        header_offset, header_length, magic = TRAILER.unpack_from(
+            mm, len(mm) - TRAILER.size
+        )
+        if magic != MAGIC:
+            raise ValueError(f"{path} is incomplete")
+        header = json.loads(mm[header_offset : header_offset + header_length])
+        if header["version"] != VERSION or header["byteorder"] != sys.byteorder:
+            raise ValueError(f"{path} was written in an unsupported format")
+
+        self.size = len(mm)
+        self.string_count: int = header["strings"]
+        self.entity_count: int = header["entities"]
+        self.relation_count: int = header["relations"]
+        self.source = header["source"] and tuple(header["source"])
+        self.log = header["log"] and tuple(header["log"])
+        self.version: int = header.get("graphVersion", 0)
+
+        view = memoryview(mm)
+        sections = header["sections"]
+
+        def section(name: str, fmt: Optional[str]):
+            start, length = sections[name]
+            data = view[start : start + length]
+            return data.cast(fmt) if fmt else data
+
+        self._string_offsets = section("string_offsets", "Q")
+        self._string_start = sections["string_data"][0]
+        self._entity_of_string = section("entity_of_string", "I")
+        self._entities = section("entities", "I")
+        # Snapshots from before entity versions lack the section.
+        self._entity_versions = (
+            section("entity_versions", "Q") if "entity_versions" in sections else None
+        )
+        self._obs_offsets = section("obs_offsets", "Q")
+        self._obs_start = sections["obs_data"][0]
+        self.relations = section("relations", "I")
+        self._out_offsets = section("out_offsets", "Q")
+        self._out_index = section("out_index", "I")
+        self._in_offsets = section("in_offsets", "Q")
+        self._in_index = section("in_index", "I")
+
+    # -- strings --
+
+    def _string_bytes(self, string_id: int) -> bytes:
+        start = self._string_start
+        return self._mmap[
+            start
+            + self._string_offsets[string_id] : start
+            + self._string_offsets[string_id + 1]
+        ]
+
+    def string(self, string_id: int) -> str:
+        return decode(self._string_bytes(string_id))
+
+    def find(self, text: str) -> Optional[int]:
+        """Id of ``text`` in the string table, or None."""
+        needle = encode(text)
+        lo, hi = 0, self.string_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._string_bytes(mid) < needle:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo < self.string_count and self._string_bytes(lo) == needle:
+            return lo
+        return None
+
+    # -- entities --
+
+    def entity_index(self, string_id: int) -> Optional[int]:
+        """Index of the entity named by a string, or None."""
+        index = self._entity_of_string[string_id]
+        return None if index == NO_ENTITY else index
+
+    def entity_name(self, index: int) -> str:
+        return self.string(self._entities[2 * index])
+
+    def entity_type(self, index: int) -> str:
+        return self.string(self._entities[2 * index + 1])
+
+    def entity_version(self, index: int) -> int:
+        versions = self._entity_versions
+        return versions[index] if versions is not None else 0
+
+    def observations(self, index: int) -> List[str]:
+        start = self._obs_start
+        return json.loads(
+            self._mmap[
+                start + self._obs_offsets[index] : start + self._obs_offsets[index + 1]
+            ]
+        )
+
+    def names_in_order(self) -> List[str]:
+        """Entity names sorted like Python strings (the table's order)."""
+        return [
+            self.string(string_id)
+            for string_id in range(self.string_count)
+            if self._entity_of_string[string_id] != NO_ENTITY
+        ]
+
+    # -- relations --
+
+    def outgoing(self, string_id: int) -> memoryview:
+        """Indexes of the relations leaving a string id, in graph order."""
+        offsets = self._out_offsets
+        return self._out_index[offsets[string_id] : offsets[string_id + 1]]
+
+    def incoming(self, string_id: int) -> memoryview:
+        offsets = self._in_offsets
+        return self._in_index[offsets[string_id] : offsets[string_id + 1]]
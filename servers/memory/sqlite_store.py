@@ -0,0 +1,644 @@
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Dict, Iterable, List, Optional, Tuple
+import sqlite3
+import threading
+
+from models import Entity, Relation, KnowledgeGraph
+from search import rank
+from store import (
+    PendingCommit,
+    Store,
+    VersionConflict,
+    read_graph_file,
+    relation_model,
+    replay_log,
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS entities (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL UNIQUE,
+    entity_type TEXT NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE TABLE IF NOT EXISTS observations (
+    id INTEGER PRIMARY KEY,
+    entity_id INTEGER NOT NULL REFERENCES entities(id) ON DELETE CASCADE,
+    content TEXT NOT NULL,
+    -- Also serves lookups by entity_id alone.
+    UNIQUE (entity_id, content)
+);
+
+-- Relations reference entities by name: like the JSONL store, a relation may
+-- point at an entity that does not exist (yet).
+CREATE TABLE IF NOT EXISTS relations (
+    id INTEGER PRIMARY KEY,
+    from_name TEXT NOT NULL,
+    to_name TEXT NOT NULL,
+    relation_type TEXT NOT NULL,
+    UNIQUE (from_name, to_name, relation_type)
+);
+CREATE INDEX IF NOT EXISTS relations_to ON relations(to_name);
+
+CREATE VIRTUAL TABLE IF NOT EXISTS entities_fts
+    USING fts5(name, entity_type, tokenize='trigram');
+CREATE VIRTUAL TABLE IF NOT EXISTS observations_fts
+    USING fts5(content, tokenize='trigram');
+
+CREATE TRIGGER IF NOT EXISTS entities_fts_insert AFTER INSERT ON entities BEGIN
+    INSERT INTO entities_fts(rowid, name, entity_type)
+    VALUES (new.id, new.name, new.entity_type);
+END;
+CREATE TRIGGER IF NOT EXISTS entities_fts_delete AFTER DELETE ON entities BEGIN
+    DELETE FROM entities_fts WHERE rowid = old.id;
+END;
+CREATE TRIGGER IF NOT EXISTS observations_fts_insert AFTER INSERT ON observations BEGIN
+    INSERT INTO observations_fts(rowid, content) VALUES (new.id, new.content);
+END;
+CREATE TRIGGER IF NOT EXISTS observations_fts_delete AFTER DELETE ON observations BEGIN
+    DELETE FROM observations_fts WHERE rowid = old.id;
+END;
+"""
+
+# The trigram tokenizer cannot match anything shorter than this.
+MIN_FTS_QUERY = 3
+# SQLite's default page cache size per connection.
+PAGE_CACHE_BYTES = 2 << 20
+# Keep IN (...) lists well below SQLite's bound-parameter limit.
+CHUNK_SIZE = 500
+
+
+def chunks(items: List, size: int = CHUNK_SIZE):
+    for i in range(0, len(items), size):
+        yield items[i : i + size]
+
+
+def placeholders(items: List) -> str:
+    return ",".join("?" * len(items))
+
+
+# ----- SQLite Store -----
+class SqliteStore(Store):
+    """
+    Knowledge graph kept in a SQLite database in WAL mode.
+
+    Entities, observations and relations are rows indexed on name and on both
+    relation endpoints, so every mutation touches only the affected rows and
+    the graph does not have to fit in memory. search_nodes is served by FTS5
+    trigram indexes, kept in sync by triggers. Each worker thread gets its own
+    connection; readers run concurrently with the single writer.
+
+    On first start against an empty database, an existing JSONL memory file
+    (and its write-ahead log) is imported once.
+
+    The graph's version is kept in the meta table and advanced in the same
+    transaction as each mutation, which also stamps it on the entities it
+    creates or changes. The change feed only holds what this
+    process committed; writes by other processes restart it.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        migrate_from: Optional[Path] = None,
+        group_commit_window: float = 0.0,
+        change_history: int = 10000,
+    ):
+        super().__init__(group_commit_window, change_history)
+        self.path = path
+        self._local = threading.local()
+        self._connections: List[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        # Reentrant so a commit can publish its changes before letting go.
+        self._write_lock = threading.RLock()
+
+        conn = self._connection()
+        conn.executescript(SCHEMA)
+        columns = {row[1] for row in conn.execute("PRAGMA table_info(entities)")}
+        if "version" not in columns:
+            # Databases created before entities carried versions.
+            conn.execute(
+                "ALTER TABLE entities ADD COLUMN version INTEGER NOT NULL DEFAULT 0"
+            )
+        if not any(row[2] for row in conn.execute("PRAGMA index_list(observations)")):
+            self._unique_observations()
+        if migrate_from is not None:
+            self._migrate(migrate_from)
+        self.feed.reset(self._db_version(conn))
+
+    # -- connections --
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            # Autocommit mode: transactions are opened explicitly below.
+            conn = sqlite3.connect(
+                self.path, isolation_level=None, check_same_thread=False
+            )
+            conn.execute("PRAGMA journal_mode=WAL")
+            # Group commit acknowledges writes as durable, so every commit
+            # must reach the disk; batching is what keeps that affordable.
+            synchronous = "FULL" if self.group_commit_window > 0 else "NORMAL"
+            conn.execute(f"PRAGMA synchronous={synchronous}")
+            conn.execute("PRAGMA foreign_keys=ON")
+            conn.execute("PRAGMA busy_timeout=5000")
+            # SQLite's lower() only folds ASCII; match Python's str.lower().
+            conn.create_function("py_lower", 1, str.lower, deterministic=True)
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    @contextmanager
+    def _read(self):
+        conn = self._connection()
+        conn.execute("BEGIN")
+        try:
+            yield conn
+        finally:
+            conn.execute("COMMIT")
+
+    @contextmanager
+    def _write(self):
+        conn = self._connection()
+        with self._write_lock:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def close(self):
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
+
+    def resident_bytes(self) -> int:
+        # Only each connection's page cache stays resident.
+        with self._connections_lock:
+            return len(self._connections) * PAGE_CACHE_BYTES
+
+    # -- migration --
+
+    def _unique_observations(self):
+        """Databases created before an entity's observations were unique."""
+        with self._write() as conn:
+            conn.execute(
+                "DELETE FROM observations WHERE id NOT IN"
+                " (SELECT min(id) FROM observations GROUP BY entity_id, content)"
+            )
+            conn.execute(
+                "CREATE UNIQUE INDEX observations_content"
+                " ON observations(entity_id, content)"
+            )
+            conn.execute("DROP INDEX IF EXISTS observations_entity")
+
+    def _migrate(self, jsonl_path: Path):
+        with self._write() as conn:
+            done = conn.execute(
+                "SELECT value FROM meta WHERE key = 'migrated_from'"
+            ).fetchone()
+            empty = conn.execute(
+                "SELECT NOT EXISTS (SELECT 1 FROM entities)"
+                " AND NOT EXISTS (SELECT 1 FROM relations)"
+            ).fetchone()[0]
+            if done or not empty:
+                return
+            graph = read_graph_file(jsonl_path)
+            replay_log(graph, jsonl_path.with_name(jsonl_path.name + ".wal"))
+            self._insert_entities(conn, graph.iter_entities())
+            self._insert_relations(conn, map(relation_model, graph.relation_keys()))
+            conn.execute(
+                "INSERT INTO meta (key, value) VALUES ('migrated_from', ?)",
+                (str(jsonl_path),),
+            )
+            self._set_db_version(conn, graph.version)
+
+    # -- versions --
+
+    def _db_version(self, conn) -> int:
+        row = conn.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        return int(row[0]) if row else 0
+
+    def _set_db_version(self, conn, version: int):
+        conn.execute(
+            "INSERT OR REPLACE INTO meta (key, value) VALUES ('version', ?)",
+            (str(version),),
+        )
+
+    def refresh(self):
+        # Polled on every ETag check, /changes request and stream tick, so
+        # the common case is one read of the meta table, with no lock taken.
+        with self._read() as conn:
+            version = self._db_version(conn)
+        if version == self.feed.version:
+            return
+        # Commits publish while holding the write lock, so holding it here
+        # means a version ahead of the feed was written by another process
+        # rather than by a commit of ours still publishing.
+        with self._write_lock:
+            with self._read() as conn:
+                version = self._db_version(conn)
+            if version != self.feed.version:
+                self.feed.reset(version)
+
+    # -- mutations --
+
+    def _commit_batch(self, batch: List[PendingCommit], durable: bool):
+        """Apply the whole batch in one transaction, one savepoint per record."""
+        with self._write_lock:
+            changes = []
+            with self._write() as conn:
+                version = self._db_version(conn)
+                for p in batch:
+                    record = {"version": version + 1, **p.record}
+                    conn.execute("SAVEPOINT record")
+                    try:
+                        p.result = getattr(self, "_apply_" + p.record["op"])(
+                            conn, record
+                        )
+                    except (KeyError, VersionConflict) as e:
+                        conn.execute("ROLLBACK TO record")
+                        p.error = e
+                    else:
+                        version += 1
+                        changes.append(record)
+                    conn.execute("RELEASE record")
+                if changes:
+                    self._set_db_version(conn, version)
+            self.feed.publish(changes)
+
+    def _insert_entities(self, conn, entities: Iterable[Entity]) -> List[Entity]:
+        new_entities = []
+        for entity in entities:
+            cur = conn.execute(
+                "INSERT OR IGNORE INTO entities (name, entity_type, version)"
+                " VALUES (?, ?, ?)",
+                (entity.name, entity.entityType, entity.version or 0),
+            )
+            if not cur.rowcount:
+                continue
+            observations = list(dict.fromkeys(entity.observations))
+            conn.executemany(
+                "INSERT INTO observations (entity_id, content) VALUES (?, ?)",
+                [(cur.lastrowid, o) for o in observations],
+            )
+            new_entities.append(
+                Entity(
+                    name=entity.name,
+                    entityType=entity.entityType,
+                    observations=observations,
+                    version=entity.version or 0,
+                )
+            )
+        return new_entities
+
+    def _insert_relations(self, conn, relations: Iterable[Relation]) -> List[Relation]:
+        new = []
+        for relation in relations:
+            cur = conn.execute(
+                "INSERT OR IGNORE INTO relations (from_name, to_name, relation_type)"
+                " VALUES (?, ?, ?)",
+                (relation.from_, relation.to, relation.relationType),
+            )
+            if cur.rowcount:
+                new.append(relation)
+        return new
+
+    def _check_version(self, conn, name: str, expected: Optional[int]):
+        if expected is None:
+            return
+        row = conn.execute(
+            "SELECT version FROM entities WHERE name = ?", (name,)
+        ).fetchone()
+        actual = row[0] if row else None
+        if actual != expected:
+            raise VersionConflict(name, expected, actual)
+
+    def _apply_create_entities(self, conn, record: Dict) -> List[Entity]:
+        version = record.get("version", 0)
+        return self._insert_entities(
+            conn, (Entity(**{**e, "version": version}) for e in record["entities"])
+        )
+
+    def _apply_create_relations(self, conn, record: Dict) -> List[Relation]:
+        return self._insert_relations(
+            conn, (Relation(**r) for r in record["relations"])
+        )
+
+    def _apply_add_observations(self, conn, record: Dict) -> List[Dict]:
+        results = []
+        for item in record["observations"]:
+            name = item["entityName"]
+            row = conn.execute(
+                "SELECT id, version FROM entities WHERE name = ?", (name,)
+            ).fetchone()
+            if row is None:
+                # Raising rolls back observations added for earlier items.
+                raise KeyError(name)
+            entity_id, entity_version = row
+            self._check_version(conn, name, item.get("expectedVersion"))
+            # The unique (entity_id, content) index skips existing contents.
+            added = [
+                content
+                for content in item["contents"]
+                if conn.execute(
+                    "INSERT OR IGNORE INTO observations (entity_id, content)"
+                    " VALUES (?, ?)",
+                    (entity_id, content),
+                ).rowcount
+            ]
+            if added:
+                entity_version = record.get("version", 0)
+                conn.execute(
+                    "UPDATE entities SET version = ? WHERE id = ?",
+                    (entity_version, entity_id),
+                )
+            results.append(
+                {
+                    "entityName": name,
+                    "addedObservations": added,
+                    "version": entity_version,
+                }
+            )
+        return results
+
+    def _apply_delete_entities(self, conn, record: Dict) -> Dict:
+        # Both relation deletes are index lookups (the unique key starts with
+        # from_name; to_name has its own index).
+        for name, expected in record.get("expectedVersions", {}).items():
+            self._check_version(conn, name, expected)
+        names = [(name,) for name in dict.fromkeys(record["entityNames"])]
+        entities = conn.executemany("DELETE FROM entities WHERE name = ?", names)
+        outgoing = conn.executemany("DELETE FROM relations WHERE from_name = ?", names)
+        incoming = conn.executemany("DELETE FROM relations WHERE to_name = ?", names)
+        return {
+            "entities": entities.rowcount,
+            "relations": outgoing.rowcount + incoming.rowcount,
+        }
+
+    def _apply_delete_observations(self, conn, record: Dict) -> Dict[str, int]:
+        for item in record["deletions"]:
+            self._check_version(conn, item["entityName"], item.get("expectedVersion"))
+            cur = conn.executemany(
+                "DELETE FROM observations WHERE content = ? AND entity_id ="
+                " (SELECT id FROM entities WHERE name = ?)",
+                [(o, item["entityName"]) for o in item["observations"]],
+            )
+            if cur.rowcount > 0:
+                conn.execute(
+                    "UPDATE entities SET version = ? WHERE name = ?",
+                    (record.get("version", 0), item["entityName"]),
+                )
+        names = list(dict.fromkeys(item["entityName"] for item in record["deletions"]))
+        versions = {}
+        for chunk in chunks(names):
+            versions.update(
+                conn.execute(
+                    f"SELECT name, version FROM entities"
+                    f" WHERE name IN ({placeholders(chunk)})",
+                    chunk,
+                )
+            )
+        return versions
+
+    def _apply_delete_relations(self, conn, record: Dict) -> Dict:
+        cur = conn.executemany(
+            "DELETE FROM relations"
+            " WHERE from_name = ? AND to_name = ? AND relation_type = ?",
+            [(r["from"], r["to"], r["relationType"]) for r in record["relations"]],
+        )
+        return {"relations": cur.rowcount}
+
+    def _apply_import_graph(self, conn, record: Dict) -> Dict:
+        entities = record["entities"]
+        names = [e["name"] for e in entities]
+        existing = set()
+        for chunk in chunks(names):
+            existing.update(
+                row[0]
+                for row in conn.execute(
+                    f"SELECT name FROM entities WHERE name IN ({placeholders(chunk)})",
+                    chunk,
+                )
+            )
+        new_entities = [e for e in entities if e["name"] not in existing]
+        version = record.get("version", 0)
+        conn.executemany(
+            "INSERT INTO entities (name, entity_type, version) VALUES (?, ?, ?)",
+            [(e["name"], e["entityType"], version) for e in new_entities],
+        )
+        conn.executemany(
+            "INSERT OR IGNORE INTO observations (entity_id, content)"
+            " SELECT id, ? FROM entities WHERE name = ?",
+            [(o, e["name"]) for e in new_entities for o in e["observations"]],
+        )
+        cur = conn.executemany(
+            "INSERT OR IGNORE INTO relations (from_name, to_name, relation_type)"
+            " VALUES (?, ?, ?)",
+            [(r["from"], r["to"], r["relationType"]) for r in record["relations"]],
+        )
+        return {"entities": len(new_entities), "relations": max(cur.rowcount, 0)}
+
+    # -- queries --
+
+    def _load_entities(self, conn, ids: List[int]) -> List[Tuple[int, Entity]]:
+        """(id, Entity) pairs for ``ids``, in insertion order."""
+        rows = []
+        for chunk in chunks(sorted(ids)):
+            rows.extend(
+                conn.execute(
+                    f"SELECT id, name, entity_type, version FROM entities"
+                    f" WHERE id IN ({placeholders(chunk)}) ORDER BY id",
+                    chunk,
+                )
+            )
+        observations: Dict[int, List[str]] = {row[0]: [] for row in rows}
+        for chunk in chunks(list(observations)):
+            for entity_id, content in conn.execute(
+                f"SELECT entity_id, content FROM observations"
+                f" WHERE entity_id IN ({placeholders(chunk)}) ORDER BY id",
+                chunk,
+            ):
+                observations[entity_id].append(content)
+        return [
+            (
+                entity_id,
+                Entity(
+                    name=name,
+                    entityType=entity_type,
+                    observations=observations[entity_id],
+                    version=version,
+                ),
+            )
+            for entity_id, name, entity_type, version in rows
+        ]
+
+    def _entities_by_name(self, conn, names: List[str]) -> Dict[str, Entity]:
+        ids = []
+        for chunk in chunks(names):
+            ids.extend(
+                row[0]
+                for row in conn.execute(
+                    f"SELECT id FROM entities WHERE name IN ({placeholders(chunk)})",
+                    chunk,
+                )
+            )
+        return {e.name: e for _, e in self._load_entities(conn, ids)}
+
+    def _relations_among(self, conn, names: List[str]) -> List[Relation]:
+        members = set(names)
+        relations = []
+        for chunk in chunks(list(members)):
+            for from_, to, relation_type in conn.execute(
+                f"SELECT from_name, to_name, relation_type FROM relations"
+                f" WHERE from_name IN ({placeholders(chunk)}) ORDER BY id",
+                chunk,
+            ):
+                if to in members:
+                    relations.append(
+                        Relation(
+                            **{"from": from_, "to": to, "relationType": relation_type}
+                        )
+                    )
+        return relations
+
+    def read_graph(self) -> KnowledgeGraph:
+        with self._read() as conn:
+            observations: Dict[int, List[str]] = {}
+            for entity_id, content in conn.execute(
+                "SELECT entity_id, content FROM observations ORDER BY id"
+            ):
+                observations.setdefault(entity_id, []).append(content)
+            entities = [
+                Entity(
+                    name=name,
+                    entityType=entity_type,
+                    observations=observations.get(entity_id, []),
+                    version=version,
+                )
+                for entity_id, name, entity_type, version in conn.execute(
+                    "SELECT id, name, entity_type, version FROM entities ORDER BY id"
+                )
+            ]
+            relations = [
+                Relation(**{"from": from_, "to": to, "relationType": relation_type})
+                for from_, to, relation_type in conn.execute(
+                    "SELECT from_name, to_name, relation_type FROM relations"
+                    " ORDER BY id"
+                )
+            ]
+        return KnowledgeGraph(entities=entities, relations=relations)
+
+    def open_nodes(self, names: List[str]) -> KnowledgeGraph:
+        names = list(dict.fromkeys(names))
+        with self._read() as conn:
+            by_name = self._entities_by_name(conn, names)
+            entities = [by_name[name] for name in names if name in by_name]
+            relations = self._relations_among(conn, [e.name for e in entities])
+        return KnowledgeGraph(entities=entities, relations=relations)
+
+    def entity_page(self, after: Optional[str], limit: int) -> List[Entity]:
+        with self._read() as conn:
+            if after is None:
+                rows = conn.execute(
+                    "SELECT id FROM entities ORDER BY name LIMIT ?", (limit,)
+                )
+            else:
+                rows = conn.execute(
+                    "SELECT id FROM entities WHERE name > ? ORDER BY name LIMIT ?",
+                    (after, limit),
+                )
+            ids = [row[0] for row in rows]
+            entities = [e for _, e in self._load_entities(conn, ids)]
+        return sorted(entities, key=lambda e: e.name)
+
+    def relation_page(
+        self, after: Optional[Tuple[str, str, str]], limit: int
+    ) -> List[Relation]:
+        with self._read() as conn:
+            if after is None:
+                rows = conn.execute(
+                    "SELECT from_name, to_name, relation_type FROM relations"
+                    " ORDER BY from_name, to_name, relation_type LIMIT ?",
+                    (limit,),
+                )
+            else:
+                rows = conn.execute(
+                    "SELECT from_name, to_name, relation_type FROM relations"
+                    " WHERE (from_name, to_name, relation_type) > (?, ?, ?)"
+                    " ORDER BY from_name, to_name, relation_type LIMIT ?",
+                    (*after, limit),
+                )
+            return [
+                Relation(**{"from": from_, "to": to, "relationType": relation_type})
+                for from_, to, relation_type in rows
+            ]
+
+    def neighbors(self, names: List[str], direction: str) -> List[Relation]:
+        columns = {
+            "outgoing": ("from_name",),
+            "incoming": ("to_name",),
+            "both": ("from_name", "to_name"),
+        }[direction]
+        with self._read() as conn:
+            return [
+                Relation(**{"from": from_, "to": to, "relationType": relation_type})
+                for column in columns
+                for chunk in chunks(names)
+                for from_, to, relation_type in conn.execute(
+                    f"SELECT from_name, to_name, relation_type FROM relations"
+                    f" WHERE {column} IN ({placeholders(chunk)}) ORDER BY id",
+                    chunk,
+                )
+            ]
+
+    def entity_records(self, names: List[str]) -> List[Dict]:
+        with self._read() as conn:
+            by_name = self._entities_by_name(conn, names)
+        return [by_name[name].dict() for name in names if name in by_name]
+
+    def search_nodes(
+        self, query: str, limit: Optional[int] = None, offset: int = 0
+    ) -> Tuple[int, KnowledgeGraph]:
+        query = query.lower()
+        with self._read() as conn:
+            if len(query) >= MIN_FTS_QUERY:
+                phrase = '"' + query.replace('"', '""') + '"'
+                cur = conn.execute(
+                    "SELECT rowid FROM entities_fts WHERE entities_fts MATCH ?"
+                    " UNION"
+                    " SELECT o.entity_id FROM observations_fts"
+                    " JOIN observations o ON o.id = observations_fts.rowid"
+                    " WHERE observations_fts MATCH ?",
+                    (phrase, phrase),
+                )
+            else:
+                # Too short for the trigram index; fall back to a scan.
+                cur = conn.execute(
+                    "SELECT id FROM entities"
+                    " WHERE instr(py_lower(name), ?) OR instr(py_lower(entity_type), ?)"
+                    " UNION"
+                    " SELECT entity_id FROM observations"
+                    " WHERE instr(py_lower(content), ?)",
+                    (query, query, query),
+                )
+            candidates = self._load_entities(conn, [row[0] for row in cur])
+            # rank() re-checks every candidate, so the result is exactly a
+            # case-insensitive substring match whatever the tokenizer folds.
+            ranked = rank(candidates, query)
+            end = None if limit is None else offset + limit
+            entities = ranked[offset:end]
+            relations = self._relations_among(conn, [e.name for e in entities])
+        return len(ranked), KnowledgeGraph(entities=entities, relations=relations)
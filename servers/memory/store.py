@@ -0,0 +1,1399 @@
+from bisect import bisect_right
+from collections import deque
+from pathlib import Path
+from typing import Callable, Deque, Dict, Iterable, Iterator, List, Optional, Tuple
+import base64
+import json
+import logging
+import os
+import threading
+import time
+
+from graph import EntityRecord, EntityTuple, Graph, RelationKey, relation_key
+from models import Entity, Relation, KnowledgeGraph
+from snapshot import Snapshot, write_snapshot
+import logs
+
+# Resident graph size relative to its memory.json and log, for budgeting.
+RESIDENT_FACTOR = 3
+# Observations embedded per step when building a vector index; self.lock is
+# only taken between steps.
+VECTOR_BUILD_BATCH = 4096
+
+
+# ----- I/O Handlers -----
+def file_signature(path: Path):
+    """(inode, mtime, size) of ``path``, or None if it does not exist."""
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def read_graph_file(path: Path) -> Graph:
+    graph = Graph()
+    if not path.exists():
+        return graph
+    start = time.perf_counter()
+    with open(path, "r", encoding="utf-8") as f:
+        lines = [line for line in f if line.strip()]
+        for line in lines:
+            item = json.loads(line)
+            if item["type"] == "entity":
+                graph.add_entity(
+                    item["name"],
+                    item["entityType"],
+                    item["observations"],
+                    item.get("version", 0),
+                )
+            elif item["type"] == "relation":
+                graph.add_relation(item["from"], item["to"], item["relationType"])
+            elif item["type"] == "meta":
+                graph.version = item.get("version", 0)
+
+    logs.event(
+        logging.INFO,
+        "loaded graph",
+        path=str(path),
+        entities=graph.entity_count(),
+        relations=graph.relation_count(),
+        seconds=round(time.perf_counter() - start, 3),
+    )
+    return graph
+
+
+def write_graph_file(
+    path: Path,
+    entities: Iterable[EntityTuple],
+    relations: Iterable[RelationKey],
+    version: int = 0,
+):
+    with open(path, "w", encoding="utf-8") as f:
+        # Readers of the format skip lines that are neither entities nor relations.
+        f.write(json.dumps({"type": "meta", "version": version}) + "\n")
+        for name, entity_type, observations, entity_version in entities:
+            item = {
+                "type": "entity",
+                "name": name,
+                "entityType": entity_type,
+                "observations": observations,
+                "version": entity_version,
+            }
+            f.write(json.dumps(item) + "\n")
+        for from_, to, relation_type in relations:
+            item = {
+                "type": "relation",
+                "from": from_,
+                "to": to,
+                "relationType": relation_type,
+            }
+            f.write(json.dumps(item) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def save_graph(
+    path: Path,
+    entities: Iterable[EntityTuple],
+    relations: Iterable[RelationKey],
+    version: int = 0,
+):
+    # Write to a sibling file and swap it in so readers never see a partial file.
+    tmp_path = path.with_name(path.name + ".tmp")
+    write_graph_file(tmp_path, entities, relations, version)
+    os.replace(tmp_path, path)
+
+
+# ----- Log Records -----
+# Every mutation is expressed as a record shaped like its request body. The
+# same functions apply records to the live graph and replay them from the
+# write-ahead log, so replay reproduces exactly what the endpoint did. The
+# entities a record creates or changes take its version.
+
+
+class VersionConflict(Exception):
+    """A record expected an entity at a version it is no longer at."""
+
+    def __init__(self, name: str, expected: int, actual: Optional[int]):
+        super().__init__(name, expected, actual)
+        self.name = name
+        self.expected = expected
+        self.actual = actual
+
+
+def apply_create_entities(graph: Graph, record: Dict) -> List[Entity]:
+    version = record.get("version", 0)
+    new_entities = []
+    for item in record["entities"]:
+        entity = Entity(**{**item, "version": version})
+        if graph.add_entity(
+            entity.name, entity.entityType, entity.observations, version
+        ):
+            # As stored, without repeated observations.
+            new_entities.append(entity_model(graph.get_entity(entity.name)))
+    return new_entities
+
+
+def apply_create_relations(graph: Graph, record: Dict) -> List[Relation]:
+    new = []
+    for item in record["relations"]:
+        relation = Relation(**item)
+        if graph.add_relation(*relation_key(relation)):
+            new.append(relation)
+    return new
+
+
+def apply_add_observations(graph: Graph, record: Dict) -> List[Dict]:
+    # Resolve every entity before mutating so a missing one leaves the graph untouched.
+    targets = []
+    for item in record["observations"]:
+        name = item["entityName"]
+        entity = graph.get_entity(name)
+        if not entity:
+            raise KeyError(name)
+        targets.append((name, entity, item["contents"]))
+
+    results = []
+    for name, entity, contents in targets:
+        added = graph.add_observations(entity, contents, record.get("version", 0))
+        results.append(
+            {"entityName": name, "addedObservations": added, "version": entity.version}
+        )
+    return results
+
+
+def apply_delete_entities(graph: Graph, record: Dict) -> Dict:
+    # Each name only costs the relations that touch it, found through the
+    # adjacency indexes; repeated names are dropped first.
+    entities = relations = 0
+    for name in dict.fromkeys(record["entityNames"]):
+        relations += graph.detach(name)
+        entities += graph.remove_entity(name)
+    return {"entities": entities, "relations": relations}
+
+
+def apply_delete_observations(graph: Graph, record: Dict) -> Dict[str, int]:
+    """Returns the version of each entity deletions were asked for."""
+    versions = {}
+    for item in record["deletions"]:
+        entity = graph.get_entity(item["entityName"])
+        if entity:
+            graph.remove_observations(
+                entity, item["observations"], record.get("version", 0)
+            )
+            versions[entity.name] = entity.version
+    return versions
+
+
+def apply_delete_relations(graph: Graph, record: Dict) -> Dict:
+    relations = 0
+    for r in record["relations"]:
+        relations += graph.remove_relation(r["from"], r["to"], r["relationType"])
+    return {"relations": relations}
+
+
+def apply_import_graph(graph: Graph, record: Dict) -> Dict:
+    # Bulk records are validated by ImportBatch, so skip per-row model checks.
+    version = record.get("version", 0)
+    entities = 0
+    for item in record["entities"]:
+        if graph.add_entity(
+            item["name"], item["entityType"], item["observations"], version
+        ):
+            entities += 1
+    relations = 0
+    for item in record["relations"]:
+        if graph.add_relation(item["from"], item["to"], item["relationType"]):
+            relations += 1
+    return {"entities": entities, "relations": relations}
+
+
+def check_add_observations(graph: Graph, record: Dict, created: Dict[str, bool]):
+    for item in record["observations"]:
+        name = item["entityName"]
+        exists = created.get(name)
+        if exists is None:
+            exists = graph.get_entity(name) is not None
+        if not exists:
+            raise KeyError(name)
+
+
+def check_version(
+    graph: Graph, name: str, expected: Optional[int], created: Dict[str, bool]
+):
+    if expected is None:
+        return
+    entity = graph.get_entity(name)
+    actual = entity.version if entity is not None else None
+    # An entity that an earlier record in the batch touched is about to change.
+    if actual != expected or name in created:
+        raise VersionConflict(name, expected, actual)
+
+
+def check_record(graph: Graph, record: Dict, created: Dict[str, bool]):
+    """
+    Refuse a record that would fail, before it is logged: KeyError for a
+    missing entity, VersionConflict for a failed precondition.
+
+    ``created`` overlays the graph with entity names created or changed
+    (True) or deleted (False) by records accepted earlier in the same batch,
+    which are logged but not applied yet; accepting this record updates it.
+    """
+    if record["op"] == "add_observations":
+        check_add_observations(graph, record, created)
+        for item in record["observations"]:
+            check_version(
+                graph, item["entityName"], item.get("expectedVersion"), created
+            )
+        for item in record["observations"]:
+            created[item["entityName"]] = True
+    elif record["op"] == "delete_observations":
+        for item in record["deletions"]:
+            check_version(
+                graph, item["entityName"], item.get("expectedVersion"), created
+            )
+        for item in record["deletions"]:
+            name = item["entityName"]
+            if created.get(name, graph.get_entity(name) is not None):
+                created[name] = True
+    elif record["op"] in ("create_entities", "import_graph"):
+        for item in record["entities"]:
+            created[item["name"]] = True
+    elif record["op"] == "delete_entities":
+        for name, expected in record.get("expectedVersions", {}).items():
+            check_version(graph, name, expected, created)
+        for name in record["entityNames"]:
+            created[name] = False
+
+
+APPLY = {
+    "create_entities": apply_create_entities,
+    "create_relations": apply_create_relations,
+    "add_observations": apply_add_observations,
+    "delete_entities": apply_delete_entities,
+    "delete_observations": apply_delete_observations,
+    "delete_relations": apply_delete_relations,
+    "import_graph": apply_import_graph,
+}
+
+
+# ----- API Models -----
+# The resident graph holds compact records; models are built from them only
+# when a response needs one, and never share state with the live graph.
+
+
+def entity_model(entity: EntityRecord) -> Entity:
+    return Entity(
+        name=entity.name,
+        entityType=entity.entityType,
+        observations=list(entity.observations),
+        version=entity.version,
+    )
+
+
+def relation_model(key: RelationKey) -> Relation:
+    from_, to, relation_type = key
+    return Relation(**{"from": from_, "to": to, "relationType": relation_type})
+
+
+def log_records(path: Path) -> Iterator[Dict]:
+    """The records logged at ``path``, in order."""
+    if not path.exists():
+        return
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError:
+                # A torn final record from a crash mid-append; it was never acknowledged.
+                return
+
+
+def replay_log(graph: Graph, path: Path) -> List[Dict]:
+    """Apply the records logged at ``path``; returns those that were new, as changes."""
+    changes = []
+    for record in log_records(path):
+        # Records logged before versioning get the next number. One the
+        # graph already contains (see JsonlStore.compacting_path) is still
+        # applied, but is not a change.
+        version = record.setdefault("version", graph.version + 1)
+        new = version > graph.version
+        if new:
+            graph.version = version
+        try:
+            APPLY[record["op"]](graph, record)
+        except KeyError:
+            continue
+        if new:
+            changes.append(record)
+    return changes
+
+
+def log_history(paths: Iterable[Path], version: int, size: int) -> List[Dict]:
+    """
+    The last ``size`` records logged at ``paths`` that lead up to ``version``
+    without a gap, for the change feed after a load. Records the graph
+    already contained are included: they still describe how it got there.
+    """
+    history: Deque[Dict] = deque(maxlen=size)
+    for path in paths:
+        for record in log_records(path):
+            record_version = record.get("version")
+            if not isinstance(record_version, int) or record_version > version:
+                continue
+            if history:
+                last = history[-1]["version"]
+                if record_version <= last:
+                    # Also in the log being compacted.
+                    continue
+                if record_version != last + 1:
+                    history.clear()
+            history.append(record)
+    if not history or history[-1]["version"] != version:
+        return []
+    return list(history)
+
+
+# ----- Bulk Import -----
+class ImportBatch:
+    """
+    A graph being imported from memory.json-format lines.
+
+    Lines are checked as plain JSON rather than through the Pydantic models,
+    and entities (by name), relations (by key) and each entity's observations
+    are deduplicated with hash lookups as they arrive; the first occurrence
+    wins, as it would through create_entities. ``record()`` then yields a
+    single import_graph mutation for the whole batch.
+    """
+
+    def __init__(self):
+        self.entities: Dict[str, Dict] = {}
+        self.relations: Dict[Tuple[str, str, str], Dict] = {}
+        self.entity_lines = 0
+        self.relation_lines = 0
+        self._line_number = 0
+        self._partial = b""
+
+    def feed(self, chunk: bytes):
+        """Parse the complete lines in ``chunk``; raises ValueError on a bad one."""
+        lines = (self._partial + chunk).split(b"\n")
+        self._partial = lines.pop()
+        for line in lines:
+            self.add_line(line)
+
+    def close(self):
+        if self._partial:
+            self.add_line(self._partial)
+            self._partial = b""
+
+    def add_line(self, line: bytes):
+        self._line_number += 1
+        if not line.strip():
+            return
+        try:
+            item = json.loads(line)
+        except ValueError:
+            raise ValueError(f"line {self._line_number}: invalid JSON")
+        kind = item.get("type") if isinstance(item, dict) else None
+        if kind == "entity":
+            name = self._string(item, "name")
+            entity_type = self._string(item, "entityType")
+            observations = item.get("observations", [])
+            if not isinstance(observations, list) or not all(
+                isinstance(o, str) for o in observations
+            ):
+                raise ValueError(
+                    f"line {self._line_number}: observations must be a list of strings"
+                )
+            self.entity_lines += 1
+            if name not in self.entities:
+                self.entities[name] = {
+                    "name": name,
+                    "entityType": entity_type,
+                    "observations": list(dict.fromkeys(observations)),
+                }
+        elif kind == "relation":
+            key = (
+                self._string(item, "from"),
+                self._string(item, "to"),
+                self._string(item, "relationType"),
+            )
+            self.relation_lines += 1
+            if key not in self.relations:
+                self.relations[key] = {
+                    "from": key[0],
+                    "to": key[1],
+                    "relationType": key[2],
+                }
+        elif kind != "meta":
+            # memory.json's version line; the importing graph keeps its own.
+            raise ValueError(
+                f"line {self._line_number}: type must be 'entity' or 'relation'"
+            )
+
+    def _string(self, item: Dict, field: str) -> str:
+        value = item.get(field)
+        if not isinstance(value, str):
+            raise ValueError(f"line {self._line_number}: {field} must be a string")
+        return value
+
+    def record(self) -> Dict:
+        return {
+            "op": "import_graph",
+            "entities": list(self.entities.values()),
+            "relations": list(self.relations.values()),
+        }
+
+
+# ----- Cursors -----
+# Pages walk entities in name order, then relations in (from, to, type)
+# order. A cursor records which of the two is being walked and the last key
+# returned, so it stays valid however the graph changes in between.
+
+
+def encode_cursor(phase: str, key) -> str:
+    raw = json.dumps([phase, key], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii")
+
+
+def decode_cursor(cursor: Optional[str]):
+    """Return ``(phase, key)``; raises ValueError for a malformed cursor."""
+    if not cursor:
+        return "entities", None
+    try:
+        phase, key = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except Exception:
+        raise ValueError("Malformed cursor")
+    if phase == "entities" and isinstance(key, str):
+        return phase, key
+    if phase == "relations" and isinstance(key, list) and len(key) == 3:
+        return phase, tuple(key)
+    raise ValueError("Malformed cursor")
+
+
+# ----- Change Feed -----
+class ChangesExpired(Exception):
+    """The changes after a version are not in the feed; ``version`` is the current one."""
+
+    def __init__(self, version: int):
+        super().__init__(version)
+        self.version = version
+
+
+class ChangeFeed:
+    """
+    The most recent mutations of a graph, for clients that mirror it.
+
+    Each committed record gets the next graph version and is kept as a
+    change: the record plus its ``version``. A client that has seen version
+    ``v`` fetches the changes after it and applies them in order; like log
+    replay, applying a change it already has is harmless. Only the last
+    ``size`` changes are kept, and a store that reloads its graph starts the
+    feed over at the version it loaded, so a client further behind than
+    ``floor`` gets ChangesExpired and has to read the whole graph again.
+
+    Listeners are called, from the thread that changed the feed, after every
+    publish or reset.
+    """
+
+    def __init__(self, size: int = 10000):
+        self.size = size
+        self.version = 0
+        # Every change after this version is in _changes.
+        self.floor = 0
+        self._changes: List[Dict] = []
+        self._lock = threading.Lock()
+        self._listeners: List[Callable[[], None]] = []
+
+    def reset(self, version: int, changes: List[Dict] = ()):
+        with self._lock:
+            self._changes = list(changes)
+            self.version = version
+            self.floor = self._changes[0]["version"] - 1 if self._changes else version
+            self._trim(self.size)
+        self._notify()
+
+    def publish(self, changes: List[Dict]):
+        if not changes:
+            return
+        with self._lock:
+            if changes[0]["version"] != self.version + 1:
+                # Someone else changed the graph in between; start over.
+                self._changes = []
+                self.floor = changes[0]["version"] - 1
+            self._changes.extend(changes)
+            self.version = changes[-1]["version"]
+            # Trimming copies the list, so let it grow to twice the size first.
+            self._trim(2 * self.size)
+        self._notify()
+
+    def _trim(self, bound: int):
+        # Called with _lock held.
+        if len(self._changes) > bound:
+            del self._changes[: len(self._changes) - self.size]
+            self.floor = (
+                self._changes[0]["version"] - 1 if self._changes else self.version
+            )
+
+    def since(self, version: int, limit: int) -> Tuple[int, List[Dict]]:
+        """The current version and up to ``limit`` changes after ``version``."""
+        with self._lock:
+            if not self.floor <= version <= self.version:
+                raise ChangesExpired(self.version)
+            start = bisect_right(self._changes, version, key=lambda c: c["version"])
+            return self.version, self._changes[start : start + limit]
+
+    def subscribe(self, listener: Callable[[], None]):
+        with self._lock:
+            self._listeners.append(listener)
+
+    def unsubscribe(self, listener: Callable[[], None]):
+        with self._lock:
+            self._listeners.remove(listener)
+
+    def _notify(self):
+        with self._lock:
+            listeners = list(self._listeners)
+        for listener in listeners:
+            listener()
+
+
+# ----- Storage Backends -----
+class PendingCommit:
+    """A mutation record waiting in a commit batch, and its outcome."""
+
+    __slots__ = ("record", "result", "error", "done")
+
+    def __init__(self, record: Dict):
+        self.record = record
+        self.result = None
+        self.error: Optional[BaseException] = None
+        self.done = threading.Event()
+
+
+class Store:
+    """
+    Interface the endpoints use to reach the knowledge graph.
+
+    Mutations are passed to ``commit`` as records shaped like their request
+    bodies (see APPLY above); queries return API models ready to serialize.
+
+    With a ``group_commit_window`` (seconds), mutations that arrive within
+    the window are persisted together: the first caller becomes the batch
+    leader, waits out the window, and commits everything queued behind it in
+    one durable write. Every caller still returns only once its own record
+    is durable. Backends implement ``_commit_batch``.
+
+    Every committed record advances the graph's version and is published to
+    ``feed``, which keeps the last ``change_history`` of them.
+    """
+
+    def __init__(self, group_commit_window: float = 0.0, change_history: int = 10000):
+        self.group_commit_window = group_commit_window
+        self.feed = ChangeFeed(change_history)
+        self._queue: List[PendingCommit] = []
+        self._queue_lock = threading.Lock()
+        self._commit_lock = threading.Lock()
+        self._leader_waiting = False
+
+    def commit(self, record: Dict):
+        pending = PendingCommit(record)
+        if self.group_commit_window <= 0:
+            self._commit_batch([pending], durable=False)
+        else:
+            with self._queue_lock:
+                self._queue.append(pending)
+                leader = not self._leader_waiting
+                self._leader_waiting = True
+            if leader:
+                time.sleep(self.group_commit_window)
+                with self._commit_lock:
+                    # Records arriving from here on form the next batch, which
+                    # gathers while this one is being written.
+                    with self._queue_lock:
+                        batch, self._queue = self._queue, []
+                        self._leader_waiting = False
+                    try:
+                        self._commit_batch(batch, durable=True)
+                    except Exception as e:
+                        for p in batch:
+                            p.error = p.error or e
+                    finally:
+                        for p in batch:
+                            p.done.set()
+            else:
+                pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    def _commit_batch(self, batch: List[PendingCommit], durable: bool):
+        """
+        Persist and apply ``batch`` in order, setting each entry's result or
+        error. A refused record must not affect the rest of the batch. With
+        ``durable`` the batch must be on stable storage before returning.
+        """
+        raise NotImplementedError
+
+    def refresh(self):
+        """Catch the feed up with changes made to the files by other processes."""
+
+    def version(self) -> int:
+        """The graph's current version."""
+        self.refresh()
+        return self.feed.version
+
+    def changes(self, since: int, limit: int = 1000) -> Tuple[int, List[Dict]]:
+        """
+        The current version and up to ``limit`` changes after version
+        ``since``, oldest first. Raises ChangesExpired when the feed no
+        longer holds them.
+        """
+        self.refresh()
+        return self.feed.since(since, limit)
+
+    def read_graph(self) -> KnowledgeGraph:
+        raise NotImplementedError
+
+    def open_nodes(self, names: List[str]) -> KnowledgeGraph:
+        raise NotImplementedError
+
+    def search_nodes(
+        self, query: str, limit: Optional[int] = None, offset: int = 0
+    ) -> Tuple[int, KnowledgeGraph]:
+        """Return the total number of matches and the requested page of them."""
+        raise NotImplementedError
+
+    def semantic_search(self, query: str, limit: int = 10) -> List[Dict]:
+        """
+        The ``limit`` observations most similar to ``query``, closest first,
+        as ``{"entityName", "observation", "score"}`` dicts. Raises
+        NotImplementedError when the store has no embedder.
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def resident_bytes(self) -> int:
+        """Rough estimate of the memory this store keeps resident."""
+        return 0
+
+    # -- pagination --
+
+    def entity_page(self, after: Optional[str], limit: int) -> List[Entity]:
+        """Up to ``limit`` entities whose names sort after ``after``."""
+        raise NotImplementedError
+
+    def relation_page(
+        self, after: Optional[Tuple[str, str, str]], limit: int
+    ) -> List[Relation]:
+        """Up to ``limit`` relations whose (from, to, type) keys sort after ``after``."""
+        raise NotImplementedError
+
+    def read_page(
+        self, cursor: Optional[str], limit: int
+    ) -> Tuple[List[Entity], List[Relation], Optional[str]]:
+        """Up to ``limit`` entities and relations after ``cursor``, plus the next cursor."""
+        phase, after = decode_cursor(cursor)
+        entities: List[Entity] = []
+        if phase == "entities":
+            # Fetch one extra item to tell whether another page follows.
+            entities = self.entity_page(after, limit + 1)
+            if len(entities) > limit:
+                entities = entities[:limit]
+                return entities, [], encode_cursor("entities", entities[-1].name)
+            after = None
+        room = limit - len(entities)
+        relations = self.relation_page(after, room + 1)
+        if len(relations) <= room:
+            return entities, relations, None
+        relations = relations[:room]
+        if relations:
+            key = list(relation_key(relations[-1]))
+            return entities, relations, encode_cursor("relations", key)
+        # The page filled up exactly at the last entity; resume at the relations.
+        return entities, [], encode_cursor("entities", entities[-1].name)
+
+    def iter_records(self, batch_size: int = 1000) -> Iterator[Dict]:
+        """
+        Every entity then every relation, as memory.json records.
+
+        The graph is read in keyset-paginated batches, so memory use stays
+        bounded by ``batch_size`` however large the graph is.
+        """
+        after = None
+        while True:
+            batch = self.entity_page(after, batch_size)
+            for e in batch:
+                yield {"type": "entity", **e.dict()}
+            if len(batch) < batch_size:
+                break
+            after = batch[-1].name
+        after = None
+        while True:
+            batch = self.relation_page(after, batch_size)
+            for r in batch:
+                yield {"type": "relation", **r.dict(by_alias=True)}
+            if len(batch) < batch_size:
+                break
+            after = relation_key(batch[-1])
+
+    # -- traversal --
+
+    def neighbors(self, names: List[str], direction: str) -> List[Relation]:
+        """Relations leaving (``outgoing``), entering (``incoming``) or touching
+        (``both``) any of ``names``."""
+        raise NotImplementedError
+
+    def entity_records(self, names: List[str]) -> List[Dict]:
+        """Existing entities among ``names`` as plain dicts, in ``names`` order."""
+        raise NotImplementedError
+
+    def traverse(
+        self,
+        seeds: List[str],
+        max_depth: int,
+        relation_types: Optional[List[str]] = None,
+        direction: str = "both",
+        max_nodes: int = 1000,
+        max_edges: int = 5000,
+    ) -> Iterator[Dict]:
+        """
+        Breadth-first expansion from ``seeds``, yielded one level at a time.
+
+        Yields entity records (with the depth they were reached at) and the
+        relations followed to reach them, then a final summary record. Each
+        level is read in one short pass over the store's adjacency index, so
+        the store is never held for the whole traversal. Once ``max_nodes``
+        entities have been visited, relations leading to new entities are
+        skipped; once ``max_edges`` relations were emitted the walk stops.
+        """
+        type_filter = set(relation_types) if relation_types else None
+        frontier = list(dict.fromkeys(seeds))[:max_nodes]
+        visited = set(frontier)
+        seen_edges = set()
+        truncated = len(frontier) < len(set(seeds))
+
+        for entity in self.entity_records(frontier):
+            yield {"type": "entity", "depth": 0, **entity}
+
+        depth = 0
+        out_of_edges = False
+        while frontier and depth < max_depth and not out_of_edges:
+            depth += 1
+            edges = []
+            discovered = []
+            for relation in self.neighbors(frontier, direction):
+                key = relation_key(relation)
+                if key in seen_edges:
+                    continue
+                if type_filter is not None and relation.relationType not in type_filter:
+                    continue
+                if len(seen_edges) >= max_edges:
+                    truncated = out_of_edges = True
+                    break
+                # One endpoint is always in the frontier; the other may be new.
+                other = relation.to if relation.from_ in visited else relation.from_
+                if other not in visited:
+                    if len(visited) >= max_nodes:
+                        truncated = True
+                        continue
+                    visited.add(other)
+                    discovered.append(other)
+                seen_edges.add(key)
+                edges.append(relation)
+
+            for relation in edges:
+                yield {
+                    "type": "relation",
+                    "depth": depth,
+                    **relation.dict(by_alias=True),
+                }
+            for entity in self.entity_records(discovered):
+                yield {"type": "entity", "depth": depth, **entity}
+            frontier = discovered
+
+        yield {
+            "type": "summary",
+            "nodes": len(visited),
+            "edges": len(seen_edges),
+            "depth": depth,
+            "truncated": truncated,
+        }
+
+
+class JsonlStore(Store):
+    """
+    Process-resident knowledge graph with an append-only write-ahead log.
+
+    memory.json holds a snapshot and memory.json.wal holds the mutations made
+    since. The graph is loaded once (snapshot plus log replay) and served from
+    memory; each mutation appends one compact record to the log, so a write
+    costs O(change) rather than O(graph). The log is fsynced at most every
+    ``sync_interval`` seconds (0 syncs on every write), and once it grows past
+    ``compact_bytes`` a background thread folds it into a fresh snapshot.
+
+    Concurrency follows a single-writer model. ``_log_lock`` serializes
+    writers and covers all file I/O; ``lock`` guards the in-memory graph and
+    is only held while a record is applied or a response is copied out. A
+    record is logged before it is applied, so readers never wait on the disk
+    and never observe a change that is not in the log.
+
+    Every access compares the files' inode, mtime and size with what this
+    process last loaded or wrote, so edits made by another process trigger a
+    reload.
+
+    Compaction and ``close`` also write memory.json.snap, a binary snapshot
+    (see snapshot.py) that records the memory.json and log it reflects. When
+    it matches the current memory.json, loading maps it instead of parsing
+    memory.json, and decodes entities and adjacency as they are first used,
+    so opening a store costs O(log) rather than O(graph).
+
+    With an ``embedder`` (see semantic.py) the store also serves semantic
+    search from a vector index over observations. It is built on the first
+    query, kept up to date by every mutation, and saved to
+    memory.json.vectors next to each snapshot so later starts load it.
+
+    The graph's version is stored in memory.json's first line, in the binary
+    snapshot and in every log record, so it survives restarts. On load the
+    change feed is rebuilt from the log's records, also when a snapshot
+    already holds them, so it covers everything since the last compaction.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        sync_interval: float = 1.0,
+        compact_bytes: int = 8 << 20,
+        group_commit_window: float = 0.0,
+        embedder=None,
+        change_history: int = 10000,
+    ):
+        super().__init__(group_commit_window, change_history)
+        self.path = path
+        self.wal_path = path.with_name(path.name + ".wal")
+        # The log being folded by an in-flight compaction. Replaying it again
+        # on top of the new snapshot is harmless because every record is
+        # idempotent against a graph that already contains its effect.
+        self.compacting_path = path.with_name(path.name + ".wal.compacting")
+        self.snapshot_path = path.with_name(path.name + ".snap")
+        self.vectors_path = path.with_name(path.name + ".vectors")
+        self.embedder = embedder
+        self.sync_interval = sync_interval
+        self.compact_bytes = compact_bytes
+
+        # Lock order: _log_lock before lock.
+        self.lock = threading.RLock()
+        self._log_lock = threading.RLock()
+        # Held while a vector index is built, so only one build runs.
+        self._vectors_build_lock = threading.Lock()
+        self._graph: Optional[Graph] = None
+        self._signature = None
+        # (memory.json, log) signatures the snapshot on disk reflects.
+        self._snapshot_state = None
+        # Likewise for the saved vector index.
+        self._vectors_state = None
+        self._wal = None
+        self._dirty = False
+
+        self._wake = threading.Event()
+        self._closed = threading.Event()
+        self._worker = threading.Thread(
+            target=self._background, name="memory-wal", daemon=True
+        )
+        self._worker.start()
+
+    # -- file bookkeeping --
+
+    def _stat_signature(self):
+        return (file_signature(self.path), file_signature(self.wal_path))
+
+    def _load(self):
+        # Called with both locks held.
+        if self._wal is not None:
+            self._wal.close()
+            self._wal = None
+        self._snapshot_state = self._vectors_state = None
+        recovering = self.compacting_path.exists()
+        signature = self._stat_signature()
+        graph = None if recovering else self._open_snapshot(signature[0])
+        if graph is None:
+            graph = read_graph_file(self.path)
+            replay_log(graph, self.compacting_path)
+            replay_log(graph, self.wal_path)
+        else:
+            # Attached before the replay, which then updates it like any write.
+            self._open_vectors(graph)
+            if self._snapshot_state[1] != signature[1]:
+                replay_log(graph, self.wal_path)
+        # The feed starts with the logged records, including those the
+        # snapshot or memory.json already holds, so clients can catch up
+        # across a restart.
+        changes = log_history(
+            [self.compacting_path, self.wal_path], graph.version, self.feed.size
+        )
+        if self._graph is not None and graph.version <= self.feed.version:
+            # The files were edited without logging a newer version, so the
+            # graph changed in ways the feed cannot describe.
+            graph.version = self.feed.version + 1
+            changes = []
+        self.feed.reset(graph.version, changes)
+        self._graph = graph
+        self._wal = open(self.wal_path, "ab")
+        self._signature = self._stat_signature()
+        if recovering:
+            # A previous compaction did not finish; fold everything now.
+            save_graph(self.path, *graph.capture(), graph.version)
+            self.compacting_path.unlink()
+            self._signature = self._stat_signature()
+
+    def _open_snapshot(self, source) -> Optional[Graph]:
+        """A graph over the snapshot, if it was taken from the ``source`` memory.json."""
+        start = time.perf_counter()
+        try:
+            snapshot = Snapshot(self.snapshot_path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError) as e:
+            logs.event(
+                logging.WARNING,
+                "ignored unreadable snapshot",
+                path=str(self.snapshot_path),
+                error=str(e),
+            )
+            return None
+        if snapshot.source != source:
+            return None
+        self._snapshot_state = (snapshot.source, snapshot.log)
+        graph = Graph(snapshot)
+        logs.event(
+            logging.INFO,
+            "opened snapshot",
+            path=str(self.snapshot_path),
+            entities=graph.entity_count(),
+            relations=graph.relation_count(),
+            seconds=round(time.perf_counter() - start, 3),
+        )
+        return graph
+
+    def _open_vectors(self, graph: Graph):
+        """Attach the saved vector index if it was saved with the snapshot."""
+        if self.embedder is None or not self.vectors_path.exists():
+            return
+        from semantic import read_vectors
+
+        start = time.perf_counter()
+        try:
+            index, source, log = read_vectors(self.vectors_path, self.embedder)
+        except (OSError, ValueError, KeyError) as e:
+            logs.event(
+                logging.WARNING,
+                "ignored unreadable vector index",
+                path=str(self.vectors_path),
+                error=str(e),
+            )
+            return
+        if (source, log) != self._snapshot_state:
+            return
+        graph.vector_index = index
+        self._vectors_state = (source, log)
+        logs.event(
+            logging.INFO,
+            "loaded vector index",
+            path=str(self.vectors_path),
+            vectors=len(index),
+            seconds=round(time.perf_counter() - start, 3),
+        )
+
+    def _write_vectors(self, state: Dict, source, log):
+        from semantic import write_vectors
+
+        start = time.perf_counter()
+        write_vectors(self.vectors_path, self.embedder.name, state, source, log)
+        logs.event(
+            logging.INFO,
+            "wrote vector index",
+            path=str(self.vectors_path),
+            seconds=round(time.perf_counter() - start, 3),
+        )
+
+    def _write_snapshot(self, entities, relations, source, log, version):
+        start = time.perf_counter()
+        write_snapshot(self.snapshot_path, entities, relations, source, log, version)
+        logs.event(
+            logging.INFO,
+            "wrote snapshot",
+            path=str(self.snapshot_path),
+            seconds=round(time.perf_counter() - start, 3),
+        )
+
+    def _snapshot_stale(self, signature) -> bool:
+        source, log = signature
+        empty_log = not log or not log[2]
+        if self._snapshot_state is not None and self._snapshot_state[0] == source:
+            return not (self._snapshot_state[1] == log or empty_log)
+        return source is not None or not empty_log
+
+    # -- public API --
+
+    def read(self) -> Graph:
+        """
+        Return the resident graph, reloading it if the files changed on disk.
+
+        Must be called without ``lock`` held; callers take ``lock`` afterwards
+        for as long as they look at the graph.
+        """
+        if self._graph is not None and self._stat_signature() == self._signature:
+            return self._graph
+        # Either another process changed the files or a local write is in
+        # flight; waiting for the writer tells the two apart.
+        with self._log_lock:
+            if self._graph is None or self._stat_signature() != self._signature:
+                with self.lock:
+                    self._load()
+            return self._graph
+
+    def _commit_batch(self, batch: List[PendingCommit], durable: bool):
+        """Append the batch's records to the log in one write, then apply them."""
+        self.read()
+        with self._log_lock:
+            created: Dict[str, bool] = {}
+            accepted = []
+            with self.lock:
+                for p in batch:
+                    try:
+                        check_record(self._graph, p.record, created)
+                    except (KeyError, VersionConflict) as e:
+                        p.error = e
+                        continue
+                    accepted.append(p)
+            if not accepted:
+                return
+            version = self._graph.version
+            for p in accepted:
+                version += 1
+                p.record = {"version": version, **p.record}
+            data = b"".join(
+                (json.dumps(p.record, separators=(",", ":")) + "\n").encode("utf-8")
+                for p in accepted
+            )
+            offset = self._wal.tell()
+            try:
+                self._wal.write(data)
+                self._wal.flush()
+                if durable or self.sync_interval <= 0:
+                    os.fsync(self._wal.fileno())
+                else:
+                    self._dirty = True
+            except Exception as e:
+                # Drop any partial record so later appends stay readable.
+                try:
+                    self._wal.truncate(offset)
+                finally:
+                    self._signature = None
+                for p in accepted:
+                    p.error = e
+                return
+            with self.lock:
+                for p in accepted:
+                    p.result = APPLY[p.record["op"]](self._graph, p.record)
+                self._graph.version = version
+            self._signature = self._stat_signature()
+            self.feed.publish([p.record for p in accepted])
+            if self._signature[1] and self._signature[1][2] >= self.compact_bytes:
+                self._wake.set()
+
+    def refresh(self):
+        self.read()
+
+    def read_graph(self) -> KnowledgeGraph:
+        graph = self.read()
+        with self.lock:
+            entities = [entity_model(e) for e in graph.iter_entities()]
+            relations = [relation_model(k) for k in graph.relation_keys()]
+        return KnowledgeGraph(entities=entities, relations=relations)
+
+    def open_nodes(self, names: List[str]) -> KnowledgeGraph:
+        graph = self.read()
+        with self.lock:
+            found = [graph.get_entity(name) for name in dict.fromkeys(names)]
+            entities = [entity_model(e) for e in found if e is not None]
+            names = [e.name for e in entities]
+            relations = [relation_model(k) for k in graph.relations_among(names)]
+        return KnowledgeGraph(entities=entities, relations=relations)
+
+    def search_nodes(
+        self, query: str, limit: Optional[int] = None, offset: int = 0
+    ) -> Tuple[int, KnowledgeGraph]:
+        graph = self.read()
+        with self.lock:
+            ranked = graph.search(query)
+            end = None if limit is None else offset + limit
+            entities = [entity_model(e) for e in ranked[offset:end]]
+            keys = graph.relations_among(e.name for e in entities)
+            relations = [relation_model(k) for k in keys]
+        return len(ranked), KnowledgeGraph(entities=entities, relations=relations)
+
+    def entity_page(self, after: Optional[str], limit: int) -> List[Entity]:
+        graph = self.read()
+        with self.lock:
+            return [entity_model(e) for e in graph.entities_after(after, limit)]
+
+    def relation_page(
+        self, after: Optional[Tuple[str, str, str]], limit: int
+    ) -> List[Relation]:
+        graph = self.read()
+        with self.lock:
+            keys = graph.relations_after(after, limit)
+        return [relation_model(k) for k in keys]
+
+    def neighbors(self, names: List[str], direction: str) -> List[Relation]:
+        graph = self.read()
+        with self.lock:
+            keys = graph.neighbors(names, direction)
+        return [relation_model(k) for k in keys]
+
+    def entity_records(self, names: List[str]) -> List[Dict]:
+        graph = self.read()
+        with self.lock:
+            return [
+                {
+                    "name": e.name,
+                    "entityType": e.entityType,
+                    "observations": list(e.observations),
+                    "version": e.version,
+                }
+                for e in map(graph.get_entity, names)
+                if e is not None
+            ]
+
+    def semantic_search(self, query: str, limit: int = 10) -> List[Dict]:
+        if self.embedder is None:
+            raise NotImplementedError
+        graph = self.read()
+        # Embedding, building and training all happen outside self.lock;
+        # only the lookup itself holds it.
+        vector = self.embedder.embed([query])[0]
+        index = self._vector_index(graph)
+        with self.lock:
+            matches = index.search_vector(vector, limit)
+            if index.needs_training():
+                vectors, live = index.begin_training()
+                threading.Thread(
+                    target=self._train_vectors,
+                    args=(index, vectors, live),
+                    name="memory-vectors",
+                    daemon=True,
+                ).start()
+        return [
+            {"entityName": name, "observation": text, "score": score}
+            for name, text, score in matches
+        ]
+
+    def _vector_index(self, graph: Graph):
+        """
+        The graph's vector index, built first if need be. Observations are
+        embedded outside self.lock, so writes go on meanwhile; the index is
+        attached from the start to see them, and queries wait for the build.
+        """
+        with self.lock:
+            index = graph.vector_index
+            if index is not None and not index.building:
+                return index
+        with self._vectors_build_lock:
+            with self.lock:
+                index = graph.vector_index
+                if index is not None and not index.building:
+                    return index
+                from semantic import VectorIndex
+
+                start = time.perf_counter()
+                index = VectorIndex(self.embedder)
+                index.start_build()
+                graph.vector_index = index
+                pairs = [
+                    (e.name, text) for e in graph.iter_entities() for text in e.observations
+                ]
+            try:
+                for i in range(0, len(pairs), VECTOR_BUILD_BATCH):
+                    batch = pairs[i : i + VECTOR_BUILD_BATCH]
+                    vectors = self.embedder.embed([text for _, text in batch])
+                    with self.lock:
+                        index.add_embedded(batch, vectors)
+            except BaseException:
+                with self.lock:
+                    if graph.vector_index is index:
+                        graph.vector_index = None
+                raise
+            with self.lock:
+                # Entities written during the build are redone from the graph.
+                for name in index.finish_build():
+                    entity = graph.get_entity(name)
+                    if entity is None:
+                        index.remove_entity(name)
+                    else:
+                        index.add(name, entity.observations)
+            logs.event(
+                logging.INFO,
+                "built vector index",
+                vectors=len(index),
+                seconds=round(time.perf_counter() - start, 3),
+            )
+            return index
+
+    def _train_vectors(self, index, vectors, live):
+        from semantic import fit_clusters
+
+        start = time.perf_counter()
+        try:
+            centroids, nearest = fit_clusters(vectors, live)
+        except Exception:
+            logs.logger.exception("could not train vector index")
+            with self.lock:
+                index.abandon_training()
+            return
+        with self.lock:
+            index.finish_training(live, centroids, nearest)
+        logs.event(
+            logging.INFO,
+            "trained vector index",
+            vectors=len(live),
+            clusters=len(centroids),
+            seconds=round(time.perf_counter() - start, 3),
+        )
+
+    def resident_bytes(self) -> int:
+        # The loaded graph takes about three times the size of its files (see
+        # benchmarks/footprint.py); the sizes come from the last stat. A graph
+        # opened from a snapshot only holds the mapping plus what the log
+        # added on top of it.
+        graph, signature = self._graph, self._signature
+        if graph is None or not signature:
+            return 0
+        memory, log = signature
+        log_bytes = log[2] if log else 0
+        vectors = graph.vector_index.nbytes() if graph.vector_index is not None else 0
+        if graph.base is not None:
+            return graph.base.size + RESIDENT_FACTOR * log_bytes + vectors
+        return RESIDENT_FACTOR * ((memory[2] if memory else 0) + log_bytes) + vectors
+
+    def sync(self):
+        """Flush buffered log records to stable storage."""
+        with self._log_lock:
+            if self._dirty and self._wal is not None:
+                os.fsync(self._wal.fileno())
+                self._dirty = False
+
+    def compact(self):
+        """Fold the write-ahead log into a new memory.json snapshot."""
+        with self._log_lock:
+            if self._graph is None or self._wal is None:
+                return
+            self._wal.flush()
+            os.fsync(self._wal.fileno())
+            self._wal.close()
+            os.replace(self.wal_path, self.compacting_path)
+            self._wal = open(self.wal_path, "ab")
+            self._dirty = False
+            self._signature = self._stat_signature()
+            with self.lock:
+                entities, relations = self._graph.capture()
+                version = self._graph.version
+                vectors = self._graph.vector_index
+                if vectors is not None and not vectors.building:
+                    vectors = vectors.state()
+                else:
+                    vectors = None
+
+        # Serializing the snapshots is O(graph) and blocks neither readers nor writers.
+        start = time.perf_counter()
+        entities, relations = list(entities), list(relations)
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        write_graph_file(tmp_path, entities, relations, version)
+        # The rename keeps the inode and mtime, so this is the new memory.json's
+        # signature. Records appended since the capture are replayed on load.
+        source = file_signature(tmp_path)
+        self._write_snapshot(entities, relations, source, None, version)
+        if vectors is not None:
+            self._write_vectors(vectors, source, None)
+
+        with self._log_lock:
+            os.replace(tmp_path, self.path)
+            self.compacting_path.unlink()
+            self._signature = self._stat_signature()
+            self._snapshot_state = (source, None)
+            if vectors is not None:
+                self._vectors_state = (source, None)
+        logs.event(
+            logging.INFO,
+            "compacted log",
+            path=str(self.path),
+            entities=len(entities),
+            relations=len(relations),
+            seconds=round(time.perf_counter() - start, 3),
+        )
+
+    def close(self):
+        self._closed.set()
+        self._wake.set()
+        self._worker.join()
+        with self._log_lock:
+            self.sync()
+            if self._wal is not None:
+                self._wal.close()
+                self._wal = None
+            # Leave a snapshot of the final state for the next start, unless
+            # another process changed the files since they were loaded.
+            signature = self._stat_signature()
+            if (
+                self._graph is not None
+                and signature == self._signature
+                and self._snapshot_stale(signature)
+            ):
+                with self.lock:
+                    entities, relations = self._graph.capture()
+                    version = self._graph.version
+                try:
+                    self._write_snapshot(entities, relations, *signature, version)
+                    self._snapshot_state = signature
+                except OSError:
+                    logs.logger.exception("could not write snapshot")
+            # The vector index is saved against the snapshot it goes with.
+            if (
+                self._graph is not None
+                and self._graph.vector_index is not None
+                and not self._graph.vector_index.building
+                and signature == self._signature
+                and self._snapshot_state is not None
+                and self._vectors_state != self._snapshot_state
+            ):
+                with self.lock:
+                    vectors = self._graph.vector_index.state()
+                try:
+                    self._write_vectors(vectors, *self._snapshot_state)
+                    self._vectors_state = self._snapshot_state
+                except OSError:
+                    logs.logger.exception("could not write vector index")
+
+    # -- internals --
+
+    def _background(self):
+        timeout = self.sync_interval if self.sync_interval > 0 else None
+        while not self._closed.is_set():
+            self._wake.wait(timeout)
+            self._wake.clear()
+            if self._closed.is_set():
+                break
+            try:
+                self.sync()
+                with self._log_lock:
+                    signature = self._signature
+                if signature and signature[1] and signature[1][2] >= self.compact_bytes:
+                    self.compact()
+            except Exception:
+                # Keep the worker alive; the next wake-up retries.
+                logs.logger.exception("write-ahead log maintenance failed")